@@ -0,0 +1,156 @@
+# ход анализа документа для клиентов: процесс с моделью публикует частичный ответ в канал Redis,
+# API пересылает события клиенту через Server-Sent Events (GET /documents/{id}/analysis/stream)
+import json
+import os
+import time
+import redis
+import redis.asyncio
+import metrics
+from celery_app import REDIS_URL
+from logger_config import logger
+
+# публикация частичного ответа модели (0 - клиенты получают только итог)
+ANALYSIS_STREAMING_ENABLED = os.getenv('ANALYSIS_STREAMING_ENABLED', '1') == '1'
+# через сколько секунд без событий SSE-соединение получает комментарий-пинг (прокси не закрывают его)
+ANALYSIS_STREAM_PING_SECONDS = float(os.getenv('ANALYSIS_STREAM_PING_SECONDS', '15'))
+# частичный ответ публикуется не чаще раза в ANALYSIS_STREAM_FLUSH_SECONDS или каждые
+# ANALYSIS_STREAM_FLUSH_PIECES кусков: генерация не ждет Redis на каждом токене
+ANALYSIS_STREAM_FLUSH_SECONDS = float(os.getenv('ANALYSIS_STREAM_FLUSH_SECONDS', '0.25'))
+ANALYSIS_STREAM_FLUSH_PIECES = int(os.getenv('ANALYSIS_STREAM_FLUSH_PIECES', '32'))
+# сколько хранится последний полный частичный ответ для клиентов, подключившихся посреди генерации
+ANALYSIS_STREAM_TEXT_TTL_SECONDS = int(os.getenv('ANALYSIS_STREAM_TEXT_TTL_SECONDS', '600'))
+
+# события канала: status - документ взят в работу (processing) или ответ маленькой модели
+# отброшен и считается большой (escalated - частичный ответ начинается заново),
+# token - новая часть ответа (delta) с позиции offset, done - итог, error - сбой
+EVENT_STATUS = 'status'
+EVENT_TOKEN = 'token'
+EVENT_DONE = 'done'
+EVENT_ERROR = 'error'
+
+def channel(doc_id) -> str:
+    return f'edi:analysis:{doc_id}'
+
+def text_key(doc_id) -> str:
+    return f'edi:analysis_text:{doc_id}'
+
+def publish(doc_id, event: str, data: dict):
+    """
+    Событие анализа документа. Недоступный Redis не должен ломать обработку документа.
+    """
+    try:
+        metrics.get_redis().publish(channel(doc_id), json.dumps({'event': event, **data}, ensure_ascii=False))
+    except redis.RedisError as e:
+        logger.debug(f'Не удалось опубликовать событие {event} документа {doc_id}: {e}')
+
+def clear_partial(doc_id):
+    """
+    Сброс сохраненного частичного ответа (эскалация на большую модель - ответ начинается заново)
+    """
+    try:
+        metrics.get_redis().delete(text_key(doc_id))
+    except redis.RedisError as e:
+        logger.debug(f'Не удалось сбросить частичный ответ документа {doc_id}: {e}')
+
+class PartialPublisher:
+    """
+    Получатель кусков текста от бэкенда при генерации. Куски копятся и уходят пачкой
+    (не чаще ANALYSIS_STREAM_FLUSH_SECONDS): в событие token идет только новая часть (delta)
+    и ее позиция в ответе (offset), а весь текст с начала ответа хранится в ключе Redis -
+    клиент, подключившийся посреди генерации, получает его при подключении.
+    Остаток отправляется вызовом close() после генерации.
+    """
+    def __init__(self, doc_id, model_id: str):
+        self.doc_id = doc_id
+        self.model_id = model_id
+        self.text = ''
+        self._sent = 0
+        self._pieces = 0
+        self._flushed_at = time.monotonic()
+
+    def __call__(self, piece: str):
+        if not piece:
+            return
+        self.text += piece
+        self._pieces += 1
+        if self._pieces >= ANALYSIS_STREAM_FLUSH_PIECES or \
+                time.monotonic() - self._flushed_at >= ANALYSIS_STREAM_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        if self._sent == len(self.text):
+            return
+        delta = json.dumps({'event': EVENT_TOKEN, 'delta': self.text[self._sent:], 'offset': self._sent,
+                            'model': self.model_id}, ensure_ascii=False)
+        partial = json.dumps({'text': self.text, 'model': self.model_id}, ensure_ascii=False)
+        try:
+            # ключ и событие - одной пачкой команд, один обмен с Redis
+            pipe = metrics.get_redis().pipeline(transaction=False)
+            pipe.set(text_key(self.doc_id), partial, ex=ANALYSIS_STREAM_TEXT_TTL_SECONDS)
+            pipe.publish(channel(self.doc_id), delta)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.debug(f'Не удалось опубликовать частичный ответ документа {self.doc_id}: {e}')
+        self._sent = len(self.text)
+        self._pieces = 0
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+def sse_event(event: str, data: dict) -> str:
+    # формат text/event-stream: имя события и JSON одной строкой, пустая строка - конец события
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+async def relay(doc_id, load_final, is_disconnected):
+    """
+    События анализа документа в формате SSE до итога или ошибки.
+    load_final - корутина, возвращающая (событие, данные) итога из БД: done с анализом,
+    error для документа, анализ которого упал, None - анализ еще идет. Проверка идет после
+    подписки, поэтому итог или сбой, записанные до подключения клиента, не теряются;
+    частичный ответ, начатый до подключения, приходит одним событием token с полным текстом.
+    """
+    client = redis.asyncio.Redis.from_url(REDIS_URL)
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(channel(doc_id))
+        final = await load_final()
+        if final is not None:
+            yield sse_event(*final)
+            return
+        
+        # позиция конца уже отданного клиенту текста: повторы из событий до чтения ключа отбрасываются
+        position = 0
+        partial = await client.get(text_key(doc_id))
+        if partial:
+            partial = json.loads(partial)
+            position = len(partial['text'])
+            yield sse_event(EVENT_TOKEN, {'delta': partial['text'], 'offset': 0, 'model': partial['model']})
+        
+        while not await is_disconnected():
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=ANALYSIS_STREAM_PING_SECONDS)
+            if message is None:
+                yield ': ping\n\n'
+                continue
+            data = json.loads(message['data'])
+            event = data.pop('event')
+            if event == EVENT_TOKEN:
+                end = data['offset'] + len(data['delta'])
+                if end <= position:
+                    continue
+                if data['offset'] < position:
+                    data['delta'] = data['delta'][position - data['offset']:]
+                    data['offset'] = position
+                position = end
+            elif event == EVENT_STATUS and data.get('status') == 'escalated':
+                # ответ большой модели начинается с нуля
+                position = 0
+            yield sse_event(event, data)
+            if event in (EVENT_DONE, EVENT_ERROR):
+                return
+    except redis.RedisError as e:
+        logger.warning(f'Поток событий анализа документа {doc_id} прерван: {e}')
+        yield sse_event(EVENT_ERROR, {'detail': 'Поток событий анализа недоступен'})
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
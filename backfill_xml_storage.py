@@ -0,0 +1,51 @@
+# сжатие XML документов, загруженных до включения сжатого хранения
+# запуск: python backfill_xml_storage.py [размер пачки]
+import sys
+import time
+from sqlalchemy import func
+from database import SessionLocal, EdiDocument, init_db
+from xml_storage import compress_xml
+
+def backfill(batch_size: int = 500):
+    init_db()
+    db = SessionLocal()
+    raw_bytes = 0
+    compressed_bytes = 0
+    converted = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            # каждую пачку выбираю заново: уже сжатые строки выпадают из условия
+            docs = db.query(EdiDocument)\
+                .filter(EdiDocument.content_xml_compressed.is_(None),
+                        EdiDocument.content_xml_raw.isnot(None))\
+                .order_by(EdiDocument.id)\
+                .limit(batch_size)\
+                .all()
+            if not docs:
+                break
+
+            for doc in docs:
+                raw = doc.content_xml_raw
+                doc.content_xml_compressed, doc.content_codec = compress_xml(raw)
+                doc.content_xml_raw = None
+                raw_bytes += len(raw.encode('utf-8'))
+                compressed_bytes += len(doc.content_xml_compressed)
+            db.commit()
+            converted += len(docs)
+            print(f'Сжато документов: {converted}')
+
+        elapsed = time.perf_counter() - started
+        print(f'Готово за {elapsed:.1f} с. Документов: {converted}')
+        if converted:
+            print(f'Объем XML: {raw_bytes / 1024:.1f} КБ -> {compressed_bytes / 1024:.1f} КБ '
+                  f'(в {raw_bytes / compressed_bytes:.1f} раз меньше)')
+
+        # общий объем хранимого XML после переноса
+        total = db.query(func.coalesce(func.sum(func.length(EdiDocument.content_xml_compressed)), 0)).scalar()
+        print(f'Сжатый XML в таблице: {total / 1024:.1f} КБ')
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    backfill(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
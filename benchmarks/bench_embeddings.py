@@ -0,0 +1,111 @@
+# модель векторизации: время запуска процесса и скорость векторизации на CPU для бэкендов torch / onnx / torch_int8
+# старт: импорт модуля (--module, по умолчанию embeddings; main - нужен PostgreSQL) с ленивой моделью
+# и с загрузкой модели при импорте, как было раньше; каждый замер - в отдельном процессе
+# эквивалентность: косинус вектора бэкенда с вектором torch float32 и совпадение top-k поиска
+# запросами бэкенда по векторам правил torch (как правила хранятся в БД)
+# бэкенд, векторы которого ближе к torch хуже порогов --min-cosine / --min-top-k, считается неэквивалентным:
+# скрипт завершается с кодом 1 (проверка перед сменой EMBEDDING_BACKEND)
+# запуск: python benchmarks/bench_embeddings.py [--backends torch onnx torch_int8] [--texts 512]
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from embeddings import load_model, vector_agreement, EMBEDDING_MIN_COSINE, EMBEDDING_MIN_TOP_K_AGREEMENT
+
+# тексты в духе базы знаний и ошибок валидации накладных
+TOPICS = ['Сумма документа', 'Валюта', 'Дата выставления', 'ИНН поставщика', 'Ставка НДС', 'Номер накладной']
+CHECKS = ['не может быть отрицательной', 'должна совпадать с суммой строк', 'задается кодом ISO 4217',
+          'не может быть позже даты отгрузки', 'состоит из 10 или 12 цифр', 'обязателен для каждой строки']
+ERRORS = ["Element 'cbc:IssueDate': This element is not expected.",
+          "Element 'cbc:DocumentCurrencyCode': [facet 'pattern'] The value '...' is not accepted.",
+          'Сумма строк (N) не совпадает с итогом (N)',
+          "Element 'Invoice': Missing child element(s). Expected is ( cbc:IssueDate )."]
+
+def build_texts(count: int) -> list:
+    return [f'{TOPICS[i % len(TOPICS)]} {CHECKS[(i // len(TOPICS)) % len(CHECKS)]} (правило {i}).'
+            for i in range(count)]
+
+def startup_seconds(module: str, load: bool, backend: str) -> float:
+    code = f'import {module}'
+    if load:
+        code += '; from embeddings import embedder; embedder.load()'
+    env = dict(os.environ, EMBEDDING_BACKEND=backend)
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # None - бэкенд не загрузился (не установлены зависимости или нет файла модели)
+    return time.perf_counter() - started if result.returncode == 0 else None
+
+def seconds_cell(value) -> str:
+    return f'{value:>8.2f}' if value is not None else f"{'n/a':>8}"
+
+def throughput(model, texts: list, batch_size: int):
+    # одиночные вызовы - как запрос по ошибке документа, пачки - как массовый импорт правил
+    single = texts[:64]
+    started = time.perf_counter()
+    for text in single:
+        model.encode(text)
+    single_rate = len(single) / (time.perf_counter() - started)
+    started = time.perf_counter()
+    vectors = model.encode(texts, batch_size=batch_size)
+    batch_rate = len(texts) / (time.perf_counter() - started)
+    return single_rate, batch_rate, np.asarray(vectors, dtype=np.float32)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Старт процесса и скорость векторизации для бэкендов модели')
+    arg_parser.add_argument('--backends', nargs='+', choices=['torch', 'onnx', 'torch_int8'],
+                            default=['torch', 'onnx', 'torch_int8'])
+    arg_parser.add_argument('--texts', type=int, default=512)
+    arg_parser.add_argument('--batch-size', type=int, default=64)
+    arg_parser.add_argument('--k', type=int, default=5)
+    arg_parser.add_argument('--module', default='embeddings', help='модуль, импорт которого замеряется')
+    arg_parser.add_argument('--min-cosine', type=float, default=EMBEDDING_MIN_COSINE)
+    arg_parser.add_argument('--min-top-k', type=float, default=EMBEDDING_MIN_TOP_K_AGREEMENT)
+    args = arg_parser.parse_args()
+
+    failed = []
+    print(f"{'startup':>24} {'seconds':>8}")
+    print(f"{'import ' + args.module + ' (lazy)':>24} {seconds_cell(startup_seconds(args.module, False, 'torch'))}")
+    for backend in args.backends:
+        print(f"{'import + load ' + backend:>24} {seconds_cell(startup_seconds(args.module, True, backend))}")
+
+    texts = build_texts(args.texts)
+    print(f"\n{'backend':>10} {'load, s':>8} {'single/s':>9} {'batch/s':>9} {'min cos':>8} {'top' + str(args.k):>6}")
+    reference = None
+    for backend in ['torch'] + [b for b in args.backends if b != 'torch']:
+        started = time.perf_counter()
+        try:
+            model = load_model(backend=backend)
+        except Exception as e:
+            print(f'{backend:>10} недоступен: {e}')
+            continue
+        load_seconds = time.perf_counter() - started
+        single_rate, batch_rate, vectors = throughput(model, texts, args.batch_size)
+        queries = np.asarray(model.encode(ERRORS), dtype=np.float32)
+        if backend == 'torch':
+            reference = (vectors, queries)
+        elif reference is None:
+            # без эталона torch эквивалентность не проверить - бэкенд не проходит проверку
+            failed.append(backend)
+            print(f'{backend:>10} {load_seconds:>8.2f} {single_rate:>9.0f} {batch_rate:>9.0f} (нет эталона torch)')
+            continue
+        cosine, agreement = vector_agreement(reference[0], vectors, reference[1], queries, args.k)
+        equivalent = cosine >= args.min_cosine and agreement >= args.min_top_k
+        if not equivalent:
+            failed.append(backend)
+        print(f'{backend:>10} {load_seconds:>8.2f} {single_rate:>9.0f} {batch_rate:>9.0f} '
+              f"{cosine:>8.4f} {agreement:>6.2f} {'' if equivalent else 'НЕ ЭКВИВАЛЕНТЕН'}")
+
+    if failed:
+        print(f'\nВекторы {", ".join(failed)} отличаются от torch сильнее порогов: '
+              f'min cos < {args.min_cosine} или top-{args.k} < {args.min_top_k}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
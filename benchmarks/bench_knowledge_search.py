@@ -0,0 +1,135 @@
+# поиск правил по вектору: последовательный просмотр против индекса HNSW / IVFFlat и индекса в памяти воркера
+# задержка запроса (p50) и полнота (recall@k) относительно точного поиска при разных ef_search / probes
+# данные - синтетические векторы размерности 384 во временной таблице, настоящая база знаний не трогается
+# нужен PostgreSQL с pgvector; запуск: python benchmarks/bench_knowledge_search.py --rules 10000 100000
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+import numpy as np
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import engine, knowledge_index_statement
+from knowledge_search import set_search_params, RuleIndex
+
+TABLE = 'bench_knowledge_base'
+DIM = 384
+
+def build_vectors(count: int, seed: int = 0):
+    # векторы группами вокруг "тем", как у правил базы знаний, нормированы как у MiniLM
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, count // 100), DIM))
+    vectors = centers[rng.integers(0, len(centers), count)] + rng.normal(scale=0.6, size=(count, DIM))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+def vector_literal(vector) -> str:
+    return '[' + ','.join(f'{value:.6f}' for value in vector) + ']'
+
+def load_table(vectors):
+    with engine.connect() as connection:
+        connection.execute(text(f'DROP TABLE IF EXISTS {TABLE}'))
+        connection.execute(text(f'CREATE TABLE {TABLE} (id SERIAL PRIMARY KEY, status VARCHAR, embedding vector({DIM}))'))
+        connection.commit()
+    # COPY - в разы быстрее вставки по строке
+    rows = io.StringIO(''.join(f'approved\t{vector_literal(vector)}\n' for vector in vectors))
+    raw = engine.raw_connection()
+    try:
+        with raw.cursor() as cursor:
+            cursor.copy_expert(f'COPY {TABLE} (status, embedding) FROM STDIN', rows)
+        raw.commit()
+    finally:
+        raw.close()
+    with engine.connect() as connection:
+        connection.execute(text(f'ANALYZE {TABLE}'))
+        connection.commit()
+
+def run_queries(queries, k: int, index_type: str, ef_search: int = None, probes: int = None):
+    latencies = []
+    found = []
+    with engine.connect() as connection:
+        for query in queries:
+            with connection.begin():
+                if index_type == 'none':
+                    # точный поиск: индекс не используется
+                    connection.execute(text('SET LOCAL enable_indexscan = off'))
+                else:
+                    set_search_params(connection, index_type=index_type, ef_search=ef_search or 40,
+                                      probes=probes or 1, limit=k)
+                started = time.perf_counter()
+                ids = connection.execute(
+                    text(f"SELECT id FROM {TABLE} WHERE status = 'approved' "
+                         f"ORDER BY embedding <=> CAST(:query AS vector) LIMIT :k"),
+                    {'query': vector_literal(query), 'k': k}
+                ).scalars().all()
+                latencies.append((time.perf_counter() - started) * 1000)
+            found.append(ids)
+    return statistics.median(latencies), found
+
+def run_memory(vectors, queries, k: int):
+    # индекс в памяти процесса (KNOWLEDGE_SEARCH_MODE=memory): без обращения к БД
+    index = RuleIndex()
+    ids = list(range(1, len(vectors) + 1))
+    index.build(ids, vectors, ids)
+    latencies = []
+    found = []
+    for query in queries:
+        started = time.perf_counter()
+        found.append(index.search_vector(query, k))
+        latencies.append((time.perf_counter() - started) * 1000)
+    return statistics.median(latencies), found
+
+def recall(found, truth) -> float:
+    return statistics.mean(len(set(ids) & set(expected)) / len(expected) for ids, expected in zip(found, truth))
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Задержка и полнота поиска правил с индексом векторов и без него')
+    arg_parser.add_argument('--rules', type=int, nargs='+', default=[10000, 100000])
+    arg_parser.add_argument('--queries', type=int, default=100)
+    arg_parser.add_argument('--k', type=int, default=10)
+    arg_parser.add_argument('--index', choices=['hnsw', 'ivfflat'], default='hnsw')
+    arg_parser.add_argument('--ef-search', type=int, nargs='+', default=[10, 20, 40, 80, 160])
+    arg_parser.add_argument('--probes', type=int, nargs='+', default=[1, 5, 10, 20, 50])
+    args = arg_parser.parse_args()
+
+    print(f"{'rules':>7} {'search':>14} {'p50, ms':>9} {'recall@' + str(args.k):>10}")
+    try:
+        for count in args.rules:
+            vectors = build_vectors(count)
+            # запросы - зашумленные векторы из данных, точный ответ считается в numpy
+            rng = np.random.default_rng(1)
+            queries = vectors[rng.integers(0, count, args.queries)] + rng.normal(scale=0.05, size=(args.queries, DIM))
+            queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+            # id в таблице - порядковый номер вектора с 1
+            truth = [list(np.argsort(-(vectors @ query))[:args.k] + 1) for query in queries]
+            p50, found = run_memory(vectors, queries, args.k)
+            print(f"{count:>7} {'numpy memory':>14} {p50:>9.3f} {recall(found, truth):>10.3f}")
+            load_table(vectors)
+
+            p50, found = run_queries(queries, args.k, 'none')
+            print(f"{count:>7} {'seq scan':>14} {p50:>9.2f} {recall(found, truth):>10.3f}")
+
+            started = time.perf_counter()
+            with engine.connect() as connection:
+                connection.execute(text(knowledge_index_statement(TABLE, args.index)))
+                connection.commit()
+            print(f"{count:>7} {'build ' + args.index:>14} {(time.perf_counter() - started) * 1000:>9.0f}")
+
+            for value in (args.ef_search if args.index == 'hnsw' else args.probes):
+                if args.index == 'hnsw':
+                    p50, found = run_queries(queries, args.k, 'hnsw', ef_search=value)
+                    label = f'ef_search={value}'
+                else:
+                    p50, found = run_queries(queries, args.k, 'ivfflat', probes=value)
+                    label = f'probes={value}'
+                print(f'{count:>7} {label:>14} {p50:>9.2f} {recall(found, truth):>10.3f}')
+    finally:
+        with engine.connect() as connection:
+            connection.execute(text(f'DROP TABLE IF EXISTS {TABLE}'))
+            connection.commit()
+
+if __name__ == '__main__':
+    main()
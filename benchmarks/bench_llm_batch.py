@@ -0,0 +1,58 @@
+# пропускная способность и задержка анализа при разных размерах батча (нужна GGUF-модель в models/)
+# запросы подаются одновременно из нескольких потоков, как задачи воркера с пулом threads
+# запуск: python benchmarks/bench_llm_batch.py --batch-sizes 1 2 4 8 --requests 16
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# кэш ответов отключен - нужна честная генерация на каждом запросе
+os.environ['LLM_CACHE_ENABLED'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_batcher import InferenceBatcher
+from llm_engine import LLMEngine
+from bench_llm_prefix import ERRORS
+
+def run(engine: LLMEngine, template_text: str, batch_size: int, requests: int, max_tokens: int):
+    batcher = InferenceBatcher(lambda: engine, max_batch_size=batch_size, max_wait_ms=50)
+
+    def one(i):
+        started = time.perf_counter()
+        batcher.analyze(
+            doc_id=str(i),
+            doc_type='Invoice',
+            error_text=ERRORS[i % len(ERRORS)],
+            rules='- Сумма документа не может быть отрицательной.',
+            template_text=template_text,
+            generation_config={'temperature': 0.1, 'max_tokens': max_tokens}
+        )
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=requests) as pool:
+        latencies = sorted(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return requests / elapsed * 60, statistics.median(latencies), p95
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Документов в минуту и задержка при разных размерах батча')
+    arg_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    arg_parser.add_argument('--requests', type=int, default=16)
+    arg_parser.add_argument('--max-tokens', type=int, default=128)
+    args = arg_parser.parse_args()
+
+    with open('prompts/analyze_error.j2', encoding='utf-8') as f:
+        template_text = f.read()
+    engine = LLMEngine()
+
+    print(f"{'batch':>6} {'docs/min':>9} {'p50, ms':>9} {'p95, ms':>9}")
+    for batch_size in args.batch_sizes:
+        throughput, p50, p95 = run(engine, template_text, batch_size, args.requests, args.max_tokens)
+        print(f'{batch_size:>6} {throughput:>9.1f} {p50:>9.0f} {p95:>9.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# свободная генерация против ограниченной грамматикой JSON-схемы ответа (нужна GGUF-модель в models/)
+# считаются сгенерированные токены, время генерации и доля ответов, которые целиком разбираются json.loads
+# запуск: python benchmarks/bench_llm_constrained.py --requests 8
+import argparse
+import json
+import os
+import sys
+import time
+
+# кэш ответов отключен - нужна честная генерация на каждом запросе
+os.environ['LLM_CACHE_ENABLED'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llama_cpp
+import llm_backends
+from llm_engine import LLMEngine
+from bench_llm_prefix import ERRORS
+
+def is_json(text: str) -> bool:
+    try:
+        json.loads(text)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+def run(engine: LLMEngine, template_text: str, requests: int, max_tokens: int):
+    template = engine.env.from_string(template_text)
+    config = {'temperature': 0.1, 'max_tokens': max_tokens}
+    tokens, latencies, parsed = [], [], 0
+    for i in range(requests):
+        prompt = template.render(
+            doc_id=str(i),
+            doc_type='Invoice',
+            error_text=ERRORS[i % len(ERRORS)],
+            context_rules='- Сумма документа не может быть отрицательной.'
+        )
+        llama_cpp.llama_perf_context_reset(engine.backend.llm.ctx)
+        started = time.perf_counter()
+        raw_text = engine.backend.generate(prompt, config, prefix=engine._static_prefix(template))
+        latencies.append((time.perf_counter() - started) * 1000)
+        tokens.append(llama_cpp.llama_perf_context(engine.backend.llm.ctx).n_eval)
+        parsed += is_json(raw_text.strip())
+    return sum(tokens) / requests, sum(latencies) / requests, parsed / requests
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Токены, задержка и разбор JSON с грамматикой и без нее')
+    arg_parser.add_argument('--requests', type=int, default=8)
+    arg_parser.add_argument('--max-tokens', type=int, default=512)
+    args = arg_parser.parse_args()
+
+    with open('prompts/analyze_error.j2', encoding='utf-8') as f:
+        template_text = f.read()
+    engine = LLMEngine()
+
+    print(f"{'mode':>12} {'tokens':>7} {'latency, ms':>12} {'valid JSON':>11}")
+    for mode, enabled in (('free', False), ('constrained', True)):
+        llm_backends.LLM_CONSTRAINED_DECODING = enabled
+        tokens, latency, valid = run(engine, template_text, args.requests, args.max_tokens)
+        print(f'{mode:>12} {tokens:>7.1f} {latency:>12.0f} {valid:>11.0%}')
+
+if __name__ == '__main__':
+    main()
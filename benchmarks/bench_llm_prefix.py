@@ -0,0 +1,68 @@
+# бенчмарк переиспользования KV-кэша системного блока промпта (нужна GGUF-модель в models/)
+# время вычисления промпта (prompt eval) и генерации считаются раздельно по счетчикам llama.cpp
+# перед каждым запросом KV-кэш сбрасывается - так выглядит поток, где между задачами
+# модель обрабатывала другие промпты
+# запуск: python benchmarks/bench_llm_prefix.py --requests 5
+import argparse
+import os
+import sys
+import time
+
+# кэш ответов отключен - нужна честная генерация на каждом запросе
+os.environ['LLM_CACHE_ENABLED'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llama_cpp
+import llm_backends
+from llm_engine import LLMEngine
+
+ERRORS = [
+    'Сумма строк (100.0) не совпадает с итогом (120.0)',
+    "Element 'cbc:IssueDate': This element is not expected.",
+    'Сумма документа не может быть отрицательной.',
+    "Element 'cbc:DocumentCurrencyCode': [facet 'pattern'] The value 'EURO' is not accepted.",
+]
+
+def run(engine: LLMEngine, template_text: str, requests: int, max_tokens: int):
+    ctx = engine.backend.llm.ctx
+    prompt_eval_ms, generation_ms, prompt_tokens, total_ms = [], [], [], []
+    for i in range(requests):
+        engine.backend.llm.reset()
+        llama_cpp.llama_perf_context_reset(ctx)
+        started = time.perf_counter()
+        engine.analyze_error(
+            doc_id=str(i),
+            doc_type='Invoice',
+            error_text=ERRORS[i % len(ERRORS)],
+            rules='- Сумма документа не может быть отрицательной.',
+            template_text=template_text,
+            generation_config={'temperature': 0.1, 'max_tokens': max_tokens}
+        )
+        total_ms.append((time.perf_counter() - started) * 1000)
+        perf = llama_cpp.llama_perf_context(ctx)
+        prompt_eval_ms.append(perf.t_p_eval_ms)
+        generation_ms.append(perf.t_eval_ms)
+        prompt_tokens.append(perf.n_p_eval)
+    # первый запрос с префиксом вычисляет его и сохраняет состояние - в среднее не беру
+    tail = slice(1, None) if requests > 1 else slice(None)
+    avg = lambda values: sum(values[tail]) / len(values[tail])
+    return avg(prompt_eval_ms), avg(prompt_tokens), avg(generation_ms), avg(total_ms)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Prompt eval и генерация с переиспользованием префикса и без')
+    arg_parser.add_argument('--requests', type=int, default=5)
+    arg_parser.add_argument('--max-tokens', type=int, default=128)
+    args = arg_parser.parse_args()
+
+    with open('prompts/analyze_error.j2', encoding='utf-8') as f:
+        template_text = f.read()
+    engine = LLMEngine()
+
+    print(f"{'mode':>8} {'prompt eval, ms':>16} {'prompt tokens':>14} {'generation, ms':>15} {'total, ms':>10}")
+    for mode, enabled in (('cold', False), ('prefix', True)):
+        llm_backends.LLM_PREFIX_CACHE_ENABLED = enabled
+        p_ms, p_tokens, g_ms, t_ms = run(engine, template_text, args.requests, args.max_tokens)
+        print(f'{mode:>8} {p_ms:>16.1f} {p_tokens:>14.0f} {g_ms:>15.1f} {t_ms:>10.1f}')
+
+if __name__ == '__main__':
+    main()
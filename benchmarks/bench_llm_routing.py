@@ -0,0 +1,71 @@
+# выбор модели: все документы на 8B против маршрутизации маленькая модель -> 8B при эскалации
+# нужны обе GGUF-модели (LLM_MODEL_PATH, LLM_SMALL_MODEL_PATH); с --fake - бэкенды-заглушки
+# запуск: python benchmarks/bench_llm_routing.py --documents 40 --max-tokens 256
+import argparse
+import os
+import statistics
+import sys
+import time
+
+# кэш ответов отключен - нужна честная генерация на каждом запросе
+os.environ['LLM_CACHE_ENABLED'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# (статус валидации, текст ошибки) в пропорциях, близких к потоку накладных
+DOCUMENTS = [
+    ('schema_error', "Element 'cbc:IssueDate': This element is not expected."),
+    ('schema_error', "Element 'cbc:DocumentCurrencyCode': [facet 'pattern'] The value 'EURO' is not accepted."),
+    ('schema_error', "Element 'Invoice': Missing child element(s). Expected is ( cbc:IssueDate )."),
+    ('syntax_error', 'Invalid XML: Opening and ending tag mismatch: Invoice line 1 and Inv, line 12, column 7'),
+    ('math_error', 'Сумма строк (100.0) не совпадает с итогом (120.0)'),
+    ('math_error', 'Сумма документа не может быть отрицательной.'),
+]
+
+def run(engine, template_text: str, documents: int, max_tokens: int, model_tier: str):
+    from llm_router import routing_stats
+    routing_stats.reset()
+    latencies = []
+    cpu_started = time.process_time()
+    for i in range(documents):
+        category, error_text = DOCUMENTS[i % len(DOCUMENTS)]
+        started = time.perf_counter()
+        engine.analyze_error(
+            doc_id=str(i),
+            doc_type='Invoice',
+            error_text=error_text,
+            rules='- Сумма документа не может быть отрицательной.',
+            template_text=template_text,
+            generation_config={'temperature': 0.1, 'max_tokens': max_tokens, 'model_tier': model_tier},
+            error_category=category
+        )
+        latencies.append((time.perf_counter() - started) * 1000)
+    cpu_ms = (time.process_time() - cpu_started) * 1000 / documents
+    return statistics.median(latencies), cpu_ms, routing_stats.snapshot()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Доля запросов по моделям и задержка с маршрутизацией и без')
+    arg_parser.add_argument('--documents', type=int, default=40)
+    arg_parser.add_argument('--max-tokens', type=int, default=256)
+    arg_parser.add_argument('--fake', action='store_true', help='бэкенды-заглушки LLM_BACKEND=fake вместо моделей')
+    args = arg_parser.parse_args()
+    if args.fake:
+        os.environ['LLM_BACKEND'] = 'fake'
+
+    from llm_engine import LLMEngine
+    with open('prompts/analyze_error.j2', encoding='utf-8') as f:
+        template_text = f.read()
+    engine = LLMEngine()
+    if engine.small_backend is None:
+        sys.exit('Маленькая модель не загружена: проверь LLM_SMALL_MODEL_PATH и LLM_ROUTING_ENABLED')
+    engine.warm_up()
+
+    print(f"{'mode':>8} {'p50, ms':>9} {'cpu/doc, ms':>12} {'small':>6} {'large':>6} {'escal.':>7} "
+          f"{'small p50':>10} {'large p50':>10}")
+    for mode, model_tier in (('8B only', 'large'), ('routing', 'auto')):
+        p50, cpu_ms, stats = run(engine, template_text, args.documents, args.max_tokens, model_tier)
+        tier_p50 = {tier: f'{value:.0f}' if value is not None else '-' for tier, value in stats['latency_ms_p50'].items()}
+        print(f"{mode:>8} {p50:>9.0f} {cpu_ms:>12.0f} {stats['routed']['small']:>6} {stats['routed']['large']:>6} "
+              f"{stats['escalated']:>7} {tier_p50['small']:>10} {tier_p50['large']:>10}")
+
+if __name__ == '__main__':
+    main()
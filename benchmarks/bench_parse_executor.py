@@ -0,0 +1,74 @@
+# бенчмарк смешанной нагрузки: задержка легких запросов, пока в том же процессе парсятся крупные накладные
+# пул потоков имитирует пул Starlette, в котором выполняются синхронные обработчики FastAPI
+# запуск: python benchmarks/bench_parse_executor.py --heavy-lines 20000 --heavy 8 --light 2000
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parse_executor import ParseExecutor
+from bench_xml_parser import build_invoice
+
+# размер пула потоков Starlette по умолчанию
+API_THREADS = 40
+
+def light_request():
+    """
+    легкий запрос (авторизация, чтение): немного Python-работы под GIL
+    возвращает момент завершения
+    """
+    payload = {'id': 1, 'username': 'client', 'documents': [{'id': i, 'status': 'analyzed'} for i in range(50)]}
+    json.loads(json.dumps(payload))
+    return time.perf_counter()
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def run_mixed(executor: ParseExecutor, heavy_xml: str, heavy_count: int, light_count: int):
+    """
+    Возвращает задержки легких запросов в мс: ожидание свободного потока + выполнение
+    """
+    with ThreadPoolExecutor(max_workers=API_THREADS) as pool:
+        heavy = [pool.submit(executor.run, heavy_xml, None, None, True) for _ in range(heavy_count)]
+        # легкие запросы приходят равномерно, пока идет парсинг
+        submitted = []
+        for _ in range(light_count):
+            submitted.append((time.perf_counter(), pool.submit(light_request)))
+            time.sleep(0.0005)
+        latencies = [(future.result() - submitted_at) * 1000 for submitted_at, future in submitted]
+        for future in heavy:
+            future.result()
+    return latencies
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='p99 задержки легких запросов при парсинге крупных накладных')
+    arg_parser.add_argument('--heavy-lines', type=int, default=20000)
+    arg_parser.add_argument('--heavy', type=int, default=8)
+    arg_parser.add_argument('--light', type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    heavy_xml = build_invoice(args.heavy_lines).decode('utf-8')
+    print(f'Крупный документ: {len(heavy_xml) / 1024 / 1024:.1f} МБ, {args.heavy_lines} строк')
+
+    print(f"{'mode':>8} {'p50, ms':>9} {'p99, ms':>9} {'max, ms':>9} {'total, s':>9}")
+    for mode in ('thread', 'process'):
+        executor = ParseExecutor(mode=mode, queue_size=args.heavy, timeout=600, min_bytes=0)
+        started = time.perf_counter()
+        latencies = run_mixed(executor, heavy_xml, args.heavy, args.light)
+        total = time.perf_counter() - started
+        executor.shutdown()
+        print(
+            f'{mode:>8} {statistics.median(latencies):>9.2f} {percentile(latencies, 99):>9.2f} '
+            f'{max(latencies):>9.2f} {total:>9.2f}'
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# нагрузочный замер конвейера анализа без модели: бэкенд LLM_BACKEND=fake отвечает готовым JSON
+# с заданной задержкой, поэтому видны накладные расходы очереди, поиска правил и записи в БД
+# нужны PostgreSQL и Redis; режим queue - еще и воркер, запущенный с LLM_BACKEND=fake
+# запуск: python benchmarks/bench_pipeline.py --documents 200 --concurrency 8 --latency-ms 200 --tokens-per-second 20
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description='Пропускная способность и задержка конвейера с бэкендом-заглушкой')
+    arg_parser.add_argument('--documents', type=int, default=200)
+    arg_parser.add_argument('--concurrency', type=int, default=8)
+    arg_parser.add_argument('--latency-ms', type=float, default=200)
+    arg_parser.add_argument('--tokens-per-second', type=float, default=20)
+    arg_parser.add_argument('--mode', choices=['inline', 'queue'], default='inline',
+                            help='inline - задачи в этом процессе, queue - через очередь Celery')
+    arg_parser.add_argument('--resolver', action='store_true',
+                            help='не отключать разбор ошибок правилами (валидные документы тогда минуют LLM)')
+    return arg_parser.parse_args()
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def main():
+    args = parse_args()
+    # настройки заглушки читаются при импорте модулей проекта
+    os.environ['LLM_BACKEND'] = 'fake'
+    os.environ['LLM_FAKE_LATENCY_MS'] = str(args.latency_ms)
+    os.environ['LLM_FAKE_TOKENS_PER_SECOND'] = str(args.tokens_per_second)
+    os.environ['LLM_CACHE_ENABLED'] = '0'
+    os.environ['LLM_WARMUP_ENABLED'] = '0'
+    # все ответы - от одной заглушки с заданной задержкой, без маленькой модели
+    os.environ['LLM_ROUTING_ENABLED'] = '0'
+    if not args.resolver:
+        os.environ['RESOLVER_ENABLED'] = '0'
+
+    from database import SessionLocal, User, EdiDocument, AnalysisResult, init_db
+    from llm_backends import FakeBackend
+    from tasks import analyze_document_task
+    from bench_xml_parser import build_invoice
+
+    init_db()
+    db = SessionLocal()
+    user = db.query(User).filter(User.username == 'bench_pipeline').first()
+    if user is None:
+        user = User(username='bench_pipeline', email='bench_pipeline@example.com', api_key='bench-pipeline')
+        db.add(user)
+        db.commit()
+    xml = build_invoice(10).decode('utf-8')
+    documents = [
+        EdiDocument(filename=f'bench_{i}.xml', doc_type='Invoice', content_xml=xml, owner_id=user.id,
+                    validation_status='valid', parsed_metadata={})
+        for i in range(args.documents)
+    ]
+    db.add_all(documents)
+    db.commit()
+    doc_ids = [doc.id for doc in documents]
+
+    def run_one(doc_id):
+        started = time.perf_counter()
+        if args.mode == 'queue':
+            analyze_document_task.delay(doc_id).get(timeout=600)
+        else:
+            analyze_document_task(doc_id)
+        return (time.perf_counter() - started) * 1000
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            latencies = list(pool.map(run_one, doc_ids))
+        elapsed = time.perf_counter() - started
+    finally:
+        db.query(AnalysisResult).filter(AnalysisResult.document_id.in_(doc_ids)).delete(synchronize_session=False)
+        db.query(EdiDocument).filter(EdiDocument.id.in_(doc_ids)).delete(synchronize_session=False)
+        db.commit()
+        db.close()
+
+    model_ms = FakeBackend()._duration({'max_tokens': 512}) * 1000
+    p50 = statistics.median(latencies)
+    print(f'Режим: {args.mode}, документов: {args.documents}, параллельно: {args.concurrency}')
+    print(f'Документов в минуту: {args.documents / elapsed * 60:.0f}')
+    print(f'Задержка задачи p50: {p50:.0f} мс, p95: {percentile(latencies, 95):.0f} мс')
+    print(f'Время "модели" на ответ: {model_ms:.0f} мс, накладные расходы p50: {p50 - model_ms:.0f} мс')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# микро-бенчмарк парсинга накладной: строковые //-запросы (как было) против скомпилированных XPath
+# запуск: python benchmarks/bench_xml_parser.py --lines 10000 --repeat 5
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+from xml_parser import EdiXmlParser, UBL_NS
+
+def build_invoice(lines_count: int) -> bytes:
+    lines = ''.join(
+        f'<cac:InvoiceLine><cbc:ID>{i}</cbc:ID>'
+        f'<cbc:InvoicedQuantity>2</cbc:InvoicedQuantity>'
+        f'<cbc:LineExtensionAmount>10.00</cbc:LineExtensionAmount>'
+        f'<cac:Item><cbc:Name>Товар {i}</cbc:Name></cac:Item></cac:InvoiceLine>'
+        for i in range(1, lines_count + 1)
+    )
+    return (
+        f'<Invoice xmlns="{UBL_NS["ubl"]}" xmlns:cac="{UBL_NS["cac"]}" xmlns:cbc="{UBL_NS["cbc"]}">'
+        f'<cbc:ID>INV-BENCH</cbc:ID><cbc:IssueDate>2025-12-07</cbc:IssueDate>'
+        f'<cbc:DocumentCurrencyCode>EUR</cbc:DocumentCurrencyCode>'
+        f'<cac:AccountingSupplierParty><cac:Party><cac:PartyName><cbc:Name>Supplier</cbc:Name>'
+        f'</cac:PartyName></cac:Party></cac:AccountingSupplierParty>'
+        f'<cac:AccountingCustomerParty><cac:Party><cac:PartyName><cbc:Name>Customer</cbc:Name>'
+        f'</cac:PartyName></cac:Party></cac:AccountingCustomerParty>'
+        f'{lines}'
+        f'<cac:LegalMonetaryTotal><cbc:TaxExclusiveAmount>{lines_count * 10}.00</cbc:TaxExclusiveAmount>'
+        f'<cbc:PayableAmount>{lines_count * 10}.00</cbc:PayableAmount></cac:LegalMonetaryTotal>'
+        f'</Invoice>'
+    ).encode('utf-8')
+
+def legacy_extract(root):
+    """
+    прежняя реализация: строковые запросы компилируются на каждом вызове и сканируют все дерево
+    """
+    def get_text(xpath_query, element=root):
+        res = element.xpath(xpath_query, namespaces=UBL_NS)
+        return res[0].text if res else None
+
+    data = {
+        'invoice_id': get_text('//cbc:ID'),
+        'issue_date': get_text('//cbc:IssueDate'),
+        'currency': get_text('//cbc:DocumentCurrencyCode'),
+        'supplier_name': get_text('//cac:AccountingSupplierParty/cac:Party/cac:PartyName/cbc:Name'),
+        'customer_name': get_text('//cac:AccountingCustomerParty/cac:Party/cac:PartyName/cbc:Name'),
+        'total_payable': float(get_text('//cac:LegalMonetaryTotal/cbc:PayableAmount') or 0),
+        'total_tax_excl': float(get_text('//cac:LegalMonetaryTotal/cbc:TaxExclusiveAmount') or 0),
+        'lines': []
+    }
+    for line in root.xpath('//cac:InvoiceLine', namespaces=UBL_NS):
+        data['lines'].append({
+            'line_id': get_text('cbc:ID', line),
+            'quantity': float(get_text('cbc:InvoicedQuantity', line) or 0),
+            'line_amount': float(get_text('cbc:LineExtensionAmount', line) or 0),
+            'item_name': get_text('cac:Item/cbc:Name', line)
+        })
+    return data
+
+def best_of(func, root, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(root)
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Бенчмарк извлечения полей накладной')
+    arg_parser.add_argument('--lines', type=int, nargs='+', default=[100, 1000, 10000])
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    # логи парсера не должны влиять на замеры
+    logging.getLogger().setLevel(logging.ERROR)
+    parser = EdiXmlParser()
+
+    print(f"{'lines':>8} {'legacy, ms':>12} {'compiled, ms':>13} {'speedup':>8}")
+    for lines_count in args.lines:
+        root = etree.fromstring(build_invoice(lines_count))
+        legacy_ms = best_of(legacy_extract, root, args.repeat)
+        compiled_ms = best_of(parser._extract_invoice, root, args.repeat)
+        print(f'{lines_count:>8} {legacy_ms:>12.2f} {compiled_ms:>13.2f} {legacy_ms / compiled_ms:>7.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# сравнение хранения XML: без сжатия, gzip и zstd (если установлен zstandard)
+# запуск: python benchmarks/bench_xml_storage.py --lines 10 1000 10000
+# с флагом --db дополнительно сравнивается чтение метаданных документов с XML и без него (нужен PostgreSQL)
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xml_storage import compress_xml, decompress_xml, zstandard
+from bench_xml_parser import build_invoice
+
+def best_of(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Объем и скорость сжатого хранения XML')
+    arg_parser.add_argument('--lines', type=int, nargs='+', default=[10, 1000, 10000])
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--db', action='store_true', help='замерить чтение документов из БД')
+    args = arg_parser.parse_args()
+
+    codecs = ['gzip'] + (['zstd'] if zstandard else [])
+    print(f"{'lines':>7} {'codec':>6} {'raw, KB':>9} {'stored, KB':>11} {'ratio':>6} {'compress, ms':>13} {'decompress, ms':>15}")
+    for lines_count in args.lines:
+        xml = build_invoice(lines_count).decode('utf-8')
+        raw_kb = len(xml.encode('utf-8')) / 1024
+        for codec in codecs:
+            data, _ = compress_xml(xml, codec)
+            compress_ms = best_of(lambda: compress_xml(xml, codec), args.repeat)
+            decompress_ms = best_of(lambda: decompress_xml(data, codec), args.repeat)
+            stored_kb = len(data) / 1024
+            print(f'{lines_count:>7} {codec:>6} {raw_kb:>9.1f} {stored_kb:>11.1f} {raw_kb / stored_kb:>6.1f} '
+                  f'{compress_ms:>13.2f} {decompress_ms:>15.2f}')
+
+    if args.db:
+        bench_db_reads(args.repeat)
+
+def bench_db_reads(repeat: int):
+    """
+    чтение списка документов: отложенный XML (как в API) против загрузки всех колонок
+    """
+    from sqlalchemy.orm import undefer
+    from database import SessionLocal, EdiDocument
+
+    db = SessionLocal()
+    try:
+        def fetch(*options):
+            db.query(EdiDocument).options(*options).all()
+            # следующий замер не должен брать объекты из identity map сессии
+            db.expunge_all()
+
+        count = db.query(EdiDocument).count()
+        metadata_ms = best_of(fetch, repeat)
+        full_ms = best_of(
+            lambda: fetch(undefer(EdiDocument.content_xml_raw), undefer(EdiDocument.content_xml_compressed)),
+            repeat
+        )
+        print(f'\nДокументов в БД: {count}')
+        print(f'Только метаданные: {metadata_ms:.2f} мс, вместе с XML: {full_ms:.2f} мс')
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,12 @@ import os
 # здесь запускаю воркера вручную, поэтому localhost
 REDIS_URL = 'redis://localhost:6379/0'
 
+# сколько родитель пула prefork ждет, пока дочерний процесс выполнит worker_process_init
+# (по умолчанию в Celery 4 с, после чего процесс убивается и запускается заново);
+# в этом хуке модель загружается и прогревается или ожидается сервер инференса (до LLM_SERVER_WAIT_SECONDS),
+# поэтому запас - на загрузку самой большой модели и ожидание сервера
+CELERY_WORKER_PROC_ALIVE_TIMEOUT = float(os.getenv('CELERY_WORKER_PROC_ALIVE_TIMEOUT', '900'))
+
 # инстанс менеджера задач
 celery_app = Celery(
     'edi_tasks',
@@ -19,5 +25,6 @@ celery_app.conf.update(
     accept_content=['json'],
     result_serializer='json',
     timezone='Europe/Moscow',
-    enable_utc=True
-)
\ No newline at end of file
+    enable_utc=True,
+    worker_proc_alive_timeout=CELERY_WORKER_PROC_ALIVE_TIMEOUT
+)
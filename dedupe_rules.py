@@ -0,0 +1,20 @@
+# разовое удаление правил базы знаний с одинаковым rule_hash (остается правило с меньшим id)
+# нужно, только если уникальный индекс uq_knowledge_base_rule_hash не создается из-за дублей
+# запуск: python dedupe_rules.py [--dry-run]
+import sys
+from sqlalchemy import text
+from database import engine
+
+DUPLICATES = "FROM knowledge_base a USING knowledge_base b WHERE a.rule_hash = b.rule_hash AND a.id > b.id"
+
+def dedupe(dry_run: bool = False):
+    with engine.connect() as connection:
+        ids = connection.execute(text(f"SELECT a.id {DUPLICATES} ORDER BY a.id")).scalars().all()
+        print(f'Повторяющихся правил: {len(ids)}' + (f' (id: {", ".join(map(str, ids))})' if ids else ''))
+        if ids and not dry_run:
+            connection.execute(text(f"DELETE {DUPLICATES}"))
+            connection.commit()
+            print('Дубли удалены, уникальный индекс создастся при следующем запуске init_db.')
+
+if __name__ == '__main__':
+    dedupe(dry_run='--dry-run' in sys.argv[1:])
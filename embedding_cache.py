@@ -0,0 +1,152 @@
+# кэш векторов текста: одинаковый (после нормализации) текст + та же модель = тот же вектор
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+import redis
+import metrics
+from logger_config import logger
+
+# размер LRU в памяти процесса (векторы all-MiniLM-L6-v2 - 384 float32, 1.5 КБ на запись)
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '4096'))
+# постоянный уровень кэша, переживающий перезапуск: redis (общий для всех процессов), disk или none
+EMBEDDING_CACHE_PERSIST = os.getenv('EMBEDDING_CACHE_PERSIST', 'redis')
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', 'cache/embeddings')
+EMBEDDING_CACHE_TTL_SECONDS = int(os.getenv('EMBEDDING_CACHE_TTL_SECONDS', str(30 * 24 * 3600)))
+
+REDIS_PREFIX = 'edi:embedding:'
+# запрос поиска правил для документа без ошибки
+DEFAULT_RETRIEVAL_QUERY = 'Проблемы с суммой, валютой или датами'
+
+def normalize_text(text: str) -> str:
+    # юникод в одной форме, пробелы и переводы строк схлопнуты
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+def retrieval_query(error_text: str = None) -> str:
+    """
+    Текст запроса для поиска правил по ошибке документа. Значения конкретного документа
+    (номера строк, суммы, недопустимые значения) убираются: одна и та же ошибка в разных
+    документах дает одинаковый запрос, и его вектор берется из кэша.
+    """
+    if not error_text:
+        return DEFAULT_RETRIEVAL_QUERY
+    query = re.sub(r',? line \d+(?:, column \d+)?', '', error_text)
+    query = re.sub(r"([Vv]alue) '[^']*'", r"\1 '...'", query)
+    query = re.sub(r'-?\d+(?:[.,]\d+)?', 'N', query)
+    return normalize_text(query)
+
+class EmbeddingCache:
+    """
+    Двухуровневый кэш векторов:
+    - LRU в памяти процесса,
+    - постоянный уровень в Redis (с TTL) или в файлах на диске.
+    Ключ - SHA-256 от имени модели и нормализованного текста.
+    """
+    def __init__(
+        self,
+        model_name: str,
+        size: int = EMBEDDING_CACHE_SIZE,
+        persist: str = EMBEDDING_CACHE_PERSIST,
+        cache_dir: str = EMBEDDING_CACHE_DIR,
+        ttl: int = EMBEDDING_CACHE_TTL_SECONDS
+    ):
+        self.model_name = model_name
+        self.size = size
+        self.persist = persist
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def make_key(self, text: str) -> str:
+        return hashlib.sha256(f'{self.model_name}\n{normalize_text(text)}'.encode('utf-8')).hexdigest()
+
+    def get(self, text: str):
+        """
+        Вектор (numpy float32) или None. Попадание в постоянный уровень копируется в память процесса.
+        """
+        key = self.make_key(text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                metrics.incr('embedding_cache_hits_memory')
+                return vector
+
+        vector = self._get_persistent(key)
+        if vector is not None:
+            self._set_memory(key, vector)
+            metrics.incr('embedding_cache_hits_persistent')
+            return vector
+        metrics.incr('embedding_cache_misses')
+        return None
+
+    def set(self, text: str, vector):
+        key = self.make_key(text)
+        vector = np.asarray(vector, dtype=np.float32)
+        self._set_memory(key, vector)
+        self._set_persistent(key, vector)
+
+    def _set_memory(self, key: str, vector):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.size:
+                self._memory.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        # подкаталоги по первым символам ключа - чтобы не держать все файлы в одной папке
+        return os.path.join(self.cache_dir, key[:2], f'{key}.f32')
+
+    def _get_persistent(self, key: str):
+        if self.persist == 'redis':
+            try:
+                data = metrics.get_redis().get(REDIS_PREFIX + key)
+            except redis.RedisError as e:
+                logger.debug(f'Кэш векторов в Redis недоступен: {e}')
+                return None
+        elif self.persist == 'disk':
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None
+        else:
+            return None
+        return np.frombuffer(data, dtype=np.float32) if data else None
+
+    def _set_persistent(self, key: str, vector):
+        data = vector.tobytes()
+        if self.persist == 'redis':
+            try:
+                metrics.get_redis().set(REDIS_PREFIX + key, data, ex=self.ttl)
+            except redis.RedisError as e:
+                logger.debug(f'Не удалось записать вектор в Redis: {e}')
+        elif self.persist == 'disk':
+            path = self._path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # запись во временный файл и переименование: другой процесс не прочитает файл наполовину
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f'Не удалось записать вектор в {path}: {e}')
+
+def embedding_cache_stats(counters: dict):
+    """
+    Сводка по кэшу векторов из общих счетчиков metrics
+    """
+    memory = counters.get('embedding_cache_hits_memory', 0)
+    persistent = counters.get('embedding_cache_hits_persistent', 0)
+    misses = counters.get('embedding_cache_misses', 0)
+    return {
+        'hits_memory': memory,
+        'hits_persistent': persistent,
+        'misses': misses,
+        'hit_ratio': metrics.ratio(memory + persistent, memory + persistent + misses)
+    }
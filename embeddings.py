@@ -1,20 +1,122 @@
-from sentence_transformers import SentenceTransformer
+import os
+import threading
+import time
+import numpy as np
+from embedding_cache import EmbeddingCache, normalize_text
+from logger_config import logger
+
+# модель векторизации (правила в БД посчитаны ею - смена модели требует пересчета векторов)
+EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'all-MiniLM-L6-v2')
+# бэкенд инференса на CPU:
+# torch - исходная модель float32,
+# onnx - ONNX Runtime (нужен sentence-transformers[onnx]), файл модели - EMBEDDING_ONNX_FILE,
+# torch_int8 - динамическое квантование линейных слоев torch в int8, без дополнительных зависимостей
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+# квантованный int8 вариант из репозитория модели; onnx/model.onnx - тот же float32, что у torch
+EMBEDDING_ONNX_FILE = os.getenv('EMBEDDING_ONNX_FILE', 'onnx/model_qint8_avx2.onnx')
+EMBEDDING_BACKENDS = ('torch', 'onnx', 'torch_int8')
+# векторы правил в БД посчитаны torch float32, а запрос - выбранным бэкендом. Квантованный бэкенд
+# допустим, только если его векторы близки к torch не хуже этих порогов (проверка -
+# benchmarks/bench_embeddings.py и tests/test_embeddings.py); иначе правила нужно перевекторизовать
+# тем же бэкендом или смириться со смешанными векторами и худшим поиском
+EMBEDDING_MIN_COSINE = float(os.getenv('EMBEDDING_MIN_COSINE', '0.98'))
+EMBEDDING_MIN_TOP_K_AGREEMENT = float(os.getenv('EMBEDDING_MIN_TOP_K_AGREEMENT', '0.8'))
+
+def load_model(model_name: str = EMBEDDING_MODEL_NAME, backend: str = EMBEDDING_BACKEND):
+    """
+    SentenceTransformer для выбранного бэкенда. torch и sentence_transformers импортируются
+    здесь, а не при импорте модуля: API и тесты не платят за них, пока вектор не нужен.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    if backend == 'torch':
+        return SentenceTransformer(model_name, device='cpu')
+    if backend == 'onnx':
+        return SentenceTransformer(model_name, device='cpu', backend='onnx',
+                                   model_kwargs={'file_name': EMBEDDING_ONNX_FILE})
+    if backend == 'torch_int8':
+        import torch
+
+        model = SentenceTransformer(model_name, device='cpu')
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    raise ValueError(f'Неизвестный бэкенд векторизации: {backend}')
+
+def _normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def vector_agreement(reference_rules, rules, reference_queries, queries, k: int = 5):
+    """
+    Насколько векторы бэкенда совпадают с эталонными (torch float32):
+    (минимальный косинус вектора правила с эталонным, средняя доля общих правил в top-k поиска
+    по запросам). Поиск - запросы бэкенда против эталонных векторов правил, как в БД.
+    """
+    cosine = float(np.sum(_normalized(rules) * _normalized(reference_rules), axis=1).min())
+    reference_rules = _normalized(reference_rules)
+    found = np.argsort(-(_normalized(queries) @ reference_rules.T), axis=1)[:, :k]
+    expected = np.argsort(-(_normalized(reference_queries) @ reference_rules.T), axis=1)[:, :k]
+    agreement = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(found, expected)]))
+    return cosine, agreement
 
 class EmbeddingService:
     _instance = None
-    
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(EmbeddingService, cls).__new__(cls)
-            print('Загружаю модель векторизации...')
-            cls._instance.model = SentenceTransformer('all-MiniLM-L6-v2')
+            # модель загружается при первом запросе вектора (или явно - load() при прогреве воркера)
+            cls._instance._model = None
+            cls._instance._lock = threading.Lock()
+            cls._instance.load_seconds = None
+            # повторяющиеся тексты (запросы по одинаковым ошибкам) не векторизуются заново;
+            # векторы квантованного бэкенда немного отличаются - у него свои записи в кэше
+            cache_model = EMBEDDING_MODEL_NAME if EMBEDDING_BACKEND == 'torch' \
+                else f'{EMBEDDING_MODEL_NAME}:{EMBEDDING_BACKEND}'
+            cls._instance.cache = EmbeddingCache(cache_model)
         return cls._instance
-    
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def model(self):
+        if self._model is None:
+            self.load()
+        return self._model
+
+    def load(self):
+        """
+        Загрузка модели (повторный вызов ничего не делает). Потоки API, одновременно
+        запросившие первый вектор, ждут одну загрузку, а не грузят модель каждый свою.
+        """
+        with self._lock:
+            if self._model is None:
+                started = time.perf_counter()
+                self._model = load_model()
+                self.load_seconds = time.perf_counter() - started
+                logger.info(f'Модель векторизации {EMBEDDING_MODEL_NAME} ({EMBEDDING_BACKEND}) '
+                            f'загружена за {self.load_seconds:.1f} с')
+        return self._model
+
     def get_embedding(self, text: str):
         """
         Возвращает список float (вектор)
         """
-        return self.model.encode(text).tolist()
+        text = normalize_text(text)
+        vector = self.cache.get(text)
+        if vector is None:
+            vector = np.asarray(self.model.encode(text), dtype=np.float32)
+            self.cache.set(text, vector)
+        return vector.tolist()
+
+    def get_embeddings(self, texts: list) -> list:
+        """
+        Векторы пачки текстов за один вызов encode (для массовой загрузки правил, без кэша:
+        тексты правил не повторяются и только вытеснили бы из кэша запросы по ошибкам)
+        """
+        vectors = self.model.encode([normalize_text(text) for text in texts], batch_size=max(1, len(texts)))
+        return [vector.tolist() for vector in vectors]
 
-# глобальный инстанс сервиса векторизации
-embedder = EmbeddingService()
\ No newline at end of file
+# глобальный инстанс сервиса векторизации (модель еще не загружена)
+embedder = EmbeddingService()
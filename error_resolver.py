@@ -0,0 +1,140 @@
+# детерминированный разбор известных ошибок документа без языковой модели
+# правило: статус валидации + регулярное выражение по тексту ошибки -> готовый ответ reason/solution/criticality
+import json
+import os
+import re
+import metrics
+from logger_config import logger
+
+# включение быстрого пути и файл с правилами (JSON-список в формате DEFAULT_RULES) вместо встроенных
+RESOLVER_ENABLED = os.getenv('RESOLVER_ENABLED', '1') == '1'
+RESOLVER_RULES_FILE = os.getenv('RESOLVER_RULES_FILE')
+
+# в текстах ответа доступны {error} - текст ошибки и именованные группы из pattern
+DEFAULT_RULES = [
+    {
+        'name': 'line_sum_mismatch',
+        'statuses': ['math_error'],
+        'pattern': r'Сумма строк \((?P<calculated>[^)]*)\) не совпадает с итогом \((?P<declared>[^)]*)\)',
+        'response': {
+            'reason': 'Сумма строк накладной ({calculated}) не совпадает с итоговой суммой документа ({declared}).',
+            'solution': '1. Проверьте количество, цену и сумму в каждой строке накладной. '
+                        '2. Пересчитайте итог без налога (TaxExclusiveAmount) как сумму строк. '
+                        '3. Исправьте расхождение в учетной системе и загрузите документ повторно.',
+            'criticality': 'high'
+        }
+    },
+    {
+        'name': 'xsd_element_missing',
+        'statuses': ['schema_error'],
+        'pattern': r"Element '(?P<element>[^']+)': Missing child element\(s\)\. Expected is \( ?(?P<expected>[^)]+?) ?\)",
+        'response': {
+            'reason': 'В элементе {element} нет обязательного элемента {expected}.',
+            'solution': '1. Добавьте элемент {expected} внутрь {element} в порядке, заданном XSD-схемой. '
+                        '2. Проверьте выгрузку документа из учетной системы. '
+                        '3. Загрузите исправленный документ повторно.',
+            'criticality': 'high'
+        }
+    },
+    {
+        'name': 'xsd_element_unexpected',
+        'statuses': ['schema_error'],
+        'pattern': r"Element '(?P<element>[^']+)': This element is not expected\.",
+        'response': {
+            'reason': 'Элемент {element} не ожидается в этом месте документа: он лишний или нарушен порядок элементов.',
+            'solution': '1. Сверьте порядок и состав элементов с XSD-схемой. '
+                        '2. Удалите лишний элемент или переместите его на правильную позицию. '
+                        '3. Загрузите исправленный документ повторно.',
+            'criticality': 'medium'
+        }
+    },
+    {
+        'name': 'xsd_value_invalid',
+        'statuses': ['schema_error'],
+        'pattern': r"Element '(?P<element>[^']+)': .*(?:is not a valid value|is not accepted|is not an element of the set)",
+        'response': {
+            'reason': 'Значение элемента {element} не соответствует типу или формату из XSD-схемы.',
+            'solution': '1. Исправьте значение {element} по формату схемы (даты - ГГГГ-ММ-ДД, суммы - число через точку, '
+                        'коды валют - три заглавные буквы). 2. Загрузите исправленный документ повторно.',
+            'criticality': 'medium'
+        }
+    },
+    {
+        'name': 'xml_syntax_error',
+        'statuses': ['syntax_error'],
+        'pattern': r'.',
+        'response': {
+            'reason': 'Файл не является корректным XML или содержит нечисловые суммы: {error}',
+            'solution': '1. Откройте файл в XML-редакторе и исправьте указанную ошибку (незакрытые теги, кодировка, '
+                        'недопустимые символы, нечисловые значения сумм). 2. Загрузите исправленный документ повторно.',
+            'criticality': 'high'
+        }
+    },
+    {
+        'name': 'valid_document',
+        'statuses': ['valid'],
+        'pattern': None,
+        'response': {
+            'reason': 'Ошибок не обнаружено: документ прошел проверку схемы и арифметики.',
+            'solution': 'Действий не требуется.',
+            'criticality': 'low'
+        }
+    }
+]
+
+class _FormatValues(dict):
+    # неизвестный плейсхолдер в тексте правила остается как есть
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+class ErrorResolver:
+    """
+    Правила проверяются по порядку, первое совпавшее дает ответ.
+    Правило без pattern срабатывает на любой документ с подходящим статусом.
+    """
+    def __init__(self, rules: list):
+        self.rules = [
+            (rule['name'], set(rule['statuses']), re.compile(rule['pattern']) if rule.get('pattern') else None,
+             rule['response'])
+            for rule in rules
+        ]
+
+    def resolve(self, validation_status: str, error_text: str = None):
+        """
+        (имя правила, JSON-ответ строкой) или None - документ нужно отдать модели
+        """
+        for name, statuses, pattern, response in self.rules:
+            if validation_status not in statuses:
+                continue
+            values = _FormatValues(error=error_text or '')
+            if pattern is not None:
+                match = pattern.search(error_text or '')
+                if match is None:
+                    continue
+                values.update({key: value for key, value in match.groupdict().items() if value is not None})
+            answer = {field: text.format_map(values) for field, text in response.items()}
+            return name, json.dumps(answer, ensure_ascii=False)
+        return None
+
+def load_rules(path: str = RESOLVER_RULES_FILE) -> list:
+    if not path:
+        return DEFAULT_RULES
+    with open(path, encoding='utf-8') as f:
+        rules = json.load(f)
+    logger.info(f'Правила быстрого разбора ошибок загружены из {path}: {len(rules)}')
+    return rules
+
+def resolver_stats(counters: dict):
+    """
+    Доля документов, разобранных правилами без инференса, из общих счетчиков metrics
+    """
+    by_rule = counters.get('analysis_resolved_by_rule', 0)
+    by_llm = counters.get('analysis_llm', 0)
+    return {
+        'resolved_by_rule': by_rule,
+        'sent_to_llm': by_llm,
+        'share_without_inference': metrics.ratio(by_rule, by_rule + by_llm)
+    }
+
+# общий инстанс для воркера
+resolver = ErrorResolver(load_rules())
@@ -43,6 +43,24 @@ class ApiClient:
         )
         return resp
     
+    def upload_documents_batch(self, user_id, files, doc_type='Invoice'):
+        # пакетная загрузка: все файлы уходят одним запросом
+        payload = {
+            'documents': [
+                {
+                    'filename': file.name,
+                    'doc_type': doc_type,
+                    'content_xml': file.getvalue().decode('utf-8')
+                }
+                for file in files
+            ]
+        }
+        resp = self.session.post(
+            f'{API_URL}/users/{user_id}/documents/batch',
+            json=payload
+        )
+        return resp
+    
     # Администраторская часть
     ## создание промпта
     def create_prompt(self, name, text, config):
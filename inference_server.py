@@ -0,0 +1,75 @@
+# локальный сервер инференса: единственный процесс с моделью в памяти на хосте
+# воркеры Celery (LLM_INFERENCE_MODE=server) обращаются к нему через llm_client
+# запуск: python inference_server.py (адрес берется из LLM_SERVER_URL)
+import threading
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+import uvicorn
+from fastapi import FastAPI, HTTPException
+import metrics
+import schemas
+from llm_batcher import InferenceBatcher, LLM_BATCHING_ENABLED, LLM_MAX_BATCH_SIZE
+from llm_client import LLM_SERVER_URL
+from llm_engine import LLMEngine
+from logger_config import logger
+
+# запросы от всех воркеров попадают в общий батчер; без батчинга он просто
+# выполняет их по одному, модель вызывается только из его потока
+batcher = InferenceBatcher(LLMEngine, max_batch_size=LLM_MAX_BATCH_SIZE if LLM_BATCHING_ENABLED else 1)
+ready = threading.Event()
+# ошибка загрузки модели: /health сообщает ее воркерам вместо бесконечного 503
+load_error = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # модель загружается в фоне: /health отвечает 503, пока она не прогрета
+    threading.Thread(target=warm_up, name='llm-warm-up', daemon=True).start()
+    yield
+    metrics.mark_stopped(f'inference-server:{metrics.process_name()}')
+
+def warm_up():
+    global load_error
+    try:
+        engine = LLMEngine()
+        warmup_seconds = engine.warm_up()
+    except Exception as e:
+        load_error = f'{type(e).__name__}: {e}'
+        logger.exception(f'Сервер инференса: модель не загружена: {load_error}')
+        return
+    logger.info(
+        f'Сервер инференса: модель {engine.model_id} загружена за {engine.load_seconds:.1f} с, '
+        f'прогрета за {warmup_seconds:.1f} с'
+    )
+    ready.set()
+    metrics.mark_ready(f'inference-server:{metrics.process_name()}', {
+        'model': engine.model_id,
+        'load_seconds': round(engine.load_seconds, 2),
+        'warmup_seconds': round(warmup_seconds, 2)
+    })
+
+app = FastAPI(title='EDI LLM Inference Server', lifespan=lifespan)
+
+def check_ready():
+    # 500 - модель не загрузилась и уже не загрузится, 503 - загрузка еще идет
+    if load_error is not None:
+        raise HTTPException(status_code=500, detail=f'Модель не загружена: {load_error}')
+    if not ready.is_set():
+        raise HTTPException(status_code=503, detail='Модель загружается')
+
+@app.get('/health')
+def health():
+    check_ready()
+    return {'ready': True, 'model': LLMEngine().model_id}
+
+@app.post('/analyze', response_model=schemas.AnalysisResponse)
+def analyze(request: schemas.AnalysisRequest):
+    # обычный def: FastAPI выполняет запрос в пуле потоков, поток ждет ответ батчера
+    check_ready()
+    return {'analysis': batcher.analyze(**request.model_dump())}
+
+if __name__ == '__main__':
+    url = urlparse(LLM_SERVER_URL)
+    if url.scheme == 'unix':
+        uvicorn.run(app, uds=url.path)
+    else:
+        uvicorn.run(app, host=url.hostname, port=url.port or 80)
@@ -0,0 +1,156 @@
+# массовая загрузка правил базы знаний из JSON или CSV
+# тексты векторизуются пачками (один вызов encode на пачку), новые правила пишутся одной вставкой;
+# правило с уже загруженным текстом (по хэшу) не векторизуется и не вставляется повторно
+# запуск: python knowledge_import.py rules.csv [--format csv|json] [--batch-size 64] [--status approved]
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import time
+from sqlalchemy.dialects.postgresql import insert
+from database import SessionLocal, KnowledgeBaseItem, init_db
+from embedding_cache import normalize_text
+from embeddings import embedder
+from knowledge_search import bump_knowledge_version
+from logger_config import logger
+
+# сколько текстов векторизуется за один вызов encode
+KNOWLEDGE_IMPORT_BATCH_SIZE = int(os.getenv('KNOWLEDGE_IMPORT_BATCH_SIZE', '64'))
+# ограничение IN (...) при поиске уже загруженных хэшей
+HASH_LOOKUP_CHUNK = 1000
+RULE_STATUSES = ('draft', 'review', 'approved')
+
+def rule_hash(rule_text: str) -> str:
+    # хэш нормализованного текста: правило, отличающееся только пробелами, считается тем же
+    return hashlib.sha256(normalize_text(rule_text).encode('utf-8')).hexdigest()
+
+def parse_rules(content, fmt: str) -> list:
+    """
+    Правила из файла: JSON - список объектов (или {"rules": [...]}), CSV - с заголовком.
+    Обязательные поля - topic и rule_text, необязательное - status.
+    """
+    if isinstance(content, bytes):
+        # utf-8-sig - CSV из Excel начинается с BOM
+        content = content.decode('utf-8-sig')
+    if fmt == 'json':
+        data = json.loads(content)
+        items = data.get('rules') if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            raise ValueError('JSON должен быть списком правил или объектом с ключом "rules"')
+    elif fmt == 'csv':
+        items = list(csv.DictReader(io.StringIO(content)))
+    else:
+        raise ValueError(f'Неизвестный формат файла правил: {fmt}')
+
+    rules = []
+    for number, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            raise ValueError(f'Правило {number}: ожидается объект с полями topic и rule_text')
+        topic = (item.get('topic') or '').strip()
+        rule_text = (item.get('rule_text') or '').strip()
+        status = (item.get('status') or '').strip() or None
+        if not topic or not rule_text:
+            raise ValueError(f'Правило {number}: пустое поле topic или rule_text')
+        if status is not None and status not in RULE_STATUSES:
+            raise ValueError(f'Правило {number}: неизвестный статус {status}')
+        rules.append({'topic': topic, 'rule_text': rule_text, 'status': status})
+    return rules
+
+def import_rules(db, rules: list, batch_size: int = KNOWLEDGE_IMPORT_BATCH_SIZE, status: str = 'approved') -> dict:
+    """
+    Загрузка разобранных правил. status - статус правил, у которых он не задан в файле.
+    Возвращает сводку: всего, загружено, пропущено (уже в базе), повторы внутри файла, время.
+    """
+    started = time.perf_counter()
+    # правила, добавленные до появления хэша, получают его без повторной векторизации;
+    # повтор уже хэшированного текста остается без хэша - уникальный индекс не дает его записать
+    legacy = db.query(KnowledgeBaseItem).filter(KnowledgeBaseItem.rule_hash.is_(None)).all()
+    if legacy:
+        legacy_hashes = {item.id: rule_hash(item.rule_text) for item in legacy}
+        taken = set(
+            value for (value,) in db.query(KnowledgeBaseItem.rule_hash)
+            .filter(KnowledgeBaseItem.rule_hash.in_(set(legacy_hashes.values())))
+        )
+        for item in legacy:
+            if legacy_hashes[item.id] not in taken:
+                item.rule_hash = legacy_hashes[item.id]
+                taken.add(item.rule_hash)
+
+    new_rules = {}
+    for rule in rules:
+        new_rules.setdefault(rule_hash(rule['rule_text']), rule)
+    duplicates = len(rules) - len(new_rules)
+
+    hashes = list(new_rules)
+    existing = set()
+    for offset in range(0, len(hashes), HASH_LOOKUP_CHUNK):
+        chunk = hashes[offset:offset + HASH_LOOKUP_CHUNK]
+        existing.update(
+            value for (value,) in db.query(KnowledgeBaseItem.rule_hash).filter(KnowledgeBaseItem.rule_hash.in_(chunk))
+        )
+    pending = [(key, rule) for key, rule in new_rules.items() if key not in existing]
+
+    rows = []
+    for offset in range(0, len(pending), batch_size):
+        batch = pending[offset:offset + batch_size]
+        vectors = embedder.get_embeddings([rule['rule_text'] for _, rule in batch])
+        rows.extend(
+            {
+                'topic': rule['topic'],
+                'rule_text': rule['rule_text'],
+                'status': rule['status'] or status,
+                'rule_hash': key,
+                'embedding': vector
+            }
+            for (key, rule), vector in zip(batch, vectors)
+        )
+    imported = 0
+    if rows:
+        # правило, вставленное параллельным импортом или POST /knowledge/ после проверки хэшей,
+        # пропускается уникальным индексом; RETURNING дает число действительно вставленных
+        imported = len(db.scalars(
+            insert(KnowledgeBaseItem).on_conflict_do_nothing(index_elements=['rule_hash'])
+            .returning(KnowledgeBaseItem.id),
+            rows
+        ).all())
+    db.commit()
+    if imported:
+        # воркеры догрузят новые правила в индекс в памяти
+        bump_knowledge_version()
+
+    summary = {
+        'total': len(rules),
+        'imported': imported,
+        'skipped': len(new_rules) - imported,
+        'duplicates_in_file': duplicates,
+        'seconds': round(time.perf_counter() - started, 2)
+    }
+    logger.info('Knowledge base import finished', extra=summary)
+    return summary
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Массовая загрузка правил базы знаний из JSON или CSV')
+    arg_parser.add_argument('path')
+    arg_parser.add_argument('--format', choices=['json', 'csv'], help='по умолчанию - по расширению файла')
+    arg_parser.add_argument('--batch-size', type=int, default=KNOWLEDGE_IMPORT_BATCH_SIZE)
+    arg_parser.add_argument('--status', choices=RULE_STATUSES, default='approved')
+    args = arg_parser.parse_args()
+
+    fmt = args.format or ('csv' if args.path.lower().endswith('.csv') else 'json')
+    with open(args.path, 'rb') as f:
+        rules = parse_rules(f.read(), fmt)
+
+    init_db()
+    db = SessionLocal()
+    try:
+        summary = import_rules(db, rules, batch_size=args.batch_size, status=args.status)
+    finally:
+        db.close()
+    print(f"Правил в файле: {summary['total']}, загружено: {summary['imported']}, "
+          f"уже были в базе: {summary['skipped']}, повторов в файле: {summary['duplicates_in_file']}, "
+          f"время: {summary['seconds']} с")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# поиск правил базы знаний, ближайших к вектору запроса
+# memory - индекс утвержденных правил в памяти процесса (NumPy), db - запрос к PostgreSQL по индексу pgvector
+from collections import namedtuple
+import os
+import threading
+import time
+import numpy as np
+import redis
+from sqlalchemy import text
+import metrics
+from database import KnowledgeBaseItem, KNOWLEDGE_INDEX_TYPE
+from logger_config import logger
+
+# где искать правила: memory или db
+KNOWLEDGE_SEARCH_MODE = os.getenv('KNOWLEDGE_SEARCH_MODE', 'memory')
+# сколько правил попадает в промпт
+KNOWLEDGE_SEARCH_LIMIT = int(os.getenv('KNOWLEDGE_SEARCH_LIMIT', '3'))
+# точность приближенного поиска: размер списка кандидатов HNSW и число просматриваемых списков IVFFlat
+# больше - выше полнота (recall) и медленнее запрос
+KNOWLEDGE_SEARCH_EF = int(os.getenv('KNOWLEDGE_SEARCH_EF', '40'))
+KNOWLEDGE_SEARCH_PROBES = int(os.getenv('KNOWLEDGE_SEARCH_PROBES', '10'))
+# как часто индекс в памяти сверяет версию базы знаний (секунды)
+KNOWLEDGE_INDEX_CHECK_SECONDS = float(os.getenv('KNOWLEDGE_INDEX_CHECK_SECONDS', '5'))
+# как часто индекс сверяется с БД, даже если версия не менялась: изменения мимо API
+# (снятие с утверждения, удаление, ручной SQL, несостоявшееся обновление версии) видны не позже
+KNOWLEDGE_INDEX_FULL_SYNC_SECONDS = float(os.getenv('KNOWLEDGE_INDEX_FULL_SYNC_SECONDS', '300'))
+
+# счетчик изменений базы знаний: его увеличивает API при добавлении правил
+VERSION_KEY = 'edi:knowledge_version'
+# сколько id за раз запрашивается при догрузке правил
+FETCH_CHUNK = 1000
+
+# правило в индексе в памяти - те же поля, что нужны задаче от KnowledgeBaseItem
+IndexedRule = namedtuple('IndexedRule', 'id topic rule_text')
+
+def bump_knowledge_version():
+    """
+    Сигнал воркерам, что утвержденные правила изменились
+    """
+    try:
+        metrics.get_redis().incr(VERSION_KEY)
+    except redis.RedisError as e:
+        logger.warning(f'Не удалось обновить версию базы знаний: {e}')
+
+def knowledge_version():
+    # None - Redis недоступен, индекс сверяется с БД напрямую
+    try:
+        value = metrics.get_redis().get(VERSION_KEY)
+    except redis.RedisError as e:
+        logger.debug(f'Версия базы знаний недоступна: {e}')
+        return None
+    return int(value) if value else 0
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+class RuleIndex:
+    """
+    Векторы утвержденных правил - одна непрерывная матрица float32 с нормированными строками.
+    Косинусная близость ко всем правилам - одно умножение матрицы на вектор, top-k - argpartition.
+    При смене версии базы знаний догружаются только новые и измененные правила (по id и rule_hash),
+    удаленные и снятые с утверждения - убираются.
+    """
+    def __init__(
+        self,
+        check_seconds: float = KNOWLEDGE_INDEX_CHECK_SECONDS,
+        full_sync_seconds: float = KNOWLEDGE_INDEX_FULL_SYNC_SECONDS
+    ):
+        self.check_seconds = check_seconds
+        self.full_sync_seconds = full_sync_seconds
+        self.loaded = False
+        self._lock = threading.Lock()
+        # матрица, id и правила заменяются одним присваиванием - поиск без блокировки
+        self._snapshot = (np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64), [])
+        self._hashes = {}
+        self._version = None
+        self._checked_at = 0.0
+        self._synced_at = 0.0
+
+    def __len__(self):
+        return len(self._snapshot[1])
+
+    def build(self, ids, vectors, rules: list):
+        matrix = np.ascontiguousarray(_normalize(np.asarray(vectors, dtype=np.float32)))
+        self._snapshot = (matrix, np.asarray(ids, dtype=np.int64), list(rules))
+
+    def search_vector(self, query_vector, limit: int = KNOWLEDGE_SEARCH_LIMIT) -> list:
+        matrix, _, rules = self._snapshot
+        if not rules:
+            return []
+        scores = matrix @ _normalize(np.asarray(query_vector, dtype=np.float32))
+        k = min(limit, len(scores))
+        # argpartition - k лучших без полной сортировки, сортируются только они
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        return [rules[i] for i in top[np.argsort(-scores[top])]]
+
+    def refresh(self, db):
+        """
+        Сверка с базой знаний не чаще раза в check_seconds: сначала версия в Redis,
+        при ее изменении (или без Redis), а также раз в full_sync_seconds - список id
+        утвержденных правил в БД
+        """
+        if self.loaded and time.monotonic() - self._checked_at < self.check_seconds:
+            return
+        with self._lock:
+            if self.loaded and time.monotonic() - self._checked_at < self.check_seconds:
+                return
+            self._checked_at = time.monotonic()
+            version = knowledge_version()
+            if self.loaded and version is not None and version == self._version \
+                    and time.monotonic() - self._synced_at < self.full_sync_seconds:
+                return
+            self._sync(db)
+            self._version = version
+            self._synced_at = time.monotonic()
+            self.loaded = True
+
+    def _sync(self, db):
+        current = dict(
+            db.query(KnowledgeBaseItem.id, KnowledgeBaseItem.rule_hash)
+            .filter(KnowledgeBaseItem.status == 'approved', KnowledgeBaseItem.embedding.isnot(None))
+            .all()
+        )
+        matrix, ids, rules = self._snapshot
+        keep = [i for i, rule_id in enumerate(ids.tolist())
+                if rule_id in current and current[rule_id] == self._hashes.get(rule_id)]
+        kept_ids = set(ids[keep].tolist())
+        new_ids = [rule_id for rule_id in current if rule_id not in kept_ids]
+        if not new_ids and len(keep) == len(ids):
+            return
+
+        new_rows = []
+        for offset in range(0, len(new_ids), FETCH_CHUNK):
+            new_rows.extend(
+                db.query(KnowledgeBaseItem.id, KnowledgeBaseItem.topic, KnowledgeBaseItem.rule_text,
+                         KnowledgeBaseItem.embedding)
+                .filter(KnowledgeBaseItem.id.in_(new_ids[offset:offset + FETCH_CHUNK]))
+                .all()
+            )
+        vectors = list(matrix[keep]) + [row.embedding for row in new_rows]
+        self.build(
+            ids[keep].tolist() + [row.id for row in new_rows],
+            np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32),
+            [rules[i] for i in keep] + [IndexedRule(row.id, row.topic, row.rule_text) for row in new_rows]
+        )
+        self._hashes = current
+        logger.info(f'Индекс правил в памяти обновлен: правил {len(self)}, '
+                    f'догружено {len(new_rows)}, убрано {len(ids) - len(keep)}')
+
+    def search(self, db, query_vector, limit: int = KNOWLEDGE_SEARCH_LIMIT) -> list:
+        self.refresh(db)
+        return self.search_vector(query_vector, limit)
+
+def set_search_params(db, index_type: str = KNOWLEDGE_INDEX_TYPE, ef_search: int = KNOWLEDGE_SEARCH_EF,
+                      probes: int = KNOWLEDGE_SEARCH_PROBES, limit: int = KNOWLEDGE_SEARCH_LIMIT):
+    # set_config(..., true) - как SET LOCAL: значение действует до конца текущей транзакции
+    if index_type == 'hnsw':
+        # кандидатов не может быть меньше, чем нужно вернуть правил
+        db.execute(text("SELECT set_config('hnsw.ef_search', :value, true)"), {'value': str(max(ef_search, limit))})
+    elif index_type == 'ivfflat':
+        db.execute(text("SELECT set_config('ivfflat.probes', :value, true)"), {'value': str(probes)})
+
+def search_rules(db, query_vector, limit: int = KNOWLEDGE_SEARCH_LIMIT, ef_search: int = KNOWLEDGE_SEARCH_EF):
+    """
+    Утвержденные правила по возрастанию косинусного расстояния до query_vector.
+    В режиме db условие status = 'approved' совпадает с условием частичного индекса - запрос идет по индексу.
+    """
+    if KNOWLEDGE_SEARCH_MODE == 'memory':
+        return rule_index.search(db, query_vector, limit)
+    set_search_params(db, ef_search=ef_search, limit=limit)
+    return db.query(KnowledgeBaseItem)\
+        .filter(KnowledgeBaseItem.status == 'approved')\
+        .order_by(KnowledgeBaseItem.embedding.cosine_distance(query_vector))\
+        .limit(limit)\
+        .all()
+
+# общий индекс процесса воркера
+rule_index = RuleIndex()
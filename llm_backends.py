@@ -0,0 +1,479 @@
+# бэкенды генерации текста для LLMEngine: llama.cpp и заглушка для нагрузочных замеров
+# выбор бэкенда - переменная окружения LLM_BACKEND (llama_cpp или fake)
+import os
+import codecs
+from abc import ABC, abstractmethod
+import json
+import time
+import hashlib
+from collections import OrderedDict
+import metrics
+from llm_batcher import LLM_MAX_BATCH_SIZE
+from logger_config import logger
+
+# llama-cpp-python нужен только бэкенду llama_cpp
+try:
+    import llama_cpp
+    from llama_cpp import Llama, LlamaGrammar
+    from llama_cpp import _internals as internals
+except ImportError:
+    llama_cpp = None
+
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'llama_cpp')
+
+def _cpu_count() -> int:
+    # доступные процессу ядра (в контейнере может быть меньше, чем у хоста)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+CPU_COUNT = _cpu_count()
+
+# параметры llama.cpp - настраиваются под хост без изменения кода
+LLM_MODEL_PATH = os.getenv('LLM_MODEL_PATH', 'models/Meta-Llama-3-8B-Instruct.Q4_K_M.gguf')
+# маленькая квантованная модель для простых ошибок (см. llm_router)
+LLM_SMALL_MODEL_PATH = os.getenv('LLM_SMALL_MODEL_PATH', 'models/Llama-3.2-1B-Instruct-Q4_K_M.gguf')
+# n_ctx - размер окна контекста (сколько текста помнит)
+LLM_N_CTX = int(os.getenv('LLM_N_CTX', '4096'))
+# n_gpu_layers=-1 - если есть видеокарта, перекинуть всё на неё (0 - только CPU)
+LLM_N_GPU_LAYERS = int(os.getenv('LLM_N_GPU_LAYERS', '0'))
+# генерация токенов упирается в память, гиперпотоки не помогают - по умолчанию половина логических ядер;
+# вычисление промпта упирается в вычисления - все ядра
+LLM_N_THREADS = int(os.getenv('LLM_N_THREADS', str(max(1, CPU_COUNT // 2))))
+LLM_N_THREADS_BATCH = int(os.getenv('LLM_N_THREADS_BATCH', str(CPU_COUNT)))
+# сколько токенов промпта вычисляется за один проход
+LLM_N_BATCH = int(os.getenv('LLM_N_BATCH', '512'))
+LLM_N_UBATCH = int(os.getenv('LLM_N_UBATCH', '512'))
+# use_mlock - закрепить веса в RAM (без выгрузки в swap), use_mmap - читать веса через mmap
+LLM_USE_MLOCK = os.getenv('LLM_USE_MLOCK', '0') == '1'
+LLM_USE_MMAP = os.getenv('LLM_USE_MMAP', '1') == '1'
+LLM_FLASH_ATTN = os.getenv('LLM_FLASH_ATTN', '0') == '1'
+# 4294967295 (LLAMA_DEFAULT_SEED) - случайное зерно при каждом запуске
+LLM_SEED = int(os.getenv('LLM_SEED', '4294967295'))
+# температура, если ее нет в generation_config (та же, что по умолчанию у Llama.create_completion)
+LLM_DEFAULT_TEMPERATURE = 0.8
+LLM_VERBOSE = os.getenv('LLM_VERBOSE', '0') == '1'
+
+# переиспользование KV-кэша для неизменной начальной части промпта (системного блока)
+LLM_PREFIX_CACHE_ENABLED = os.getenv('LLM_PREFIX_CACHE_ENABLED', '1') == '1'
+# сколько сохраненных состояний модели держать (по одному на версию шаблона)
+LLM_PREFIX_CACHE_SIZE = int(os.getenv('LLM_PREFIX_CACHE_SIZE', '4'))
+# ограниченная генерация: модель выводит только JSON по схеме ответа (грамматика llama.cpp)
+LLM_CONSTRAINED_DECODING = os.getenv('LLM_CONSTRAINED_DECODING', '1') == '1'
+# ожидаемая структура ответа на анализ ошибки
+ANALYSIS_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'reason': {'type': 'string'},
+        'solution': {'type': 'string'},
+        'criticality': {'type': 'string', 'enum': ['low', 'medium', 'high']}
+    },
+    'required': ['reason', 'solution', 'criticality'],
+    'additionalProperties': False
+}
+# общий размер KV-кэша батчевой генерации в токенах (на все последовательности батча)
+LLM_BATCH_CTX = int(os.getenv('LLM_BATCH_CTX', '8192'))
+
+def llama_params() -> dict:
+    """
+    Аргументы Llama() из настроек окружения (кроме пути к модели)
+    """
+    return {
+        'n_ctx': LLM_N_CTX,
+        'n_gpu_layers': LLM_N_GPU_LAYERS,
+        'n_threads': LLM_N_THREADS,
+        'n_threads_batch': LLM_N_THREADS_BATCH,
+        'n_batch': LLM_N_BATCH,
+        'n_ubatch': LLM_N_UBATCH,
+        'use_mlock': LLM_USE_MLOCK,
+        'use_mmap': LLM_USE_MMAP,
+        'flash_attn': LLM_FLASH_ATTN,
+        'seed': LLM_SEED,
+        'verbose': LLM_VERBOSE
+    }
+
+# бэкенд fake: задержка до первого токена (вычисление промпта) и скорость генерации
+LLM_FAKE_LATENCY_MS = float(os.getenv('LLM_FAKE_LATENCY_MS', '200'))
+LLM_FAKE_TOKENS_PER_SECOND = float(os.getenv('LLM_FAKE_TOKENS_PER_SECOND', '20'))
+LLM_FAKE_RESPONSE = os.getenv('LLM_FAKE_RESPONSE') or json.dumps({
+    'reason': 'Сумма строк накладной не совпадает с итоговой суммой документа.',
+    'solution': '1. Проверьте суммы строк. 2. Пересчитайте итог. 3. Загрузите документ повторно.',
+    'criticality': 'medium'
+}, ensure_ascii=False)
+# бэкенд fake для маленькой модели: быстрее вычисляет промпт и генерирует
+LLM_FAKE_SMALL_LATENCY_MS = float(os.getenv('LLM_FAKE_SMALL_LATENCY_MS', '50'))
+LLM_FAKE_SMALL_TOKENS_PER_SECOND = float(os.getenv('LLM_FAKE_SMALL_TOKENS_PER_SECOND', '80'))
+LLM_FAKE_SMALL_RESPONSE = os.getenv('LLM_FAKE_SMALL_RESPONSE') or LLM_FAKE_RESPONSE
+
+class LLMBackend(ABC):
+    """
+    Интерфейс бэкенда: генерация сырого текста ответа по готовому промпту.
+    Шаблоны, кэш ответов и разбор JSON остаются в LLMEngine.
+    Обязателен только generate, остальное имеет реализацию по умолчанию.
+    """
+    model_id = ''
+    load_seconds = 0.0
+    n_ctx = LLM_N_CTX
+
+    @abstractmethod
+    def generate(self, prompt: str, config: dict, prefix: str = None, on_text=None) -> str:
+        """
+        prefix - постоянная начальная часть промпта (системный блок шаблона),
+        on_text - функция, получающая куски ответа по мере генерации
+        """
+
+    def generate_batch(self, prompts: list, config: dict, on_text: list = None) -> list:
+        # on_text - список получателей кусков ответа по одному на промпт (None - без потоковой выдачи)
+        on_text = on_text or [None] * len(prompts)
+        return [self.generate(prompt, config, on_text=callback) for prompt, callback in zip(prompts, on_text)]
+
+    def warm_up(self) -> float:
+        return 0.0
+
+    def cache_params(self) -> dict:
+        # настройки бэкенда, от которых зависит ответ, помимо generation_config
+        return {}
+
+    def count_tokens(self, text: str) -> int:
+        # без токенизатора модели - оценка: около 4 символов на токен
+        return (len(text) + 3) // 4
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        # начало текста длиной не больше max_tokens токенов
+        return text[:max(0, max_tokens) * 4]
+
+class LlamaCppBackend(LLMBackend):
+    def __init__(self, model_path: str = LLM_MODEL_PATH):
+        if llama_cpp is None:
+            raise RuntimeError('Для бэкенда llama_cpp нужен пакет llama-cpp-python')
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Не найдена модель {model_path}. Скачай модель.")
+        
+        logger.info(f'Загружаю языковую модель {os.path.basename(model_path)} в память...')
+        started = time.perf_counter()
+        self.model_id = os.path.basename(model_path)
+        self.llm = Llama(model_path=model_path, **llama_params())
+        self.n_ctx = self.llm.n_ctx()
+        self.load_seconds = time.perf_counter() - started
+        
+        # сохраненные состояния модели после вычисления постоянного префикса промпта
+        # ключ - хэш текста префикса: новая версия шаблона дает новый префикс и новое состояние
+        self._prefix_states = OrderedDict()
+        # контекст для батчевой генерации создается при первом батче
+        self._batch_ctx = None
+        # грамматика ответа строится при первой генерации
+        self._grammar = None
+        logger.info(f'Языковая модель {self.model_id} готова за {self.load_seconds:.1f} с')
+
+    def warm_up(self, max_tokens: int = 4) -> float:
+        """
+        Короткая пробная генерация: веса, отображенные через mmap, подгружаются с диска,
+        буферы llama.cpp выделяются до первого настоящего документа.
+        Контекст для батчей тоже создается заранее. Возвращает время прогрева в секундах.
+        """
+        started = time.perf_counter()
+        self.llm('Hello', max_tokens=max_tokens, temperature=0)
+        self.llm.reset()
+        if LLM_MAX_BATCH_SIZE > 1:
+            self._batch_context()
+        return time.perf_counter() - started
+
+    def _prompt_tokens(self, text: str):
+        # токенизация ровно как в Llama.create_completion: BOS + текст со спецтокенами
+        return [self.llm.token_bos()] + self.llm.tokenize(text.encode('utf-8'), add_bos=False, special=True)
+
+    def count_tokens(self, text: str) -> int:
+        # без BOS: счетчик нужен и для фрагментов промпта
+        return len(self.llm.tokenize(text.encode('utf-8'), add_bos=False, special=True))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        # токенизация как в count_tokens: обрезанный текст укладывается ровно в посчитанный бюджет
+        tokens = self.llm.tokenize(text.encode('utf-8'), add_bos=False, special=True)
+        if len(tokens) <= max_tokens:
+            return text
+        # обрезка посреди многобайтового символа дает неполную последовательность байт - она отбрасывается
+        return self.llm.detokenize(tokens[:max(0, max_tokens)]).decode('utf-8', errors='ignore')
+
+    def _restore_prefix(self, prefix: str, prompt: str):
+        """
+        Готовит KV-кэш модели с уже вычисленным префиксом промпта.
+        Префикс вычисляется один раз на версию шаблона, затем состояние модели
+        сохраняется и восстанавливается перед каждым запросом. Llama.generate сама находит
+        совпадающее начало токенов и вычисляет только оставшуюся часть промпта.
+        """
+        if not prefix or not prompt.startswith(prefix):
+            return
+        
+        key = hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+        entry = self._prefix_states.get(key)
+        if entry is not None:
+            prefix_tokens, state = entry
+            self._prefix_states.move_to_end(key)
+            # префикс и так лежит в KV-кэше (предыдущий запрос был с тем же шаблоном)
+            if self.llm.n_tokens >= len(prefix_tokens) and \
+                    self.llm._input_ids[:len(prefix_tokens)].tolist() == prefix_tokens:
+                return
+            self.llm.load_state(state)
+            return
+        
+        prefix_tokens = self._prompt_tokens(prefix)
+        self.llm.reset()
+        self.llm.eval(prefix_tokens)
+        self._prefix_states[key] = (prefix_tokens, self.llm.save_state())
+        while len(self._prefix_states) > LLM_PREFIX_CACHE_SIZE:
+            self._prefix_states.popitem(last=False)
+        logger.debug(f'Вычислен префикс промпта: {len(prefix_tokens)} токенов')
+
+    def cache_params(self) -> dict:
+        # ответы с грамматикой и без нее различаются - режим входит в ключ кэша ответов
+        return {'constrained': LLM_CONSTRAINED_DECODING}
+
+    def generate(self, prompt: str, config: dict, prefix: str = None, on_text=None) -> str:
+        # системный блок шаблона не вычисляется заново для каждого документа
+        if LLM_PREFIX_CACHE_ENABLED:
+            self._restore_prefix(prefix, prompt)
+        
+        # генерируется ответ
+        # max_tokens - ограничение длины ответа
+        # temperature - креативность (0.1 - робот, 0.8 - поэт)
+        # stop - слова-стопперы, когда модель должна замолчать
+        # grammar - модель может вывести только JSON по схеме ответа, после "}" - только конец генерации
+        # stream - куски ответа отдаются по мере генерации
+        output = self.llm(
+            prompt,
+            stop=["<|eot_id|>"], 
+            echo=False, # не возвращать сам вопрос в ответе
+            grammar=self._response_grammar(),
+            stream=on_text is not None,
+            **config
+        )
+        if on_text is None:
+            return output['choices'][0]["text"]
+        
+        pieces = []
+        for chunk in output:
+            piece = chunk['choices'][0]['text']
+            pieces.append(piece)
+            on_text(piece)
+        return ''.join(pieces)
+
+    def _response_grammar(self):
+        """
+        GBNF-грамматика llama.cpp из JSON-схемы ответа, строится один раз.
+        None - режим ограниченной генерации выключен.
+        """
+        if not LLM_CONSTRAINED_DECODING:
+            return None
+        if self._grammar is None:
+            self._grammar = LlamaGrammar.from_json_schema(json.dumps(ANALYSIS_RESPONSE_SCHEMA), verbose=False)
+        return self._grammar
+
+    def _batch_context(self):
+        """
+        Отдельный контекст llama.cpp для батчей: у основного контекста одна последовательность.
+        Веса модели общие, дополнительная память - только KV-кэш на LLM_BATCH_CTX токенов.
+        Кэш общий для всех последовательностей (kv_unified), поэтому общий префикс промптов
+        хранится в нем один раз.
+        """
+        if self._batch_ctx is None:
+            params = llama_cpp.llama_context_default_params()
+            params.n_ctx = LLM_BATCH_CTX
+            params.n_batch = self.llm.n_batch
+            params.n_ubatch = self.llm.context_params.n_ubatch
+            params.n_seq_max = LLM_MAX_BATCH_SIZE
+            params.kv_unified = True
+            params.n_threads = LLM_N_THREADS
+            params.n_threads_batch = LLM_N_THREADS_BATCH
+            params.flash_attn = LLM_FLASH_ATTN
+            self._batch_ctx = internals.LlamaContext(model=self.llm._model, params=params, verbose=False)
+        return self._batch_ctx
+
+    def _sampler(self, config: dict):
+        """
+        Цепочка сэмплеров llama.cpp для одной последовательности батча с теми же параметрами,
+        что у Llama.create_completion. У каждой последовательности свой сэмплер:
+        грамматика хранит состояние разбора уже выданного текста.
+        """
+        sampler = internals.LlamaSampler()
+        grammar = self._response_grammar()
+        if grammar is not None:
+            sampler.add_grammar(self.llm._model, grammar)
+        temperature = float(config.get('temperature', LLM_DEFAULT_TEMPERATURE))
+        if temperature <= 0:
+            sampler.add_greedy()
+        else:
+            sampler.add_top_k(int(config.get('top_k', 40)))
+            sampler.add_top_p(float(config.get('top_p', 0.95)), 1)
+            sampler.add_min_p(float(config.get('min_p', 0.05)), 1)
+            sampler.add_temp(temperature)
+            sampler.add_dist(LLM_SEED)
+        return sampler
+
+    def generate_batch(self, prompts: list, config: dict, on_text: list = None) -> list:
+        """
+        Генерация ответов на несколько промптов за один проход модели на каждый шаг:
+        каждый промпт - отдельная последовательность (seq_id) в общем llama_batch.
+        На CPU генерация одного токена упирается в чтение весов из памяти, поэтому
+        шаг для N последовательностей стоит ненамного дороже шага для одной.
+        """
+        on_text = on_text or [None] * len(prompts)
+        max_tokens = int(config.get('max_tokens', 512))
+        sequences = [self._prompt_tokens(prompt) for prompt in prompts]
+        
+        # общий префикс (системный блок) вычисляется один раз для всех последовательностей
+        common = _common_prefix_length(sequences)
+        needed = common + sum(len(tokens) - common + max_tokens for tokens in sequences)
+        # батч не помещается в KV-кэш - делю пополам
+        if needed > LLM_BATCH_CTX or len(prompts) > LLM_MAX_BATCH_SIZE:
+            if len(prompts) == 1:
+                raise ValueError(f'Промпт ({len(sequences[0])} токенов) не помещается в контекст батча')
+            half = len(prompts) // 2
+            return self.generate_batch(prompts[:half], config, on_text[:half]) + \
+                self.generate_batch(prompts[half:], config, on_text[half:])
+        
+        ctx = self._batch_context()
+        ctx.kv_cache_clear()
+        batch = internals.LlamaBatch(n_tokens=self.llm.n_batch, embd=0, n_seq_max=len(prompts), verbose=False)
+        samplers = [self._sampler(config) for _ in prompts]
+        vocab = llama_cpp.llama_model_get_vocab(self.llm.model)
+        seq_ids = list(range(len(prompts)))
+        # токен может оборваться посреди многобайтового символа - байты копятся до целого символа
+        decoders = [codecs.getincrementaldecoder('utf-8')(errors='ignore') if callback else None
+                    for callback in on_text]
+        try:
+            if common:
+                self._decode_tokens(ctx, batch, sequences[0][:common], start=0, seq_ids=seq_ids)
+            # первый токен ответа выбирается сразу после промпта: следующий decode перезапишет логиты
+            next_tokens = {}
+            for seq_id, tokens in enumerate(sequences):
+                last = self._decode_tokens(ctx, batch, tokens[common:], start=common, seq_ids=[seq_id])
+                next_tokens[seq_id] = samplers[seq_id].sample(ctx, last)
+            positions = [len(tokens) for tokens in sequences]
+            outputs = [[] for _ in prompts]
+            
+            for step_number in range(max_tokens):
+                step = [
+                    (seq_id, token) for seq_id, token in next_tokens.items()
+                    if not llama_cpp.llama_vocab_is_eog(vocab, token)
+                ]
+                for seq_id, token in step:
+                    outputs[seq_id].append(token)
+                    if decoders[seq_id] is not None:
+                        on_text[seq_id](decoders[seq_id].decode(self.llm.detokenize([token])))
+                if not step or step_number == max_tokens - 1:
+                    break
+                
+                # один шаг генерации: по одному новому токену от каждой активной последовательности
+                batch.reset()
+                for j, (seq_id, token) in enumerate(step):
+                    _set_batch_token(batch.batch, j, token, positions[seq_id], [seq_id], True)
+                    positions[seq_id] += 1
+                batch.batch.n_tokens = len(step)
+                ctx.decode(batch)
+                next_tokens = {seq_id: samplers[seq_id].sample(ctx, j) for j, (seq_id, _) in enumerate(step)}
+        finally:
+            batch.close()
+            for sampler in samplers:
+                sampler.close()
+        
+        metrics.incr('llm_batches')
+        metrics.incr('llm_batch_sequences', len(prompts))
+        return [self.llm.detokenize(tokens).decode('utf-8', errors='ignore') for tokens in outputs]
+
+    def _decode_tokens(self, ctx, batch, tokens: list, start: int, seq_ids: list) -> int:
+        """
+        Вычисление токенов промпта частями по n_batch.
+        Возвращает индекс последнего токена в батче - по нему берутся логиты.
+        """
+        for offset in range(0, len(tokens), self.llm.n_batch):
+            chunk = tokens[offset:offset + self.llm.n_batch]
+            batch.reset()
+            for j, token in enumerate(chunk):
+                _set_batch_token(batch.batch, j, token, start + offset + j, seq_ids, j == len(chunk) - 1)
+            batch.batch.n_tokens = len(chunk)
+            ctx.decode(batch)
+        return len(chunk) - 1
+
+class FakeBackend(LLMBackend):
+    """
+    Заглушка без модели: всегда возвращает один и тот же JSON с заданной задержкой
+    и скоростью генерации. Нужна для замеров очереди, записи в БД и поиска правил
+    отдельно от скорости модели.
+    """
+    def __init__(
+        self,
+        latency_ms: float = LLM_FAKE_LATENCY_MS,
+        tokens_per_second: float = LLM_FAKE_TOKENS_PER_SECOND,
+        response: str = LLM_FAKE_RESPONSE,
+        model_id: str = 'fake'
+    ):
+        self.model_id = model_id
+        self.latency = latency_ms / 1000
+        self.tokens_per_second = tokens_per_second
+        self.response = response
+        # оценка длины ответа в токенах: около 4 символов на токен
+        self.response_tokens = max(1, len(response) // 4)
+
+    def _duration(self, config: dict) -> float:
+        tokens = min(self.response_tokens, int(config.get('max_tokens', 512)))
+        generation = tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        return self.latency + generation
+
+    def generate(self, prompt: str, config: dict, prefix: str = None, on_text=None) -> str:
+        if on_text is None:
+            time.sleep(self._duration(config))
+        else:
+            self._stream(config, [on_text])
+        return self.response
+
+    def generate_batch(self, prompts: list, config: dict, on_text: list = None) -> list:
+        # идеальный батчинг: шаг генерации для всех последовательностей стоит как для одной
+        callbacks = [callback for callback in on_text or [] if callback is not None]
+        if callbacks:
+            self._stream(config, callbacks)
+        else:
+            time.sleep(self._duration(config))
+        metrics.incr('llm_batches')
+        metrics.incr('llm_batch_sequences', len(prompts))
+        return [self.response] * len(prompts)
+
+    def _stream(self, config: dict, callbacks: list):
+        # ответ выдается кусками по 4 символа (один "токен") с той же общей задержкой, что у generate
+        time.sleep(self.latency)
+        tokens = min(self.response_tokens, int(config.get('max_tokens', 512)))
+        for i in range(tokens):
+            if self.tokens_per_second > 0:
+                time.sleep(1 / self.tokens_per_second)
+            piece = self.response[i * 4:(i + 1) * 4 if i < tokens - 1 else None]
+            for callback in callbacks:
+                callback(piece)
+
+def create_backend(name: str = None, small: bool = False) -> LLMBackend:
+    """
+    Бэкенд большой модели или, при small=True, маленькой модели для маршрутизации
+    """
+    name = name or LLM_BACKEND
+    if name == 'llama_cpp':
+        return LlamaCppBackend(LLM_SMALL_MODEL_PATH) if small else LlamaCppBackend()
+    if name == 'fake':
+        if small:
+            return FakeBackend(LLM_FAKE_SMALL_LATENCY_MS, LLM_FAKE_SMALL_TOKENS_PER_SECOND,
+                               LLM_FAKE_SMALL_RESPONSE, model_id='fake-small')
+        return FakeBackend()
+    raise ValueError(f'Неизвестный бэкенд LLM: {name}')
+
+def _common_prefix_length(sequences: list) -> int:
+    # у каждой последовательности должен остаться хотя бы один свой токен - с него берутся логиты
+    limit = min(len(tokens) for tokens in sequences) - 1
+    length = 0
+    while length < limit and all(tokens[length] == sequences[0][length] for tokens in sequences):
+        length += 1
+    return length
+
+def _set_batch_token(batch, index: int, token: int, position: int, seq_ids: list, logits: bool):
+    batch.token[index] = token
+    batch.pos[index] = position
+    batch.n_seq_id[index] = len(seq_ids)
+    for k, seq_id in enumerate(seq_ids):
+        batch.seq_id[index][k] = seq_id
+    batch.logits[index] = logits
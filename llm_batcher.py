@@ -0,0 +1,91 @@
+# микробатчинг запросов к языковой модели: задачи воркера, пришедшие почти одновременно,
+# обрабатываются одним батчем llama.cpp вместо очереди по одному документу
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import metrics
+from logger_config import logger
+
+# включение батчинга (воркер тогда запускается с пулом потоков, см. manage.py)
+LLM_BATCHING_ENABLED = os.getenv('LLM_BATCHING_ENABLED', '1') == '1'
+# сколько запросов собирать в батч и сколько ждать после первого запроса
+LLM_MAX_BATCH_SIZE = int(os.getenv('LLM_MAX_BATCH_SIZE', '8'))
+LLM_MAX_WAIT_MS = int(os.getenv('LLM_MAX_WAIT_MS', '50'))
+
+class InferenceBatcher:
+    """
+    Собирает запросы на анализ из потоков воркера в батчи.
+    Батч закрывается, когда набрано max_batch_size запросов или прошло max_wait_ms
+    с момента первого. Модель вызывается только из одного потока батчера,
+    каждый поток задачи ждет свой ответ через Future.
+    """
+    def __init__(
+        self,
+        engine_factory,
+        max_batch_size: int = LLM_MAX_BATCH_SIZE,
+        max_wait_ms: int = LLM_MAX_WAIT_MS
+    ):
+        self.engine_factory = engine_factory
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def analyze(self, generation_config: dict = None, **request) -> str:
+        """
+        Аргументы те же, что у LLMEngine.analyze_error. Блокирует поток до готовности ответа.
+        """
+        future = Future()
+        self._ensure_started()
+        self._queue.put((request, generation_config, future))
+        return future.result()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='llm-batcher', daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            self._run(self._collect())
+
+    def _run(self, batch: list):
+        # в один вызов модели попадают только запросы с одинаковой конфигурацией генерации
+        groups = {}
+        for item in batch:
+            key = json.dumps(item[1], sort_keys=True)
+            groups.setdefault(key, []).append(item)
+
+        for items in groups.values():
+            futures = [future for _, _, future in items]
+            try:
+                engine = self.engine_factory()
+                results = engine.analyze_batch([request for request, _, _ in items], items[0][1])
+            except Exception as e:
+                logger.error(f'Батч из {len(items)} запросов к LLM завершился ошибкой: {e}')
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+        metrics.incr('llm_batcher_batches')
+        metrics.incr('llm_batcher_requests', len(batch))
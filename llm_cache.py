@@ -0,0 +1,143 @@
+# кэш ответов языковой модели: одинаковый промпт + одинаковые настройки генерации = одинаковый ответ
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import redis
+import metrics
+from llm_backends import LLM_DEFAULT_TEMPERATURE
+from logger_config import logger
+
+# включение кэша и его лимиты
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', '1') == '1'
+LLM_CACHE_MEMORY_SIZE = int(os.getenv('LLM_CACHE_MEMORY_SIZE', '256'))
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+# общий уровень кэша в Redis (виден всем воркерам): redis или none
+LLM_CACHE_SHARED = os.getenv('LLM_CACHE_SHARED', 'redis')
+LLM_CACHE_SHARED_MAX_ENTRIES = int(os.getenv('LLM_CACHE_SHARED_MAX_ENTRIES', '100000'))
+LLM_CACHE_MAX_ENTRY_BYTES = int(os.getenv('LLM_CACHE_MAX_ENTRY_BYTES', str(64 * 1024)))
+# при температуре выше порога ответ считается "творческим" и не кэшируется
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv('LLM_CACHE_MAX_TEMPERATURE', '0.3'))
+
+SHARED_PREFIX = 'edi:llm_cache:'
+SHARED_INDEX_KEY = 'edi:llm_cache_index'
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов LLM:
+    - LRU в памяти процесса воркера (TTL и ограничение по числу записей),
+    - общий уровень в Redis (TTL и ограничение по числу записей через индекс по времени).
+    Ключ - SHA-256 от модели, отрендеренного промпта и generation_config.
+    """
+    def __init__(
+        self,
+        memory_size: int = LLM_CACHE_MEMORY_SIZE,
+        ttl: int = LLM_CACHE_TTL_SECONDS,
+        shared: str = LLM_CACHE_SHARED,
+        shared_max_entries: int = LLM_CACHE_SHARED_MAX_ENTRIES,
+        max_temperature: float = LLM_CACHE_MAX_TEMPERATURE
+    ):
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.shared = shared
+        self.shared_max_entries = shared_max_entries
+        self.max_temperature = max_temperature
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(prompt: str, config: dict, model_id: str = '') -> str:
+        payload = json.dumps(
+            {'model': model_id, 'prompt': prompt, 'config': config},
+            sort_keys=True,
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def should_bypass(self, config: dict) -> bool:
+        # без temperature в конфиге модель сэмплирует с температурой по умолчанию, а не детерминированно
+        return config.get('temperature', LLM_DEFAULT_TEMPERATURE) > self.max_temperature
+
+    def get(self, key: str):
+        """
+        Ответ из кэша или None. Попадание в общий уровень копируется в память процесса.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    metrics.incr('llm_cache_hits_memory')
+                    return value
+                del self._memory[key]
+
+        value = self._get_shared(key)
+        if value is not None:
+            self._set_memory(key, value)
+            metrics.incr('llm_cache_hits_shared')
+            return value
+
+        metrics.incr('llm_cache_misses')
+        return None
+
+    def set(self, key: str, value: str):
+        if len(value.encode('utf-8')) > LLM_CACHE_MAX_ENTRY_BYTES:
+            return
+        self._set_memory(key, value)
+        self._set_shared(key, value)
+
+    def _set_memory(self, key: str, value: str):
+        with self._lock:
+            self._memory[key] = (value, time.time() + self.ttl)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _get_shared(self, key: str):
+        if self.shared != 'redis':
+            return None
+        try:
+            value = metrics.get_redis().get(SHARED_PREFIX + key)
+        except redis.RedisError as e:
+            logger.warning(f'Общий кэш LLM недоступен: {e}')
+            return None
+        return value.decode('utf-8') if value is not None else None
+
+    def _set_shared(self, key: str, value: str):
+        if self.shared != 'redis':
+            return
+        try:
+            client = metrics.get_redis()
+            pipe = client.pipeline()
+            pipe.set(SHARED_PREFIX + key, value, ex=self.ttl)
+            pipe.zadd(SHARED_INDEX_KEY, {key: time.time()})
+            pipe.zcard(SHARED_INDEX_KEY)
+            size = pipe.execute()[-1]
+            # самые старые записи сверх лимита удаляю вместе с индексом
+            if size > self.shared_max_entries:
+                stale = client.zpopmin(SHARED_INDEX_KEY, size - self.shared_max_entries)
+                if stale:
+                    client.delete(*[SHARED_PREFIX + member.decode('utf-8') for member, _ in stale])
+        except redis.RedisError as e:
+            logger.warning(f'Не удалось записать ответ в общий кэш LLM: {e}')
+
+def cache_stats(counters: dict):
+    """
+    Сводка по кэшу из общих счетчиков metrics
+    """
+    hits = counters.get('llm_cache_hits_memory', 0) + counters.get('llm_cache_hits_shared', 0)
+    lookups = hits + counters.get('llm_cache_misses', 0)
+    return {
+        'hits_memory': counters.get('llm_cache_hits_memory', 0),
+        'hits_shared': counters.get('llm_cache_hits_shared', 0),
+        'misses': counters.get('llm_cache_misses', 0),
+        'bypassed': counters.get('llm_cache_bypass', 0),
+        'hit_ratio': metrics.ratio(hits, lookups)
+    }
+
+# кэш процесса воркера
+response_cache = ResponseCache()
@@ -0,0 +1,86 @@
+# тонкий клиент локального сервера инференса (inference_server.py)
+# воркеры Celery не держат модель в памяти, а отправляют запросы одному процессу с моделью
+import http.client
+import json
+import os
+import socket
+import time
+from urllib.parse import urlparse
+
+# адрес сервера: http://127.0.0.1:8100 или unix:///tmp/edi-llm.sock
+LLM_SERVER_URL = os.getenv('LLM_SERVER_URL', 'http://127.0.0.1:8100')
+# генерация батча может занимать минуты
+LLM_SERVER_TIMEOUT = float(os.getenv('LLM_SERVER_TIMEOUT', '600'))
+
+class InferenceServerError(Exception):
+    """
+    Сервер инференса недоступен или вернул ошибку (status - HTTP-код ответа, None - нет соединения)
+    """
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class InferenceClient:
+    def __init__(self, url: str = LLM_SERVER_URL, timeout: float = LLM_SERVER_TIMEOUT):
+        self.url = urlparse(url)
+        self.timeout = timeout
+
+    def _connection(self, timeout: float):
+        if self.url.scheme == 'unix':
+            return UnixHTTPConnection(self.url.path, timeout)
+        return http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=timeout)
+
+    def _request(self, method: str, path: str, payload: dict = None, timeout: float = None):
+        connection = self._connection(timeout or self.timeout)
+        try:
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8') if payload is not None else None
+            connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+        except OSError as e:
+            raise InferenceServerError(f'Сервер инференса недоступен: {e}')
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise InferenceServerError(f'Сервер инференса ответил {response.status}: {data[:500]!r}', response.status)
+        return json.loads(data)
+
+    def analyze(self, generation_config: dict = None, **request) -> str:
+        """
+        Аргументы те же, что у LLMEngine.analyze_error. Возвращает JSON-ответ модели строкой.
+        """
+        payload = {**request, 'generation_config': generation_config}
+        return self._request('POST', '/analyze', payload)['analysis']
+
+    def health(self) -> dict:
+        return self._request('GET', '/health', timeout=5)
+
+    def wait_ready(self, timeout: float) -> bool:
+        """
+        Ожидание, пока сервер загрузит и прогреет модель.
+        Если загрузка модели на сервере завершилась ошибкой (ответ 500), ждать нечего -
+        InferenceServerError с причиной сразу.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                self.health()
+                return True
+            except InferenceServerError as e:
+                if e.status == 500:
+                    raise
+                time.sleep(1)
+        return False
+
+# клиент процесса воркера
+inference_client = InferenceClient()
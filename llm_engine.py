@@ -1,6 +1,26 @@
 import os
-from llama_cpp import Llama
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+import re
+import json
+import logging
+import hashlib
+import time
+from collections import OrderedDict, namedtuple
+import metrics
+import analysis_stream
+from jinja2 import Environment, FileSystemLoader
+from llm_cache import response_cache, LLM_CACHE_ENABLED
+from llm_backends import create_backend
+from prompt_assembler import PromptAssembler
+from llm_router import LLM_ROUTING_ENABLED, TIER_SMALL, TIER_LARGE, choose_tier, is_confident, routing_stats
+from logger_config import logger
+
+# сколько скомпилированных шаблонов промптов держать в памяти
+LLM_TEMPLATE_CACHE_SIZE = int(os.getenv('LLM_TEMPLATE_CACHE_SIZE', '32'))
+# переменные шаблона промпта
+PROMPT_VARIABLES = ('doc_id', 'doc_type', 'error_text', 'context_rules')
+
+# запрос пакета, ответа на который нет в кэше
+PendingRequest = namedtuple('PendingRequest', 'index doc_id template prompt prompt_tokens cache_key tier stream')
 
 class LLMEngine:
     _instance = None
@@ -13,26 +33,68 @@ class LLMEngine:
         return cls._instance
 
     def _init_model(self):
-        model_path = "models/Meta-Llama-3-8B-Instruct.Q4_K_M.gguf"
-        if not os.path.exists(model_path):
-            raise FileNotFoundError(f"Не найдена модель {model_path}. Скачай модель.")
+        # бэкенд генерации: llama.cpp или заглушка (LLM_BACKEND)
+        self.backend = create_backend()
+        self.model_id = self.backend.model_id
         
-        print("Загружаю языковую модель в память...")
-        # n_ctx=2048 - размер окна контекста (сколько текста помнит)
-        # n_gpu_layers=-1 - если есть видеокарта, перекинуть всё на неё (0 - только CPU)
-        self.llm = Llama(
-            model_path=model_path,
-            n_ctx=4096, 
-            n_gpu_layers=0,
-            verbose=False
-        )
+        # маленькая модель для простых ошибок; без файла модели все запросы идут в большую
+        self.small_backend = None
+        if LLM_ROUTING_ENABLED:
+            try:
+                self.small_backend = create_backend(small=True)
+            except FileNotFoundError as e:
+                logger.warning(f'Маршрутизация на маленькую модель отключена: {e}')
+        self.load_seconds = self.backend.load_seconds + (self.small_backend.load_seconds if self.small_backend else 0.0)
         
-        # настройка Jinja для шаблонов
+        # настройка Jinja для шаблонов: промпт - обычный текст для модели, не HTML,
+        # поэтому без экранирования (иначе кавычки и <> из ошибок lxml приходят модели
+        # как &#39; и &lt; и не совпадают с длиной, посчитанной при сборке промпта)
         self.env = Environment(
             loader=FileSystemLoader("prompts"),
-            autoescape=select_autoescape()
+            autoescape=False
         )
-        print("Языковая модель готова!")
+        
+        # скомпилированные шаблоны jinja2: ключ - id и версия промпта из БД
+        self._templates = OrderedDict()
+        # промпт подгоняется под контекст большой модели (у маленькой тот же LLM_N_CTX)
+        self.assembler = PromptAssembler(self.backend)
+
+    def warm_up(self) -> float:
+        """
+        Прогрев бэкенда до первого настоящего документа. Возвращает время прогрева в секундах.
+        """
+        seconds = self.backend.warm_up()
+        if self.small_backend is not None:
+            seconds += self.small_backend.warm_up()
+        return seconds
+
+    def _get_template(self, template_text: str, template_key: str = None):
+        """
+        Скомпилированный шаблон jinja2. Промпт в БД не меняется после создания
+        (новый текст - новая версия), поэтому ключ "id:версия" однозначно задает текст.
+        Без ключа (запасной шаблон) ключом служит хэш текста.
+        """
+        key = template_key or hashlib.sha256(template_text.encode('utf-8')).hexdigest()
+        template = self._templates.get(key)
+        if template is not None:
+            self._templates.move_to_end(key)
+            return template
+        
+        template = self.env.from_string(template_text)
+        self._templates[key] = template
+        while len(self._templates) > LLM_TEMPLATE_CACHE_SIZE:
+            self._templates.popitem(last=False)
+        return template
+
+    def _static_prefix(self, template) -> str:
+        """
+        Постоянная часть промпта - все, что шаблон выводит до первой подстановки переменной.
+        Определяется рендером шаблона с маркерами вместо значений.
+        """
+        markers = {name: f'\x00{name}\x00' for name in PROMPT_VARIABLES}
+        rendered = template.render(**markers)
+        positions = [rendered.find(marker) for marker in markers.values() if marker in rendered]
+        return rendered[:min(positions)] if positions else rendered
 
     def analyze_error(
         self, 
@@ -41,42 +103,171 @@ class LLMEngine:
         error_text: str, 
         rules: str,
         template_text: str,
-        generation_config: dict = None
+        generation_config: dict = None,
+        template_key: str = None,
+        error_category: str = None,
+        stream: bool = False
     ):
+        request = {
+            'doc_id': doc_id,
+            'doc_type': doc_type,
+            'error_text': error_text,
+            'rules': rules,
+            'template_text': template_text,
+            'template_key': template_key,
+            'error_category': error_category,
+            'stream': stream
+        }
+        return self.analyze_batch([request], generation_config)[0]
+
+    def analyze_batch(self, requests: list, generation_config: dict = None) -> list:
+        """
+        Анализ нескольких документов с одинаковой конфигурацией генерации.
+        Каждый запрос - словарь с аргументами analyze_error (без generation_config),
+        template_key - необязательный ключ кэша шаблона ("id:версия" промпта),
+        error_category - статус валидации документа для выбора модели,
+        stream - публиковать частичный ответ в канал документа (analysis_stream).
+        Ответы из кэша не генерируются, остальные промпты вычисляются одним
+        батчем бэкенда (для llama.cpp - multi-sequence батч) на выбранной модели.
+        Порядок ответов совпадает с порядком запросов.
+        """
         # даю дефолтную конфигурацию генерации, если не было передано ничего 
-        config = generation_config or {'temperature': 0.1, 'max_tokens': 512}
+        route_config = generation_config or {'temperature': 0.1, 'max_tokens': 512}
+        # model_tier - настройка маршрутизации, а не параметр генерации
+        config = {key: value for key, value in route_config.items() if key != 'model_tier'}
         
-        # беру шаблон jinja2 из строки в БД
-        template = self.env.from_string(template_text)
+        results = [None] * len(requests)
+        pending = []
+        for i, request in enumerate(requests):
+            # беру шаблон jinja2 из строки в БД (компилируется один раз на версию промпта)
+            template = self._get_template(request['template_text'], request.get('template_key'))
+            
+            # добавляю данные из промпта jinja2 для рендеринга: текст ошибки и правила - в пределах
+            # контекста модели за вычетом места под ответ
+            prompt, prompt_tokens = self.assembler.assemble(template, request, int(config.get('max_tokens', 512)))
+            
+            # полный промпт - только в отладочном логе (LOG_LEVEL=DEBUG)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Промпт для документа {request["doc_id"]}:\n{prompt}')
+            
+            tier = TIER_LARGE
+            if self.small_backend is not None:
+                tier = choose_tier(request.get('error_category'), request['error_text'], route_config)
+            
+            # одинаковый промпт с теми же настройками уже обрабатывался выбранной моделью - беру ответ из кэша
+            # при высокой температуре ответы должны различаться, кэш не используется
+            cache_key = None
+            if LLM_CACHE_ENABLED:
+                if response_cache.should_bypass(config):
+                    metrics.incr('llm_cache_bypass')
+                else:
+                    cache_key = self._cache_key(prompt, config, tier)
+                    cached = response_cache.get(cache_key)
+                    if cached is not None:
+                        results[i] = cached
+                        continue
+            
+            routing_stats.route(tier)
+            metrics.incr(f'llm_route_{tier}')
+            pending.append(PendingRequest(
+                i, request['doc_id'], template, prompt, prompt_tokens, cache_key, tier, request.get('stream', False)
+            ))
         
-        # добавляю данные из промпта jinja2 для рендеринга
-        prompt = template.render(
-            doc_id=doc_id, 
-            doc_type=doc_type, 
-            error_text=error_text,
-            context_rules=rules
-        )
+        raw_texts = {}
+        # ключ кэша ответа модели, которая в итоге ответила (после эскалации - большой)
+        cache_keys = {item.index: item.cache_key for item in pending}
+        large = [item for item in pending if item.tier == TIER_LARGE]
+        small = [item for item in pending if item.tier == TIER_SMALL]
+        if small:
+            for item, raw_text in zip(small, self._generate(TIER_SMALL, small, config)):
+                if is_confident(raw_text):
+                    raw_texts[item.index] = raw_text
+                else:
+                    # невалидный JSON или неуверенный ответ маленькой модели - пересчет большой;
+                    # ответ большой модели кэшируется под ее ключом, а не под ключом маленькой
+                    routing_stats.escalate()
+                    metrics.incr('llm_route_escalated')
+                    cache_key = self._cache_key(item.prompt, config, TIER_LARGE) if item.cache_key else None
+                    cached = response_cache.get(cache_key) if cache_key else None
+                    cache_keys[item.index] = cache_key
+                    if cached is not None:
+                        raw_texts[item.index] = cached
+                        continue
+                    if item.stream:
+                        # клиент отбрасывает частичный ответ маленькой модели и ждет ответ большой
+                        analysis_stream.clear_partial(item.doc_id)
+                        analysis_stream.publish(item.doc_id, analysis_stream.EVENT_STATUS,
+                                                {'status': 'escalated', 'model': self.backend.model_id})
+                    large.append(item._replace(tier=TIER_LARGE, cache_key=cache_key))
+        if large:
+            for item, raw_text in zip(large, self._generate(TIER_LARGE, large, config)):
+                raw_texts[item.index] = raw_text
         
-        print("--- ACTUAL PROMPT ---")
-        print(prompt)
-        print("---------------------")
-        # генерируется ответ
-        # max_tokens - ограничение длины ответа
-        # temperature - креативность (0.1 - робот, 0.8 - поэт)
-        # stop - слова-стопперы, когда модель должна замолчать
-        output = self.llm(
-            prompt,
-            stop=["<|eot_id|>"], 
-            echo=False, # не возвращать сам вопрос в ответе
-            **config
-        )
-        raw_text = output['choices'][0]["text"].strip()
+        for item in pending:
+            results[item.index] = self._extract_json(raw_texts[item.index].strip(), cache_keys[item.index])
+        return results
+
+    def _cache_key(self, prompt: str, config: dict, tier: str) -> str:
+        # ключ ответа модели, которая его дает: ответ маленькой модели не выдается за ответ 8B
+        backend = self.small_backend if tier == TIER_SMALL else self.backend
+        return response_cache.make_key(prompt, {**config, **backend.cache_params()}, backend.model_id)
+
+    def _generate(self, tier: str, items: list, config: dict) -> list:
+        """
+        Генерация ответов для элементов pending на модели tier с замером задержки
+        """
+        backend = self.small_backend if tier == TIER_SMALL else self.backend
+        # получатели частичного ответа для клиентов, которые следят за анализом
+        on_text = [analysis_stream.PartialPublisher(item.doc_id, backend.model_id) if item.stream else None
+                   for item in items]
+        started = time.perf_counter()
+        if len(items) == 1:
+            raw_texts = [backend.generate(items[0].prompt, config, prefix=self._static_prefix(items[0].template),
+                                          on_text=on_text[0])]
+        else:
+            raw_texts = backend.generate_batch([item.prompt for item in items], config, on_text)
+        seconds = time.perf_counter() - started
+        # остаток частичного ответа, накопленный после последней отправки
+        for publisher in on_text:
+            if publisher is not None:
+                publisher.close()
+        routing_stats.record(tier, seconds)
+        metrics.incr(f'llm_{tier}_generations')
+        metrics.incr(f'llm_{tier}_ms', int(seconds * 1000))
         
+        # стоимость документа в токенах: промпт посчитан при сборке, ответ - токенизатором той же модели
+        completion_tokens = [backend.count_tokens(raw_text) for raw_text in raw_texts]
+        for item, tokens in zip(items, completion_tokens):
+            logger.info(f'Документ {item.doc_id}: токенов промпта {item.prompt_tokens}, ответа {tokens}, '
+                        f'модель {backend.model_id}')
+        metrics.incr('llm_prompt_tokens', sum(item.prompt_tokens for item in items))
+        metrics.incr('llm_completion_tokens', sum(completion_tokens))
+        return raw_texts
+
+    def _extract_json(self, raw_text: str, cache_key: str = None) -> str:
+        """
+        JSON-ответ модели. Задача воркера делает json.loads, поэтому на выходе всегда
+        валидный JSON: текст без разбираемого объекта (или обрезанный по max_tokens)
+        оборачивается в структуру ответа и в кэш не попадает.
+        """
         # пост-обработка ответа ИИ - если что-то пишет помимо JSON в {...}
-        import re
         json_match = re.search(r'\{.*\}', raw_text, re.DOTALL)
         if json_match:
+            try:
+                json.loads(json_match.group(0))
+            except json.JSONDecodeError:
+                json_match = None
+        if json_match:
+            # в кэш попадают только ответы с JSON
+            if cache_key is not None:
+                response_cache.set(cache_key, json_match.group(0))
             return json_match.group(0)
-        else:
-            print(f'Предупреждение: ИИ выдала ответ без кода JSON: {raw_text}')
-            return raw_text
\ No newline at end of file
+        
+        logger.warning(f'ИИ выдала ответ без кода JSON: {raw_text}')
+        metrics.incr('llm_invalid_json')
+        return json.dumps({
+            'reason': 'Модель вернула ответ не в формате JSON',
+            'solution': raw_text,
+            'criticality': 'medium'
+        }, ensure_ascii=False)
+
@@ -0,0 +1,140 @@
+# выбор модели для анализа: маленькая квантованная модель для простых ошибок, 8B - для остальных
+# ответ маленькой модели проверяется, невалидный или неуверенный ответ пересчитывается большой моделью
+import json
+import os
+import re
+import threading
+import statistics
+from collections import deque
+import metrics
+
+# включение маршрутизации (без маленькой модели все запросы идут в большую)
+LLM_ROUTING_ENABLED = os.getenv('LLM_ROUTING_ENABLED', '1') == '1'
+# статусы валидации документа, которые может разобрать маленькая модель
+ROUTER_SMALL_CATEGORIES = set(filter(None, os.getenv('ROUTER_SMALL_CATEGORIES', 'schema_error,syntax_error,valid').split(',')))
+# длинный текст ошибки (несколько ошибок, вложенные сообщения) - сразу большая модель
+ROUTER_SMALL_MAX_ERROR_CHARS = int(os.getenv('ROUTER_SMALL_MAX_ERROR_CHARS', '300'))
+# промпт, рассчитанный на длинный ответ, маленькой модели не отдается
+ROUTER_SMALL_MAX_TOKENS = int(os.getenv('ROUTER_SMALL_MAX_TOKENS', '512'))
+# сколько последних замеров задержки хранить на каждую модель
+ROUTER_LATENCY_WINDOW = int(os.getenv('ROUTER_LATENCY_WINDOW', '1000'))
+# эвристика уверенности: минимальная длина причины и решения в символах
+ROUTER_MIN_REASON_CHARS = int(os.getenv('ROUTER_MIN_REASON_CHARS', '15'))
+ROUTER_MIN_SOLUTION_CHARS = int(os.getenv('ROUTER_MIN_SOLUTION_CHARS', '20'))
+
+TIER_SMALL = 'small'
+TIER_LARGE = 'large'
+CRITICALITY_LEVELS = ('low', 'medium', 'high')
+# ответы-отговорки маленькой модели
+UNSURE_PATTERN = re.compile(r'не знаю|не могу|неизвестн|не удалось определить|unknown|n/a|\.\.\.$', re.IGNORECASE)
+
+def choose_tier(error_category: str, error_text: str, generation_config: dict) -> str:
+    """
+    Модель для запроса. generation_config промпта может явно задать model_tier: small | large | auto.
+    """
+    forced = generation_config.get('model_tier', 'auto')
+    if forced in (TIER_SMALL, TIER_LARGE):
+        return forced
+    if error_category not in ROUTER_SMALL_CATEGORIES:
+        return TIER_LARGE
+    if len(error_text or '') > ROUTER_SMALL_MAX_ERROR_CHARS:
+        return TIER_LARGE
+    if int(generation_config.get('max_tokens', 512)) > ROUTER_SMALL_MAX_TOKENS:
+        return TIER_LARGE
+    return TIER_SMALL
+
+def parse_answer(raw_text: str):
+    """
+    JSON-объект из ответа модели (модель может написать текст вокруг {...}) или None
+    """
+    json_match = re.search(r'\{.*\}', raw_text, re.DOTALL)
+    if not json_match:
+        return None
+    try:
+        answer = json.loads(json_match.group(0))
+    except json.JSONDecodeError:
+        return None
+    return answer if isinstance(answer, dict) else None
+
+def is_confident(raw_text: str) -> bool:
+    """
+    Ответ маленькой модели можно сохранить без большой: валидный JSON по схеме ответа,
+    содержательные причина и решение, без отговорок
+    """
+    answer = parse_answer(raw_text)
+    if answer is None:
+        return False
+    reason, solution = answer.get('reason'), answer.get('solution')
+    if not isinstance(reason, str) or not isinstance(solution, str):
+        return False
+    if answer.get('criticality') not in CRITICALITY_LEVELS:
+        return False
+    reason, solution = reason.strip(), solution.strip()
+    if len(reason) < ROUTER_MIN_REASON_CHARS or len(solution) < ROUTER_MIN_SOLUTION_CHARS:
+        return False
+    if reason == solution:
+        return False
+    return not (UNSURE_PATTERN.search(reason) or UNSURE_PATTERN.search(solution))
+
+class RoutingStats:
+    """
+    Статистика маршрутизации в памяти процесса: число запросов и задержки генерации по моделям.
+    Общие счетчики для API пишутся в metrics.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.routed = {TIER_SMALL: 0, TIER_LARGE: 0}
+            self.escalated = 0
+            self.latencies = {tier: deque(maxlen=ROUTER_LATENCY_WINDOW) for tier in (TIER_SMALL, TIER_LARGE)}
+
+    def route(self, tier: str):
+        with self.lock:
+            self.routed[tier] += 1
+
+    def escalate(self):
+        with self.lock:
+            self.escalated += 1
+
+    def record(self, tier: str, seconds: float):
+        # время одной генерации (одиночной или батчем) на модели tier
+        with self.lock:
+            self.latencies[tier].append(seconds * 1000)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'routed': dict(self.routed),
+                'escalated': self.escalated,
+                'latency_ms_p50': {
+                    tier: round(statistics.median(values), 1) if values else None
+                    for tier, values in self.latencies.items()
+                },
+                'generations': {tier: len(values) for tier, values in self.latencies.items()}
+            }
+
+def routing_summary(counters: dict):
+    """
+    Доля запросов по моделям, эскалации и средняя задержка генерации из общих счетчиков metrics
+    """
+    small = counters.get('llm_route_small', 0)
+    large = counters.get('llm_route_large', 0)
+    escalated = counters.get('llm_route_escalated', 0)
+    return {
+        'routed_small': small,
+        'routed_large': large,
+        'escalated': escalated,
+        'share_small': metrics.ratio(small, small + large),
+        'escalation_rate': metrics.ratio(escalated, small),
+        'avg_generation_ms': {
+            tier: round(counters.get(f'llm_{tier}_ms', 0) / counters[f'llm_{tier}_generations'], 1)
+            if counters.get(f'llm_{tier}_generations') else 0.0
+            for tier in (TIER_SMALL, TIER_LARGE)
+        }
+    }
+
+# общий инстанс для процесса с моделью
+routing_stats = RoutingStats()
@@ -1,4 +1,5 @@
 # настройка логгера для создания JSON-логов, как в энтерпрайзе
+import os
 import logging
 from pythonjsonlogger import jsonlogger
 
@@ -12,7 +13,8 @@ def setup_logger():
     
     # настройка логгера
     # устанавливаю уровень ведения журнала для инстанса логгера
-    logger.setLevel(logging.INFO)
+    # LOG_LEVEL=DEBUG включает подробные логи (например, полные промпты LLM)
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
     
     # создаю для инстанса логгера обработчик, который пишет в консоль
     handler = logging.StreamHandler()
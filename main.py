@@ -1,7 +1,21 @@
-from fastapi import FastAPI, Depends, HTTPException, Header, status
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import insert, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, load_only
+from celery import group
 from typing import List
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+import redis
 import secrets
+import zipfile
+import zlib
 
 # импорт моделей БД и схем
 import database
@@ -9,13 +23,34 @@ import schemas
 
 # импорт логгера и парсера XML
 from logger_config import logger
-from xml_parser import EdiXmlParser
+from xml_parser import schema_cache
+from xml_storage import storage_columns
+from parse_executor import parse_executor, ParseQueueFull, ParseTimeout
 
 # импорт задачи для анализа документа
-from tasks import analyze_document_task
+from tasks import analyze_document_task, ANALYSIS_PROMPT_NAME
 
-# импорт векторизатора
+# ход анализа для клиентов (SSE)
+import analysis_stream
+
+# метрики системы
+import metrics
+from llm_cache import cache_stats
+from embedding_cache import embedding_cache_stats
+from error_resolver import resolver_stats
+from llm_router import routing_summary
+
+# импорт векторизатора и массовой загрузки правил
 from embeddings import embedder
+from knowledge_search import bump_knowledge_version
+from knowledge_import import parse_rules, import_rules, rule_hash, RULE_STATUSES, KNOWLEDGE_IMPORT_BATCH_SIZE
+
+# ограничения пакетной загрузки документов
+BATCH_MAX_DOCUMENTS = int(os.getenv('BATCH_MAX_DOCUMENTS', '1000'))
+BATCH_PARSE_WORKERS = int(os.getenv('BATCH_PARSE_WORKERS', str(os.cpu_count() or 4)))
+# zip-архив: размер тела запроса и суммарный размер файлов после распаковки
+BATCH_ZIP_MAX_BYTES = int(os.getenv('BATCH_ZIP_MAX_BYTES', str(100 * 1024 * 1024)))
+BATCH_ZIP_MAX_UNCOMPRESSED_BYTES = int(os.getenv('BATCH_ZIP_MAX_UNCOMPRESSED_BYTES', str(500 * 1024 * 1024)))
 
 # создание приложения
 app = FastAPI(title='EDI Enterprise API')
@@ -81,17 +116,10 @@ def read_user(user_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail='Пользователь с таким ID не найден.')
     return db_user
 
-@app.post('/users/{user_id}/documents', response_model=schemas.DocumentResponse)
-def upload_document(
-    user_id: int, 
-    doc: schemas.DocumentCreate, 
-    db: Session = Depends(get_db),
-    current_user: database.User = Depends(get_current_user)
-):
+def _check_upload_access(user_id: int, current_user: database.User, db: Session):
     """
-    Загрузка документа для клиента
+    Проверка прав на загрузку документов пользователю user_id и его существования
     """
-    # проверка доступа
     if current_user.id != user_id and current_user.role != 'admin':
         raise HTTPException(
             status_code=403,
@@ -101,6 +129,151 @@ def upload_document(
     db_user = db.query(database.User).filter(database.User.id == user_id).first()
     if db_user is None:
         raise HTTPException(status_code=404, detail='Пользователь с таким ID не найден.')
+
+def _find_active_schema(db: Session, doc_type: str):
+    return db.query(database.ValidationSchema)\
+        .filter(database.ValidationSchema.name == doc_type,
+                database.ValidationSchema.is_active == True)\
+        .first()
+
+async def _validate_and_parse(content_xml: str, schema_db, block: bool = False):
+    """
+    XSD-валидация (если схема есть) и парсинг документа за один разбор XML.
+    В режиме PARSE_EXECUTION_MODE=process крупные документы обрабатываются в пуле процессов,
+    обработчик ждет результат без занятого потока.
+    """
+    return await parse_executor.run_async(
+        content_xml,
+        xsd_content=schema_db.xsd_content if schema_db else None,
+        schema_key=(schema_db.name, schema_db.version) if schema_db else None,
+        block=block
+    )
+
+def _content_hash(content_xml: str) -> str:
+    return hashlib.sha256(content_xml.encode('utf-8')).hexdigest()
+
+def _find_duplicates(db: Session, owner_id: int, keys: set):
+    """
+    Поиск ранее загруженных документов с тем же содержимым среди документов владельца owner_id
+    (чужие документы, их разбор и анализ другому клиенту не отдаются).
+    keys - набор ключей (content_hash, doc_type, schema_version).
+    Возвращает словарь ключ -> (документ-источник, анализ или None).
+    Анализ переиспользуется, только если он получен активной версией промпта анализа.
+    """
+    if not keys:
+        return {}
+    
+    candidates = db.query(database.EdiDocument)\
+        .options(load_only(
+            database.EdiDocument.id,
+            database.EdiDocument.content_hash,
+            database.EdiDocument.doc_type,
+            database.EdiDocument.schema_version,
+            database.EdiDocument.parsed_metadata,
+            database.EdiDocument.validation_status
+        ))\
+        .filter(database.EdiDocument.owner_id == owner_id,
+                database.EdiDocument.content_hash.in_({key[0] for key in keys}))\
+        .order_by(database.EdiDocument.id.desc())\
+        .all()
+    if not candidates:
+        return {}
+    
+    prompt_db = db.query(database.PromptTemplate)\
+        .filter(database.PromptTemplate.name == ANALYSIS_PROMPT_NAME,
+                database.PromptTemplate.is_active == True)\
+        .first()
+    analyses = {}
+    if prompt_db:
+        analysis_rows = db.query(database.AnalysisResult)\
+            .filter(database.AnalysisResult.document_id.in_([c.id for c in candidates]),
+                    database.AnalysisResult.prompt_name == prompt_db.name,
+                    database.AnalysisResult.prompt_version == prompt_db.version)\
+            .order_by(database.AnalysisResult.id.desc())\
+            .all()
+        for analysis in analysis_rows:
+            analyses.setdefault(analysis.document_id, analysis)
+    
+    found = {}
+    for candidate in candidates:
+        key = (candidate.content_hash, candidate.doc_type, candidate.schema_version)
+        if key not in keys:
+            continue
+        # беру самый свежий документ, но предпочитаю тот, у которого уже есть анализ
+        analysis = analyses.get(candidate.id)
+        if key not in found or (found[key][1] is None and analysis is not None):
+            found[key] = (candidate, analysis)
+    return found
+
+def _reused_analysis(source_analysis, document_id: int = None):
+    """
+    Копия готового анализа для повторно загруженного документа
+    """
+    return {
+        'document_id': document_id,
+        'ai_response_json': source_analysis.ai_response_json,
+        'prompt_name': source_analysis.prompt_name,
+        'prompt_version': source_analysis.prompt_version,
+        # ссылка всегда на первоначальный анализ, а не на его копию
+        'reused_from_id': source_analysis.reused_from_id or source_analysis.id
+    }
+
+def _find_upload_source(db: Session, user_id: int, doc: schemas.DocumentCreate):
+    """
+    Схема для типа документа и ранее загруженная тем же клиентом копия того же XML под той же схемой:
+    (схема, хэш, версия схемы, документ-источник, его анализ)
+    """
+    schema_db = _find_active_schema(db, doc.doc_type)
+    content_hash = _content_hash(doc.content_xml)
+    schema_version = schema_db.version if schema_db else None
+    source, source_analysis = _find_duplicates(db, user_id, {(content_hash, doc.doc_type, schema_version)})\
+        .get((content_hash, doc.doc_type, schema_version), (None, None))
+    return schema_db, content_hash, schema_version, source, source_analysis
+
+def _store_document(db: Session, user_id: int, doc: schemas.DocumentCreate, parsed_data, validation_status,
+                    content_hash, schema_version, source, source_analysis):
+    new_doc = database.EdiDocument(
+        **doc.model_dump(),
+        owner_id=user_id,
+        parsed_metadata=parsed_data,
+        validation_status=validation_status,
+        content_hash=content_hash,
+        schema_version=schema_version,
+        duplicate_of_id=source.id if source else None
+    )
+    db.add(new_doc)
+    
+    if source_analysis:
+        # анализ тем же промптом уже есть - очередь и LLM не нужны
+        new_doc.status = 'analyzed'
+        db.flush()
+        db.add(database.AnalysisResult(**_reused_analysis(source_analysis, new_doc.id)))
+    
+    db.commit()
+    db.refresh(new_doc)
+    
+    if source_analysis:
+        logger.info(f'Reused analysis {source_analysis.id} for document {new_doc.id}, task skipped')
+    else:
+        # отправка задачи в celery
+        analyze_document_task.delay(new_doc.id)
+        logger.info(f'Task sent to queue for document {new_doc.id}')
+        
+    return new_doc
+
+@app.post('/users/{user_id}/documents', response_model=schemas.DocumentResponse)
+async def upload_document(
+    user_id: int, 
+    doc: schemas.DocumentCreate, 
+    db: Session = Depends(get_db),
+    current_user: database.User = Depends(get_current_user)
+):
+    """
+    Загрузка документа для клиента.
+    Запросы к БД идут в пуле потоков, а разбор XML ожидается асинхронно.
+    """
+    # проверка доступа
+    await run_in_threadpool(_check_upload_access, user_id, current_user, db)
     
     # создание лога о загрузке документа
     logger.info(
@@ -112,57 +285,384 @@ def upload_document(
     )
     
     # попытка парсинга документа заданного типа
-    ## ищу схеу для этого типа документа
-    schema_db = db.query(database.ValidationSchema)\
-        .filter(database.ValidationSchema.name == doc.doc_type,
-                database.ValidationSchema.is_active == True)\
-        .first()
-    parsed_data = {}
-    validation_status = "pending"
-    validation_error_msg = None
-    
-    parser = EdiXmlParser()
-    
-    ## если схема есть - валидирую
-    ## документ даже с ошибкой будет загружен, чтобы в случае обнаружения ошибки скормить его ИИ
-    if schema_db:
-        is_valid, error = parser.validate_xsd(
-            doc.content_xml.encode('utf-8'),
-            schema_db.xsd_content
+    ## ищу схему для этого типа документа и повторную загрузку того же XML под той же схемой
+    schema_db, content_hash, schema_version, source, source_analysis = \
+        await run_in_threadpool(_find_upload_source, db, user_id, doc)
+    
+    if source:
+        ## беру готовые результаты
+        parsed_data = source.parsed_metadata
+        validation_status = source.validation_status
+        logger.info(f'Документ совпадает с ранее загруженным {source.id}, парсинг пропущен')
+    else:
+        ## XML разбирается один раз: если схема есть - дерево валидируется и по нему же извлекаются поля
+        ## документ даже с ошибкой будет загружен, чтобы в случае обнаружения ошибки скормить его ИИ
+        try:
+            result = await _validate_and_parse(doc.content_xml, schema_db)
+        except ParseQueueFull as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={'Retry-After': '1'})
+        except ParseTimeout as e:
+            raise HTTPException(status_code=504, detail=str(e))
+        parsed_data = result['parsed_metadata']
+        validation_status = result['validation_status']
+        if validation_status == 'schema_error':
+            logger.warning(f"Документ не прошел проверку по XSD: {result['validation_error']}")
+    
+    return await run_in_threadpool(
+        _store_document, db, user_id, doc, parsed_data, validation_status,
+        content_hash, schema_version, source, source_analysis
+    )
+
+def _prepare_batch(db: Session, user_id: int, documents: List[schemas.DocumentCreate], rejected: list):
+    """
+    Проверки и запросы к БД до разбора пакета: позиции документов, схемы по типам,
+    ключи дедупликации и ранее загруженные копии
+    """
+    if len(documents) + len(rejected) > BATCH_MAX_DOCUMENTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f'В пакете больше {BATCH_MAX_DOCUMENTS} документов.'
         )
-        if not is_valid:
-            validation_status = 'schema_error'
-            validation_error_msg = error
-            logger.warning(f'Документ не прошел проверку по XSD: {error}')
     
+    # позиции документов в исходном пакете (с учетом уже отклоненных элементов)
+    rejected_positions = {index for index, _, _ in rejected}
+    positions = [
+        index for index in range(len(documents) + len(rejected))
+        if index not in rejected_positions
+    ]
     
-    if validation_status != 'schema_error':
-        
+    # схемы ищу один раз на каждый тип документа в пакете
+    schemas_by_type = {
+        doc_type: _find_active_schema(db, doc_type)
+        for doc_type in {doc.doc_type for doc in documents}
+    }
+    
+    # ключи дедупликации и ранее загруженные копии - одним запросом на весь пакет
+    keys = []
+    for doc in documents:
+        schema_db = schemas_by_type[doc.doc_type]
+        keys.append((_content_hash(doc.content_xml), doc.doc_type, schema_db.version if schema_db else None))
+    duplicates = _find_duplicates(db, user_id, set(keys))
+    return positions, schemas_by_type, keys, duplicates
+
+async def _ingest_batch(db: Session, user_id: int, documents: List[schemas.DocumentCreate], rejected=None):
+    """
+    Пакетная загрузка: параллельная валидация и парсинг, одна bulk-вставка
+    и одна группа задач Celery на весь пакет.
+    rejected - список (позиция, имя файла, ошибка) для элементов, которые не удалось прочитать
+    """
+    rejected = list(rejected or [])
+    positions, schemas_by_type, keys, duplicates = await run_in_threadpool(_prepare_batch, db, user_id, documents, rejected)
+    
+    # lxml отпускает GIL при разборе и валидации, поэтому разбор в потоках дает реальный параллелизм;
+    # одновременно разбирается не больше BATCH_PARSE_WORKERS документов пакета
+    parse_slots = asyncio.Semaphore(BATCH_PARSE_WORKERS)
+    
+    async def process(doc, key):
+        if key in duplicates:
+            source = duplicates[key][0]
+            return {
+                'parsed_metadata': source.parsed_metadata,
+                'validation_status': source.validation_status,
+                'validation_error': (source.parsed_metadata or {}).get('validation_error')
+            }
         try:
-            parsed_data = parser.parse_invoice(doc.content_xml)
-            if parsed_data.get('validation_error'):
-                validation_status = 'math_error'
+            async with parse_slots:
+                # в пакете документ ждет место в очереди пула, а не отклоняется сразу
+                return await _validate_and_parse(doc.content_xml, schemas_by_type[doc.doc_type], block=True)
+        except (ParseQueueFull, ParseTimeout) as e:
+            return e
+    
+    results = await asyncio.gather(*(process(doc, key) for doc, key in zip(documents, keys)))
+    return await run_in_threadpool(_store_batch, db, user_id, positions, documents, keys, results, duplicates, rejected)
+
+def _store_batch(db: Session, user_id: int, positions, documents, keys, results, duplicates, rejected):
+    """
+    Одна bulk-вставка разобранных документов пакета и одна группа задач Celery
+    """
+    accepted = []
+    for index, doc, key, result in zip(positions, documents, keys, results):
+        if isinstance(result, Exception):
+            rejected.append((index, doc.filename, str(result)))
+        else:
+            accepted.append((index, doc, key, result))
+    
+    rows = []
+    for _, doc, key, result in accepted:
+        source, source_analysis = duplicates.get(key, (None, None))
+        rows.append({
+            'filename': doc.filename,
+            'doc_type': doc.doc_type,
+            # XML сразу пишется сжатым - bulk-вставка идет мимо свойства content_xml
+            **storage_columns(doc.content_xml),
+            'owner_id': user_id,
+            'parsed_metadata': result['parsed_metadata'],
+            'validation_status': result['validation_status'],
+            'content_hash': key[0],
+            'schema_version': key[2],
+            'duplicate_of_id': source.id if source else None,
+            'status': 'analyzed' if source_analysis else 'uploaded'
+        })
+    
+    doc_ids = []
+    if rows:
+        # одна INSERT ... RETURNING на весь пакет, id возвращаются в порядке строк
+        doc_ids = db.scalars(
+            insert(database.EdiDocument).returning(database.EdiDocument.id, sort_by_parameter_order=True),
+            rows
+        ).all()
+        
+        # для дубликатов с готовым анализом копирую ответ, остальные идут в очередь
+        reused_rows = []
+        queued_ids = []
+        for (_, _, key, _), doc_id in zip(accepted, doc_ids):
+            source_analysis = duplicates.get(key, (None, None))[1]
+            if source_analysis:
+                reused_rows.append(_reused_analysis(source_analysis, doc_id))
             else:
-                validation_status = 'valid'
-                
-        except ValueError:
-            validation_status = 'syntax_error'
+                queued_ids.append(doc_id)
+        if reused_rows:
+            db.execute(insert(database.AnalysisResult), reused_rows)
+        db.commit()
+        
+        # анализ всего пакета ставится в очередь одной группой
+        if queued_ids:
+            group(analyze_document_task.s(doc_id) for doc_id in queued_ids).apply_async()
+        logger.info('Batch sent to queue', extra={
+            'user_id': user_id,
+            'documents': len(doc_ids),
+            'queued': len(queued_ids),
+            'reused': len(reused_rows)
+        })
     
-    new_doc = database.EdiDocument(
-        **doc.model_dump(),
-        owner_id=user_id,
-        parsed_metadata=parsed_data,
-        validation_status=validation_status
+    items = [
+        schemas.DocumentBatchItem(
+            index=index,
+            filename=doc.filename,
+            document_id=doc_id,
+            validation_status=result['validation_status'],
+            error=result['validation_error']
+        )
+        for (index, doc, _, result), doc_id in zip(accepted, doc_ids)
+    ]
+    for index, filename, error in rejected:
+        items.append(schemas.DocumentBatchItem(
+            index=index,
+            filename=filename,
+            validation_status='rejected',
+            error=error
+        ))
+    items.sort(key=lambda item: item.index)
+    
+    return schemas.DocumentBatchResponse(
+        total=len(items),
+        accepted=len(doc_ids),
+        items=items
     )
-    db.add(new_doc)
-    db.commit()
-    db.refresh(new_doc)
+
+@app.post('/users/{user_id}/documents/batch', response_model=schemas.DocumentBatchResponse)
+async def upload_documents_batch(
+    user_id: int,
+    batch: schemas.DocumentBatchCreate,
+    db: Session = Depends(get_db),
+    current_user: database.User = Depends(get_current_user)
+):
+    """
+    Пакетная загрузка списка документов для клиента
+    """
+    await run_in_threadpool(_check_upload_access, user_id, current_user, db)
+    logger.info('Received batch upload request', extra={'user_id': user_id, 'documents': len(batch.documents)})
+    return await _ingest_batch(db, user_id, batch.documents)
+
+def _read_zip_documents(body: bytes, doc_type: str):
+    """
+    Документы из zip-архива: (документы, отклоненные файлы, число файлов).
+    Число файлов и их размер после распаковки (из заголовков архива) проверяются до распаковки:
+    zip-бомба или архив из множества файлов отклоняются, не занимая память.
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(body))
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail='Тело запроса не является zip-архивом.')
     
-    # отправка задачи в celery
-    analyze_document_task.delay(new_doc.id)
-    logger.info(f'Task sent to queue for document {new_doc.id}')
-        
-    return new_doc
+    entries = [info for info in archive.infolist() if not info.is_dir()]
+    if len(entries) > BATCH_MAX_DOCUMENTS:
+        raise HTTPException(status_code=413, detail=f'В пакете больше {BATCH_MAX_DOCUMENTS} документов.')
+    # zipfile не распаковывает больше file_size из заголовка, поэтому сумма - верхняя граница
+    if sum(info.file_size for info in entries) > BATCH_ZIP_MAX_UNCOMPRESSED_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f'Файлы архива после распаковки больше {BATCH_ZIP_MAX_UNCOMPRESSED_BYTES} байт.'
+        )
+    
+    documents = []
+    rejected = []
+    for index, info in enumerate(entries):
+        try:
+            content = archive.read(info).decode('utf-8-sig')
+        except UnicodeDecodeError as e:
+            rejected.append((index, info.filename, f'Файл не в кодировке UTF-8: {e}'))
+            continue
+        except (zipfile.BadZipFile, RuntimeError, NotImplementedError, zlib.error) as e:
+            # поврежденный (Bad CRC-32), зашифрованный или сжатый неподдерживаемым методом файл
+            # отклоняется сам по себе, остальные файлы архива загружаются
+            rejected.append((index, info.filename, f'Файл архива не читается: {e}'))
+            continue
+        documents.append(schemas.DocumentCreate(
+            filename=info.filename,
+            doc_type=doc_type,
+            content_xml=content
+        ))
+    return documents, rejected, len(entries)
+
+@app.post('/users/{user_id}/documents/batch/zip', response_model=schemas.DocumentBatchResponse)
+async def upload_documents_zip(
+    user_id: int,
+    request: Request,
+    doc_type: str = 'Invoice',
+    db: Session = Depends(get_db),
+    current_user: database.User = Depends(get_current_user)
+):
+    """
+    Пакетная загрузка zip-архива с XML-документами (тело запроса - сам архив).
+    Все файлы архива загружаются с типом doc_type.
+    """
+    await run_in_threadpool(_check_upload_access, user_id, current_user, db)
+    
+    # тело читается частями: слишком большой архив отклоняется, не дочитываясь в память
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > BATCH_ZIP_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f'Архив больше {BATCH_ZIP_MAX_BYTES} байт.')
+    # распаковка - синхронная работа, выношу ее из event loop
+    documents, rejected, entries = await run_in_threadpool(_read_zip_documents, bytes(body), doc_type)
+    
+    logger.info('Received zip batch upload request', extra={'user_id': user_id, 'documents': entries})
+    return await _ingest_batch(db, user_id, documents, rejected)
+
+
+def _get_owned_document(db: Session, doc_id: int, current_user: database.User):
+    """
+    Документ, доступный пользователю: свой или любой для администратора
+    """
+    doc = db.query(database.EdiDocument).filter(database.EdiDocument.id == doc_id).first()
+    if doc is None:
+        raise HTTPException(status_code=404, detail='Документ с таким ID не найден.')
+    if doc.owner_id != current_user.id and current_user.role != 'admin':
+        raise HTTPException(
+            status_code=403,
+            detail="Not enough permissions to access this user's data"
+        )
+    return doc
+
+@app.get('/documents/{doc_id}/xml')
+def get_document_xml(
+    doc_id: int,
+    db: Session = Depends(get_db),
+    current_user: database.User = Depends(get_current_user)
+):
+    """
+    Исходный XML документа (распаковывается только здесь)
+    """
+    doc = _get_owned_document(db, doc_id, current_user)
+    return Response(content=doc.content_xml, media_type='application/xml')
+
+def _latest_analysis(db: Session, doc_id: int):
+    return db.query(database.AnalysisResult)\
+        .filter(database.AnalysisResult.document_id == doc_id)\
+        .order_by(database.AnalysisResult.id.desc())\
+        .first()
+
+def _analysis_response(result: database.AnalysisResult) -> dict:
+    return {
+        'id': result.id,
+        'document_id': result.document_id,
+        'analysis': json.loads(result.ai_response_json) if result.ai_response_json else None,
+        'prompt_name': result.prompt_name,
+        'prompt_version': result.prompt_version,
+        'reused_from_id': result.reused_from_id,
+        'is_helpful': result.is_helpful,
+        'created_at': result.created_at
+    }
+
+@app.get('/documents/{doc_id}/analysis', response_model=schemas.AnalysisResultResponse)
+def get_document_analysis(
+    doc_id: int,
+    db: Session = Depends(get_db),
+    current_user: database.User = Depends(get_current_user)
+):
+    """
+    Последний результат анализа документа
+    """
+    _get_owned_document(db, doc_id, current_user)
+    result = _latest_analysis(db, doc_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail='Анализ документа еще не готов.')
+    return _analysis_response(result)
+
+def _final_analysis_event(doc_id: int):
+    # своя сессия: поток событий живет дольше запроса и его зависимостей
+    db = database.SessionLocal()
+    try:
+        result = _latest_analysis(db, doc_id)
+        if result is not None:
+            return analysis_stream.EVENT_DONE, {'analysis_id': result.id, 'analysis': _analysis_response(result)['analysis']}
+        doc = db.query(database.EdiDocument).options(load_only(database.EdiDocument.status))\
+            .filter(database.EdiDocument.id == doc_id).first()
+        if doc is not None and doc.status == 'analysis_failed':
+            return analysis_stream.EVENT_ERROR, {'detail': 'Анализ документа завершился ошибкой'}
+        return None
+    finally:
+        db.close()
+
+@app.get('/documents/{doc_id}/analysis/stream')
+def stream_document_analysis(
+    doc_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: database.User = Depends(get_current_user)
+):
+    """
+    Ход анализа документа через Server-Sent Events: status - документ взят в работу
+    или ответ пересчитывается большой моделью, token - новая часть ответа модели (delta с позиции offset),
+    done - итоговый JSON, error - сбой. Уже проанализированный документ сразу получает done,
+    документ со сбоем анализа - error.
+    """
+    doc = _get_owned_document(db, doc_id, current_user)
+    if doc.doc_type != 'Invoice':
+        raise HTTPException(status_code=404, detail='Анализируются только накладные (Invoice).')
+    
+    async def load_final():
+        return await run_in_threadpool(_final_analysis_event, doc_id)
+    
+    return StreamingResponse(
+        analysis_stream.relay(doc_id, load_final, request.is_disconnected),
+        media_type='text/event-stream',
+        # прокси (nginx) не должен копить ответ в буфере
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.get('/documents/dedup/stats')
+def get_dedup_stats(db: Session = Depends(get_db)):
+    """
+    Сколько загрузок оказались повторами и сколько анализов LLM удалось не выполнять
+    """
+    documents_total = db.query(func.count(database.EdiDocument.id)).scalar()
+    duplicate_uploads = db.query(func.count(database.EdiDocument.id))\
+        .filter(database.EdiDocument.duplicate_of_id.isnot(None))\
+        .scalar()
+    analyses_total = db.query(func.count(database.AnalysisResult.id)).scalar()
+    analyses_reused = db.query(func.count(database.AnalysisResult.id))\
+        .filter(database.AnalysisResult.reused_from_id.isnot(None))\
+        .scalar()
+    return {
+        'documents_total': documents_total,
+        'duplicate_uploads': duplicate_uploads,
+        'analyses_total': analyses_total,
+        'analyses_reused': analyses_reused,
+        'inference_avoided_ratio': round(analyses_reused / analyses_total, 4) if analyses_total else 0.0
+    }
 
 
 # --- Knowledge Base API ---
@@ -179,13 +679,46 @@ def create_rule(rule: schemas.RuleCreate, db: Session = Depends(get_db)):
         topic=rule.topic,
         rule_text=rule.rule_text,
         status='approved',   # сразу утверждаю для простоты !НАДО ДОБАВИТЬ СИСТЕМУ ПРОВЕРКИ
-        embedding=vector
+        embedding=vector,
+        rule_hash=rule_hash(rule.rule_text)
     )
     db.add(new_rule)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # правило с тем же текстом уже добавлено (в том числе параллельным импортом)
+        db.rollback()
+        raise HTTPException(status_code=409, detail='Правило с таким текстом уже есть в базе знаний.')
     db.refresh(new_rule)
+    # воркеры догрузят правило в индекс в памяти
+    bump_knowledge_version()
     return new_rule
 
+@app.post('/knowledge/import', response_model=schemas.KnowledgeImportResponse)
+async def import_knowledge(
+    request: Request,
+    file_format: str = Query('json', alias='format'),
+    rule_status: str = Query('approved', alias='status'),
+    batch_size: int = KNOWLEDGE_IMPORT_BATCH_SIZE,
+    db: Session = Depends(get_db)
+):
+    """
+    Массовая загрузка правил (тело запроса - JSON-список или CSV с полями topic, rule_text, status;
+    format - json или csv).
+    Правила с уже загруженным текстом пропускаются без векторизации.
+    """
+    if rule_status not in RULE_STATUSES:
+        raise HTTPException(status_code=400, detail=f'Неизвестный статус правил: {rule_status}')
+    try:
+        rules = parse_rules(await request.body(), file_format)
+    except (ValueError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f'Файл правил не разобран: {e}')
+    if batch_size < 1:
+        raise HTTPException(status_code=400, detail='batch_size должен быть больше нуля.')
+    
+    # векторизация и запись в БД - синхронная работа, выношу ее из event loop
+    return await run_in_threadpool(import_rules, db, rules, batch_size, rule_status)
+
 @app.get('/knowledge/', response_model=List[schemas.RuleResponse])
 def get_rules(db: Session = Depends(get_db)):
     """
@@ -289,8 +822,18 @@ def create_schema(schema: schemas.ValidationSchemaCreate, db: Session = Depends(
     db.add(new_schema)
     db.commit()
     db.refresh(new_schema)
+    
+    # скомпилированные старые версии схемы больше не нужны
+    schema_cache.invalidate(schema.name)
     return new_schema
 
+@app.get('/schemas/cache/stats')
+def get_schema_cache_stats():
+    """
+    Счетчики кэша скомпилированных XSD-схем (попадания, промахи, вытеснения)
+    """
+    return schema_cache.stats()
+
 @app.get('/schemas/{name}', response_model=schemas.ValidationSchemaResponse)
 def get_active_schema(name: str, db: Session = Depends(get_db)):
     schema = db.query(database.ValidationSchema)\
@@ -299,4 +842,34 @@ def get_active_schema(name: str, db: Session = Depends(get_db)):
         .first()
     if not schema:
         raise HTTPException(status_code=404, detail='XSD-схема с данным именем не найдена.')
-    return schema
\ No newline at end of file
+    return schema
+
+# --- Metrics API ---
+@app.get('/health/llm')
+def llm_readiness():
+    """
+    Готовность воркеров: модель загружена и прогрета. 503, пока нет ни одного готового воркера
+    """
+    try:
+        workers = metrics.ready_processes()
+    except redis.RedisError as e:
+        logger.warning(f'Готовность воркеров недоступна: {e}')
+        raise HTTPException(status_code=503, detail='Состояние воркеров недоступно')
+    if not workers:
+        raise HTTPException(status_code=503, detail='Нет воркеров с прогретой моделью')
+    return {'ready': True, 'workers': workers}
+
+@app.get('/metrics')
+def get_metrics():
+    """
+    Общие счетчики воркеров, сводка по кэшам ответов LLM и векторов, по разбору ошибок правилами
+    и по выбору модели (маленькая / большая)
+    """
+    counters = metrics.snapshot()
+    return {
+        'counters': counters,
+        'llm_cache': cache_stats(counters),
+        'embedding_cache': embedding_cache_stats(counters),
+        'fast_path': resolver_stats(counters),
+        'routing': routing_summary(counters)
+    }
@@ -33,11 +33,24 @@ def start_services():
     
     # запуск celery worker
     print(f"{YELLOW}[2/4] Запуск ИИ-помощника...{RESET}")
+    # в режиме server модель держит отдельный процесс, воркеры легкие и их может быть много;
+    # с батчингом задачи выполняются в потоках и ждут общий батч, без него - по одной
+    if os.getenv('LLM_INFERENCE_MODE', 'local') == 'server':
+        print(f"{YELLOW}      Запуск сервера инференса...{RESET}")
+        if sys.platform == 'win32':
+            subprocess.run('start "LLM Server" cmd /k "python inference_server.py"', shell=True)
+        else:
+            subprocess.Popen('python inference_server.py', shell=True)
+        pool = f"--pool=prefork --concurrency={os.getenv('CELERY_CONCURRENCY', str(os.cpu_count() or 4))}"
+    elif os.getenv('LLM_BATCHING_ENABLED', '1') == '1':
+        pool = f"--pool=threads --concurrency={os.getenv('LLM_MAX_BATCH_SIZE', '8')}"
+    else:
+        pool = '--pool=solo'
     if sys.platform == 'win32':
-        worker_cmd = 'start "Celery Worker" cmd /k "celery -A tasks worker --loglevel=info --pool=solo"'
+        worker_cmd = f'start "Celery Worker" cmd /k "celery -A tasks worker --loglevel=info {pool}"'
         subprocess.run(worker_cmd, shell=True)
     else:
-        subprocess.Popen("celery -A tasks worker --loglevel=info --pool=solo")
+        subprocess.Popen(f"celery -A tasks worker --loglevel=info {pool}", shell=True)
     
     # запуск frontend
     print(f"{YELLOW}[3/4] Starting UI...{RESET}")
@@ -77,9 +90,17 @@ def reset_db():
     print(f'{YELLOW}Наполняю таблицы начальным набором данных... {RESET}')
     subprocess.run("python seed.py", shell=True)
 
+def compress_documents():
+    print(f'{YELLOW}Сжимаю XML ранее загруженных документов...{RESET}')
+    subprocess.run('python backfill_xml_storage.py', shell=True)
+
+def dedupe_rules():
+    print(f'{YELLOW}Удаляю повторяющиеся правила базы знаний...{RESET}')
+    subprocess.run('python dedupe_rules.py', shell=True)
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        print('Использование: python manage.py [start|stop|migrate|reset]')
+        print('Использование: python manage.py [start|stop|migrate|reset|compress|dedupe-rules]')
         sys.exit(1)
     
     command = sys.argv[1]
@@ -91,5 +112,9 @@ if __name__ == '__main__':
         run_migrations()
     elif command == 'reset':
         reset_db()
+    elif command == 'compress':
+        compress_documents()
+    elif command == 'dedupe-rules':
+        dedupe_rules()
     else:
         print(f'{RED}Неизвестная команда.{RESET}')
\ No newline at end of file
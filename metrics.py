@@ -0,0 +1,104 @@
+# общие счетчики системы в Redis: их пишут воркеры, а читает API
+import json
+import os
+import socket
+import threading
+import time
+import redis
+from celery_app import REDIS_URL
+from logger_config import logger
+
+# все счетчики лежат в одном hash
+METRICS_KEY = 'edi:metrics'
+
+_client = None
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(REDIS_URL, socket_timeout=1)
+    return _client
+
+def incr(name: str, amount: int = 1):
+    """
+    Увеличение счетчика. Недоступный Redis не должен ломать обработку документа.
+    """
+    try:
+        get_redis().hincrby(METRICS_KEY, name, amount)
+    except redis.RedisError as e:
+        logger.debug(f'Не удалось обновить метрику {name}: {e}')
+
+def snapshot():
+    """
+    Текущие значения всех счетчиков
+    """
+    try:
+        raw = get_redis().hgetall(METRICS_KEY)
+    except redis.RedisError as e:
+        logger.warning(f'Метрики недоступны: {e}')
+        return {}
+    return {key.decode('utf-8'): int(value) for key, value in raw.items()}
+
+def ratio(part: int, total: int) -> float:
+    return round(part / total, 4) if total else 0.0
+
+# процессы, в которых модель загружена и прогрета: поле - имя процесса, значение - JSON со сведениями
+READY_KEY = 'edi:llm_workers_ready'
+# процесс считается готовым, пока обновляет свою запись: упавший или убитый воркер
+# перестает быть готовым через LLM_READY_TTL_SECONDS
+LLM_READY_TTL_SECONDS = float(os.getenv('LLM_READY_TTL_SECONDS', '60'))
+# как часто живой процесс обновляет запись готовности
+LLM_READY_HEARTBEAT_SECONDS = float(os.getenv('LLM_READY_HEARTBEAT_SECONDS', '20'))
+
+_heartbeat_stop = threading.Event()
+
+def process_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def mark_ready(name: str, info: dict):
+    """
+    Сигнал готовности процесса с моделью для API (/health/llm)
+    """
+    try:
+        get_redis().hset(READY_KEY, name, json.dumps({**info, 'ready_at': time.time()}))
+    except redis.RedisError as e:
+        logger.warning(f'Не удалось записать готовность {name}: {e}')
+
+def start_heartbeat(name: str, info: dict, interval: float = LLM_READY_HEARTBEAT_SECONDS):
+    """
+    Готовность процесса с периодическим обновлением в фоновом потоке (до mark_stopped)
+    """
+    mark_ready(name, info)
+    _heartbeat_stop.clear()
+
+    def beat():
+        while not _heartbeat_stop.wait(interval):
+            mark_ready(name, info)
+
+    threading.Thread(target=beat, name='llm-ready-heartbeat', daemon=True).start()
+
+def mark_stopped(name: str):
+    _heartbeat_stop.set()
+    try:
+        get_redis().hdel(READY_KEY, name)
+    except redis.RedisError as e:
+        logger.warning(f'Не удалось снять готовность {name}: {e}')
+
+def ready_processes(ttl: float = LLM_READY_TTL_SECONDS):
+    """
+    Готовые процессы. Записи, не обновлявшиеся дольше ttl, удаляются.
+    Недоступный Redis - исключение: API отвечает 503
+    """
+    client = get_redis()
+    now = time.time()
+    ready = {}
+    stale = []
+    for name, raw in client.hgetall(READY_KEY).items():
+        info = json.loads(raw)
+        if now - info.get('ready_at', 0) > ttl:
+            stale.append(name)
+        else:
+            ready[name.decode('utf-8')] = info
+    if stale:
+        client.hdel(READY_KEY, *stale)
+    return ready
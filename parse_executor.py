@@ -0,0 +1,171 @@
+# выполнение CPU-тяжелой валидации и парсинга XML вне пула потоков API
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from xml_parser import EdiXmlParser
+from logger_config import logger
+
+# режим выполнения: thread - в потоке обработчика запроса (как раньше), process - в пуле процессов
+PARSE_EXECUTION_MODE = os.getenv('PARSE_EXECUTION_MODE', 'thread')
+# число процессов пула (по умолчанию - все ядра)
+PARSE_PROCESS_WORKERS = int(os.getenv('PARSE_PROCESS_WORKERS', str(os.cpu_count() or 2)))
+# сколько документов одновременно может находиться в пуле (в работе и в ожидании)
+PARSE_QUEUE_SIZE = int(os.getenv('PARSE_QUEUE_SIZE', str(PARSE_PROCESS_WORKERS * 2)))
+# предельное время обработки одного документа
+PARSE_TIMEOUT_SECONDS = float(os.getenv('PARSE_TIMEOUT_SECONDS', '30'))
+# документы меньше этого размера дешевле разобрать на месте, чем пересылать в другой процесс
+PARSE_PROCESS_MIN_BYTES = int(os.getenv('PARSE_PROCESS_MIN_BYTES', str(256 * 1024)))
+# способ запуска процессов пула: fork из многопоточного процесса API копирует захваченные
+# другими потоками блокировки (логгер, пул соединений БД), поэтому по умолчанию spawn
+PARSE_PROCESS_START_METHOD = os.getenv('PARSE_PROCESS_START_METHOD', 'spawn')
+# как часто асинхронный обработчик пакета проверяет, не освободилось ли место в очереди
+PARSE_QUEUE_POLL_SECONDS = float(os.getenv('PARSE_QUEUE_POLL_SECONDS', '0.01'))
+
+class ParseQueueFull(Exception):
+    """
+    В пуле процессов нет свободного места - документ не принят в обработку
+    """
+
+class ParseTimeout(Exception):
+    """
+    Документ не успел обработаться за PARSE_TIMEOUT_SECONDS
+    """
+
+def validate_and_parse(content_xml, xsd_content: str = None, schema_key=None):
+    """
+    XSD-валидация и парсинг документа за один разбор XML.
+    Функция уровня модуля - ее можно передать в дочерний процесс.
+    У каждого процесса пула свой кэш скомпилированных схем.
+    """
+    return EdiXmlParser().parse_document(
+        content_xml,
+        xsd_content=xsd_content,
+        schema_key=schema_key
+    )
+
+class ParseExecutor:
+    """
+    Исполнитель шага "валидация + парсинг".
+    В режиме process крупные документы уходят в пул процессов: lxml и извлечение полей
+    не держат GIL процесса API, и легкие запросы (авторизация, чтение) не ждут.
+    Очередь ограничена PARSE_QUEUE_SIZE, на каждый документ действует таймаут.
+    """
+    def __init__(
+        self,
+        mode: str = PARSE_EXECUTION_MODE,
+        workers: int = PARSE_PROCESS_WORKERS,
+        queue_size: int = PARSE_QUEUE_SIZE,
+        timeout: float = PARSE_TIMEOUT_SECONDS,
+        min_bytes: int = PARSE_PROCESS_MIN_BYTES,
+        start_method: str = PARSE_PROCESS_START_METHOD
+    ):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f'Неизвестный режим парсинга: {mode}')
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.min_bytes = min_bytes
+        self.start_method = start_method
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        # пул создается при первом крупном документе, а не при импорте модуля
+        with self._pool_lock:
+            if self._pool is None:
+                logger.info('Запускаю пул процессов парсинга', extra={'workers': self.workers})
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.start_method)
+                )
+            return self._pool
+
+    def _in_process(self, content_xml) -> bool:
+        if self.mode != 'process':
+            return False
+        # min_bytes - размер в байтах UTF-8: символ строки занимает от 1 до 4 байт,
+        # поэтому кодировать приходится только строки, длина которых не решает вопрос сама
+        if isinstance(content_xml, str) and len(content_xml) < self.min_bytes <= len(content_xml) * 4:
+            return len(content_xml.encode('utf-8')) >= self.min_bytes
+        return len(content_xml) >= self.min_bytes
+
+    def _submit(self, content_xml, xsd_content, schema_key):
+        try:
+            future = self._get_pool().submit(validate_and_parse, content_xml, xsd_content, schema_key)
+        except Exception:
+            self._slots.release()
+            raise
+        # место в очереди освобождается, только когда процесс действительно закончил работу
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    async def _acquire_async(self) -> bool:
+        """
+        Ожидание места в очереди не дольше таймаута без отдельного потока.
+        Место захватывается только неблокирующим acquire в самом обработчике: если запрос
+        отменят во время ожидания, захваченного и никем не освобожденного места не останется.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while not self._slots.acquire(blocking=False):
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(PARSE_QUEUE_POLL_SECONDS)
+        return True
+
+    def _timed_out(self, future):
+        # запущенную задачу пул прервать не может - снимаю ее, если она еще не началась
+        future.cancel()
+        logger.warning('Превышено время парсинга документа', extra={'timeout': self.timeout})
+        return ParseTimeout(f'Документ не обработан за {self.timeout} с.')
+
+    def run(self, content_xml, xsd_content: str = None, schema_key=None, block: bool = False):
+        """
+        Обработка одного документа.
+        block=False - при заполненной очереди сразу ParseQueueFull (одиночная загрузка),
+        block=True - ждать свободное место не дольше таймаута (пакетная загрузка).
+        """
+        if not self._in_process(content_xml):
+            return validate_and_parse(content_xml, xsd_content, schema_key)
+
+        acquired = self._slots.acquire(timeout=self.timeout) if block else self._slots.acquire(blocking=False)
+        if not acquired:
+            raise ParseQueueFull('Очередь парсинга заполнена, повторите запрос позже.')
+
+        future = self._submit(content_xml, xsd_content, schema_key)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise self._timed_out(future)
+
+    async def run_async(self, content_xml, xsd_content: str = None, schema_key=None, block: bool = False):
+        """
+        То же, что run, для асинхронных обработчиков: ожидание результата пула процессов
+        не занимает поток - число одновременных загрузок не ограничено пулом потоков Starlette.
+        В режиме thread (и для небольших документов) разбор идет в потоке пула asyncio.
+        """
+        if not self._in_process(content_xml):
+            return await asyncio.to_thread(validate_and_parse, content_xml, xsd_content, schema_key)
+
+        acquired = await self._acquire_async() if block else self._slots.acquire(blocking=False)
+        if not acquired:
+            raise ParseQueueFull('Очередь парсинга заполнена, повторите запрос позже.')
+
+        future = self._submit(content_xml, xsd_content, schema_key)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out(future)
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+# глобальный исполнитель процесса API
+parse_executor = ParseExecutor()
@@ -0,0 +1,82 @@
+# сборка промпта анализа в бюджет контекстного окна модели
+# промпт + max_tokens ответа должны поместиться в n_ctx: текст ошибки обрезается,
+# правила берутся по порядку релевантности (как их вернул поиск), пока хватает места
+from collections import OrderedDict
+import os
+import re
+from logger_config import logger
+
+# потолок длины текста ошибки в токенах: длинные сообщения XSD дальше не несут новой информации
+LLM_ERROR_TEXT_MAX_TOKENS = int(os.getenv('LLM_ERROR_TEXT_MAX_TOKENS', '512'))
+# запас на BOS и расхождение токенизации на стыках фрагментов промпта
+LLM_PROMPT_RESERVE_TOKENS = int(os.getenv('LLM_PROMPT_RESERVE_TOKENS', '32'))
+# сколько посчитанных длин правил (в токенах) держать в памяти
+LLM_TOKEN_COUNT_CACHE_SIZE = int(os.getenv('LLM_TOKEN_COUNT_CACHE_SIZE', '4096'))
+
+# метка обрезанного текста ошибки
+TRUNCATED_MARK = ' [...]'
+
+class PromptAssembler:
+    """
+    Рендер шаблона с подгонкой error_text и context_rules под бюджет токенов.
+    Токены считает токенизатор модели бэкенда; длины правил кэшируются,
+    потому что одни и те же правила приходят в промпт снова и снова.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self._rule_tokens = OrderedDict()
+
+    def rule_tokens(self, rule: str) -> int:
+        count = self._rule_tokens.get(rule)
+        if count is not None:
+            self._rule_tokens.move_to_end(rule)
+            return count
+        # +1 - перевод строки между правилами
+        count = self.backend.count_tokens(rule) + 1
+        self._rule_tokens[rule] = count
+        while len(self._rule_tokens) > LLM_TOKEN_COUNT_CACHE_SIZE:
+            self._rule_tokens.popitem(last=False)
+        return count
+
+    def assemble(self, template, request: dict, max_tokens: int):
+        """
+        (промпт, число токенов промпта). Правила в request['rules'] - строки "- текст",
+        самые релевантные первыми; не поместившиеся в бюджет пропускаются.
+        """
+        values = {'doc_id': request['doc_id'], 'doc_type': request['doc_type']}
+        budget = self.backend.n_ctx - max_tokens - LLM_PROMPT_RESERVE_TOKENS
+        # шаблон без переменных частей: системный блок, инструкции, формат ответа
+        budget -= self.backend.count_tokens(template.render(error_text='', context_rules='', **values))
+
+        # правило из базы может быть многострочным - граница правил только перед "- "
+        rules = [rule for rule in re.split(r'\n(?=- )', request['rules']) if rule.strip()]
+        rules_tokens = sum(self.rule_tokens(rule) for rule in rules)
+        
+        # текст ошибки занимает место, оставшееся от правил, но не меньше половины бюджета
+        error_text = request['error_text']
+        error_tokens = self.backend.count_tokens(error_text)
+        error_budget = min(LLM_ERROR_TEXT_MAX_TOKENS, max(budget - rules_tokens, budget // 2))
+        if error_tokens > error_budget:
+            keep = error_budget - self.backend.count_tokens(TRUNCATED_MARK)
+            error_text = self.backend.truncate(error_text, keep) + TRUNCATED_MARK
+            logger.info(f'Документ {request["doc_id"]}: текст ошибки обрезан с {error_tokens} до {error_budget} токенов')
+            error_tokens = error_budget
+        budget -= error_tokens
+
+        selected = []
+        for rule in rules:
+            count = self.rule_tokens(rule)
+            # длинное правило пропускается, более короткие менее релевантные еще могут поместиться
+            if count <= budget:
+                selected.append(rule)
+                budget -= count
+        if len(selected) < len(rules):
+            logger.info(f'Документ {request["doc_id"]}: в промпт вошло правил {len(selected)} из {len(rules)}')
+
+        prompt = template.render(error_text=error_text, context_rules='\n'.join(selected), **values)
+        # +1 - BOS, который llama.cpp добавляет перед промптом
+        prompt_tokens = self.backend.count_tokens(prompt) + 1
+        if prompt_tokens + max_tokens > self.backend.n_ctx:
+            logger.warning(f'Документ {request["doc_id"]}: промпт {prompt_tokens} токенов + ответ {max_tokens} '
+                           f'не помещаются в контекст {self.backend.n_ctx}')
+        return prompt, prompt_tokens
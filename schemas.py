@@ -21,9 +21,13 @@ class UserCreate(UserBase):
     department: Optional[str] = None
 
 # схемы для чтения того, что я буду отдавать клиенту
-class DocumentResponse(DocumentBase):
+# сам XML в ответ не входит - он отдается отдельным запросом /documents/{id}/xml
+class DocumentResponse(BaseModel):
+    filename: str
+    doc_type: str
     id: int
     status: str
+    validation_status: Optional[str] = None
     created_at: datetime
     owner_id: int
     
@@ -40,6 +44,22 @@ class UserResponse(UserBase):
     class Config:
         from_attributes = True
 
+# схемы для пакетной загрузки документов
+class DocumentBatchCreate(BaseModel):
+    documents: List[DocumentCreate]
+
+class DocumentBatchItem(BaseModel):
+    index: int  # позиция документа в пакете
+    filename: str
+    document_id: Optional[int] = None  # None - документ не принят
+    validation_status: str
+    error: Optional[str] = None
+
+class DocumentBatchResponse(BaseModel):
+    total: int
+    accepted: int
+    items: List[DocumentBatchItem]
+
 # схемы для создания правил базы знаний
 class RuleCreate(BaseModel):
     topic: str
@@ -53,6 +73,25 @@ class RuleResponse(RuleCreate):
     class Config:
         from_attributes = True
 
+# сводка массовой загрузки правил
+class KnowledgeImportResponse(BaseModel):
+    total: int
+    imported: int
+    skipped: int  # текст правила уже был в базе
+    duplicates_in_file: int
+    seconds: float
+
+# результат анализа документа
+class AnalysisResultResponse(BaseModel):
+    id: int
+    document_id: int
+    analysis: Optional[Dict[str, Any]] = None  # JSON-ответ ИИ
+    prompt_name: Optional[str] = None
+    prompt_version: Optional[int] = None
+    reused_from_id: Optional[int] = None
+    is_helpful: Optional[bool] = None
+    created_at: datetime
+
 # схема для настройки Loop Feedback
 class FeedbackCreate(BaseModel):
     is_helpful: bool
@@ -101,4 +140,18 @@ class ValidationSchemaResponse(ValidationSchemaCreate):
     is_active: bool
     
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+# схемы локального сервера инференса
+class AnalysisRequest(BaseModel):
+    doc_id: str
+    doc_type: str
+    error_text: str
+    rules: str
+    template_text: str
+    template_key: Optional[str] = None  # "id:версия" промпта для кэша шаблонов
+    error_category: Optional[str] = None  # статус валидации документа для выбора модели
+    stream: bool = False  # публиковать частичный ответ в канал документа в Redis
+    generation_config: Optional[Dict[str, Any]] = None
+
+class AnalysisResponse(BaseModel):
+    analysis: str  # JSON-ответ модели строкой
@@ -1,13 +1,32 @@
 # код для выполнения воркером
 #
 
-from celery_app import celery_app
-from database import SessionLocal, EdiDocument, KnowledgeBaseItem, AnalysisResult, PromptTemplate
+import os
+from celery.signals import worker_init, worker_process_init, worker_shutdown, worker_process_shutdown
+from celery_app import celery_app, CELERY_WORKER_PROC_ALIVE_TIMEOUT
+from database import SessionLocal, EdiDocument, AnalysisResult, PromptTemplate
 from llm_engine import LLMEngine
+from llm_batcher import InferenceBatcher, LLM_BATCHING_ENABLED
+from llm_client import inference_client, InferenceServerError, LLM_SERVER_URL
+from error_resolver import resolver, RESOLVER_ENABLED
+import analysis_stream
 from logger_config import logger
 from embeddings import embedder
+from embedding_cache import retrieval_query
+from knowledge_search import search_rules
 from sqlalchemy import text
 import json
+import metrics
+
+# имя промпта, которым анализируются накладные
+ANALYSIS_PROMPT_NAME = 'analyze_invoice'
+
+# прогрев модели при старте воркера (0 - модель загружается первой задачей)
+LLM_WARMUP_ENABLED = os.getenv('LLM_WARMUP_ENABLED', '1') == '1'
+# где выполняется модель: local - в процессе воркера, server - в общем сервере инференса
+LLM_INFERENCE_MODE = os.getenv('LLM_INFERENCE_MODE', 'local')
+# сколько воркер ждет готовности сервера инференса при старте
+LLM_SERVER_WAIT_SECONDS = int(os.getenv('LLM_SERVER_WAIT_SECONDS', '300'))
 
 # инициализация движка языковой модели - загрузка при старте воркера
 llm_engine = None
@@ -18,6 +37,93 @@ def get_llm():
         llm_engine = LLMEngine()
     return llm_engine
 
+def warm_up_model():
+    """
+    Загрузка и прогрев модели до того, как воркер начнет брать задачи из очереди.
+    Ошибка загрузки останавливает воркер: без модели задачи все равно упадут.
+    В режиме server модель держит сервер инференса - воркер только ждет его готовности.
+    """
+    # модель векторизации нужна для поиска правил в каждой задаче - грузится до первой из них
+    embedder.load()
+    if LLM_INFERENCE_MODE == 'server':
+        if not inference_client.wait_ready(LLM_SERVER_WAIT_SECONDS):
+            raise InferenceServerError(f'Сервер инференса {LLM_SERVER_URL} не готов')
+        logger.info(f'Воркер: сервер инференса {LLM_SERVER_URL} готов')
+        return
+    
+    engine = get_llm()
+    warmup_seconds = engine.warm_up()
+    logger.info(
+        f'Воркер: модель {engine.model_id} загружена за {engine.load_seconds:.1f} с, '
+        f'прогрета за {warmup_seconds:.1f} с'
+    )
+    # сигнал готовности для API, обновляется, пока процесс жив
+    metrics.start_heartbeat(metrics.process_name(), {
+        'model': engine.model_id,
+        'load_seconds': round(engine.load_seconds, 2),
+        'warmup_seconds': round(warmup_seconds, 2),
+        'embedding_load_seconds': round(embedder.load_seconds, 2)
+    })
+
+@worker_process_init.connect
+def on_worker_process_init(**kwargs):
+    # пул prefork: каждый дочерний процесс загружает свою модель до получения задач;
+    # хук должен уложиться в worker_proc_alive_timeout (celery_app), иначе процесс перезапускается
+    if LLM_WARMUP_ENABLED:
+        if LLM_INFERENCE_MODE == 'server' and LLM_SERVER_WAIT_SECONDS >= CELERY_WORKER_PROC_ALIVE_TIMEOUT:
+            logger.warning(
+                f'LLM_SERVER_WAIT_SECONDS={LLM_SERVER_WAIT_SECONDS} не меньше '
+                f'CELERY_WORKER_PROC_ALIVE_TIMEOUT={CELERY_WORKER_PROC_ALIVE_TIMEOUT}: '
+                f'процесс пула будет убит раньше, чем дождется сервера инференса'
+            )
+        warm_up_model()
+
+@worker_init.connect
+def on_worker_init(sender=None, **kwargs):
+    # пулы solo и threads выполняют задачи в основном процессе - прогрев до запуска консьюмера
+    pool = getattr(sender, 'pool_cls', '')
+    if LLM_WARMUP_ENABLED and 'prefork' not in str(getattr(pool, '__module__', pool)):
+        warm_up_model()
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def on_worker_shutdown(**kwargs):
+    if llm_engine is not None:
+        metrics.mark_stopped(metrics.process_name())
+
+# батчер общий для всех потоков воркера; модель вызывается только из его потока
+batcher = InferenceBatcher(get_llm)
+
+def run_analysis(**request) -> str:
+    """
+    Анализ одного документа: запросом к серверу инференса, через батчер, если он включен,
+    иначе напрямую моделью
+    """
+    if LLM_INFERENCE_MODE == 'server':
+        return inference_client.analyze(**request)
+    if LLM_BATCHING_ENABLED:
+        return batcher.analyze(**request)
+    return get_llm().analyze_error(**request)
+
+def _save_analysis(db, doc, analysis_json: str, prompt_name: str = None, prompt_version: int = None):
+    # результат запроса в JSON сохраняю в таблицу БД
+    analysis_entry = AnalysisResult(
+        document_id=doc.id,
+        ai_response_json=analysis_json,
+        prompt_name=prompt_name,
+        prompt_version=prompt_version
+    )
+    db.add(analysis_entry)
+    
+    # статус документа обновляю до analyzed
+    doc.status = 'analyzed'
+    db.commit()
+    
+    analysis = json.loads(analysis_json)
+    # итог - клиентам, которые следят за анализом через SSE
+    analysis_stream.publish(doc.id, analysis_stream.EVENT_DONE, {'analysis_id': analysis_entry.id, 'analysis': analysis})
+    return analysis
+
 @celery_app.task
 def analyze_document_task(doc_id: int):
     """
@@ -38,33 +144,29 @@ def analyze_document_task(doc_id: int):
             logger.info('Worker: Skipping non-invoice document')
             return 'Skipped: non-invoice'
         
-        if doc.validation_status == 'math_error':
-            error_msg = doc.parsed_metadata.get('validation_error', 'Не сходится математика.')
-            logger.info(f'Воркер: найдена математическая ошибка - {error_msg}')
-            
-            engine = get_llm()
-            analysis_json = engine.analyze_error(
-                doc_id=str(doc_id),
-                doc_type=doc.doc_type,
-                error_text=error_msg,
-                rules=rules_text,
-                template_text=template_text,
-                generation_config=gen_config
-            )
+        analysis_stream.publish(doc.id, analysis_stream.EVENT_STATUS, {'status': 'processing'})
+        
+        # текст ошибки, найденной при загрузке (None - документ прошел все проверки)
+        error_msg = (doc.parsed_metadata or {}).get('validation_error')
         
+        # известные классы ошибок разбираются правилами - модель не нужна
+        if RESOLVER_ENABLED:
+            resolved = resolver.resolve(doc.validation_status, error_msg)
+            if resolved:
+                rule_name, analysis_json = resolved
+                logger.info(f'Воркер: документ {doc.id} разобран правилом {rule_name} без LLM')
+                metrics.incr('analysis_resolved_by_rule')
+                return _save_analysis(db, doc, analysis_json, prompt_name=f'rule:{rule_name}')
+        metrics.incr('analysis_llm')
         
-        # превращаю ошибку (сам документ) в вектор запроса
-        query_text = 'Проблемы с суммой, валютой или датами'
+        # превращаю ошибку документа в вектор запроса (одинаковые ошибки - один вектор из кэша)
+        query_text = retrieval_query(error_msg)
         query_vector = embedder.get_embedding(query_text)
         
-        # правила из базы знаний - ищу 3 ближайших правила в базе знаний
+        # правила из базы знаний - ищу ближайшие правила по косинусному расстоянию
+        # (индекс в памяти воркера или индекс pgvector - KNOWLEDGE_SEARCH_MODE)
         # забираю правила и склеиваю в одну строку
-        # 
-        rules_objects = db.query(KnowledgeBaseItem)\
-            .filter(KnowledgeBaseItem.status == 'approved')\
-            .order_by(KnowledgeBaseItem.embedding.l2_distance(query_vector))\
-            .limit(3)\
-            .all()
+        rules_objects = search_rules(db, query_vector)
         
         if rules_objects:
             rules_text = '\n'.join([f'- {r.rule_text}' for r in rules_objects])
@@ -74,7 +176,7 @@ def analyze_document_task(doc_id: int):
                 
         # читаю промпт из БД
         prompt_db = db.query(PromptTemplate)\
-            .filter(PromptTemplate.name == 'analyze_invoice', PromptTemplate.is_active == True)\
+            .filter(PromptTemplate.name == ANALYSIS_PROMPT_NAME, PromptTemplate.is_active == True)\
             .first()
         
         if prompt_db:
@@ -82,6 +184,8 @@ def analyze_document_task(doc_id: int):
             
             # нужно достать конфигурацию генерации; если в БД ничего - пустой словарь
             gen_config = prompt_db.generation_config or {}            
+            # промпт в БД неизменяем - id и версия однозначно задают скомпилированный шаблон
+            template_key = f'{prompt_db.id}:{prompt_db.version}'
             
             logger.info(f"Воркер: Использую промпт '{prompt_db.name}' версии {prompt_db.version} \
                 с конфигурацией: {gen_config}")
@@ -92,37 +196,39 @@ def analyze_document_task(doc_id: int):
             <|start_header_id|>system<|end_header_id|>\nТы — опытный инженер технической поддержки EDI-системы.\nТвоя задача — проанализировать ошибку и дать четкие рекомендации по исправлению в формате JSON.\nИспользуй следующий контекст (правила системы):\n{{ context_rules }}\n<|eot_id|><|start_header_id|>user<|end_header_id|>\nПроанализируй следующую ошибку при загрузке документа:\nID документа: {{ doc_id }}\nТип: {{ doc_type }}\nТекст ошибки: {{ error_text }}\nВерни ответ ТОЛЬКО в формате JSON следующей структуры:\n{\n\"reason\": \"Краткая причина ошибки\",\n\"solution\": \"Пошаговая инструкция для пользователя\",\n\"criticality\": \"low/medium/high\"\n}\n<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
             """
             gen_config = {"temperature": 0.1, "max_tokens": 512}
+            template_key = None
         
         # применение языковой модели
-        # нужен контекст: анализируется сам XML на предмет ошибок, 
-        # если у документа статус error - анализируется текст ошибки
-        # для текущего уровня анализирую потенциальные проблемы с XML
-        engine = get_llm()
-        analysis_json = engine.analyze_error(
+        # если у документа есть ошибка - анализируется ее текст, иначе модель проверяет сам документ
+        analysis_json = run_analysis(
             doc_id=str(doc.id),
             doc_type=doc.doc_type,
-            error_text='Проверь этот XML на ошибки.',
+            error_text=error_msg or 'Проверь этот XML на ошибки.',
             rules=rules_text,
             template_text=template_text,
-            generation_config=gen_config
+            generation_config=gen_config,
+            template_key=template_key,
+            error_category=doc.validation_status,
+            stream=analysis_stream.ANALYSIS_STREAMING_ENABLED
         )
         
-        # результат запроса в JSON сохраняю в таблицу БД
-        analysis_entry = AnalysisResult(
-            document_id=doc.id,
-            ai_response_json=analysis_json
+        return _save_analysis(
+            db, doc, analysis_json,
+            prompt_name=prompt_db.name if prompt_db else None,
+            prompt_version=prompt_db.version if prompt_db else None
         )
-        db.add(analysis_entry)
-        
-        # статус документа обновляю до analyzed
-        doc.status = 'analyzed'
-        db.commit()
-        
-        return json.loads(analysis_json)
     
     except Exception as e:
         logger.error(f'Worker failed: {e}')
         db.rollback()
+        # статус сбоя - в БД до события: клиент, подписавшийся после события, узнает о сбое из БД
+        try:
+            db.query(EdiDocument).filter(EdiDocument.id == doc_id).update({'status': 'analysis_failed'})
+            db.commit()
+        except Exception as status_error:
+            logger.error(f'Worker: не удалось записать сбой анализа документа {doc_id}: {status_error}')
+            db.rollback()
+        analysis_stream.publish(doc_id, analysis_stream.EVENT_ERROR, {'detail': str(e)})
     
     finally:
         db.close()
\ No newline at end of file
@@ -0,0 +1,78 @@
+import pytest
+import metrics
+
+class FakeRedis:
+    """
+    Redis в памяти для тестов: строки, хэши, публикация в каналы и pipeline.
+    Значения хэшей хранятся байтами, как их возвращает redis-py.
+    round_trips - число обращений к серверу (publish и execute у pipeline)
+    """
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+        self.published = []
+        self.round_trips = 0
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+        self.hashes.pop(key, None)
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[_bytes(field)] = _bytes(value)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.hashes.get(key, {}).pop(_bytes(field), None)
+
+    def hincrby(self, key, field, amount=1):
+        values = self.hashes.setdefault(key, {})
+        value = int(values.get(_bytes(field), b'0')) + amount
+        values[_bytes(field)] = str(value).encode('utf-8')
+        return value
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        self.round_trips += 1
+        return 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+class FakePipeline:
+    """
+    Команды копятся и выполняются на клиенте одним обращением при execute
+    """
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(FakeRedis, name)
+        return lambda *args, **kwargs: self.commands.append((method, args, kwargs))
+
+    def execute(self):
+        self.client.round_trips += 1
+        round_trips = self.client.round_trips
+        results = [method(self.client, *args, **kwargs) for method, args, kwargs in self.commands]
+        # publish внутри pipeline не отдельное обращение к серверу
+        self.client.round_trips = round_trips
+        return results
+
+def _bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    # общий клиент metrics.get_redis(): метрики, готовность процессов, поток анализа
+    client = FakeRedis()
+    monkeypatch.setattr(metrics, '_client', client)
+    return client
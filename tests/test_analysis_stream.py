@@ -0,0 +1,73 @@
+import asyncio
+import json
+import analysis_stream
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = list(messages)
+
+    async def subscribe(self, channel):
+        pass
+
+    async def get_message(self, ignore_subscribe_messages=True, timeout=None):
+        return {'data': self.messages.pop(0)} if self.messages else None
+
+    async def aclose(self):
+        pass
+
+class FakeAsyncRedis:
+    def __init__(self, values, messages):
+        self.values = values
+        self.messages = messages
+
+    def pubsub(self):
+        return FakePubSub(self.messages)
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def aclose(self):
+        pass
+
+def run_relay(monkeypatch, values, messages, final=None):
+    monkeypatch.setattr(analysis_stream.redis.asyncio.Redis, 'from_url', lambda url: FakeAsyncRedis(values, messages))
+
+    async def load_final():
+        return final
+
+    async def is_disconnected():
+        return False
+
+    async def collect():
+        return [chunk async for chunk in analysis_stream.relay(1, load_final, is_disconnected)]
+    return asyncio.run(collect())
+
+def token(delta, offset):
+    return json.dumps({'event': 'token', 'delta': delta, 'offset': offset, 'model': 'm'})
+
+def test_partial_publisher_sends_deltas_in_batches(fake_redis, monkeypatch):
+    client = fake_redis
+    monkeypatch.setattr(analysis_stream, 'ANALYSIS_STREAM_FLUSH_SECONDS', 3600)
+    monkeypatch.setattr(analysis_stream, 'ANALYSIS_STREAM_FLUSH_PIECES', 4)
+    publisher = analysis_stream.PartialPublisher(1, 'm')
+    for piece in 'abcdefghij':
+        publisher(piece)
+    publisher.close()
+    events = [json.loads(message) for _, message in client.published]
+    assert [(event['delta'], event['offset']) for event in events] == [('abcd', 0), ('efgh', 4), ('ij', 8)]
+    assert client.round_trips == 3
+    assert json.loads(client.values[analysis_stream.text_key(1)])['text'] == 'abcdefghij'
+
+def test_relay_catches_up_without_duplicates(monkeypatch):
+    # клиент подключился, когда в ключе уже "abc", а событие с "bc" еще в канале
+    values = {analysis_stream.text_key(1): json.dumps({'text': 'abc', 'model': 'm'})}
+    messages = [token('bc', 1), token('de', 3), json.dumps({'event': 'done', 'analysis': {}})]
+    chunks = run_relay(monkeypatch, values, messages)
+    deltas = [json.loads(chunk.split('data: ')[1])['delta'] for chunk in chunks if chunk.startswith('event: token')]
+    assert ''.join(deltas) == 'abcde'
+    assert chunks[-1].startswith('event: done')
+
+def test_relay_reports_stored_failure(monkeypatch):
+    # сбой записан в БД до подключения клиента: событие error уже прошло, клиент не ждет вечно
+    chunks = run_relay(monkeypatch, {}, [], final=('error', {'detail': 'сбой'}))
+    assert chunks == [analysis_stream.sse_event('error', {'detail': 'сбой'})]
@@ -1,7 +1,13 @@
+import io
+import uuid
+import zipfile
+import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+import main
 from main import app, get_db
+import database
 from database import Base
 
 # временная БД в памяти для теста
@@ -31,6 +37,94 @@ Base.metadata.create_all(bind=engine)
 
 client = TestClient(app)
 
+with open('test_invoice.xml', encoding='utf-8') as f:
+    INVOICE_XML = f.read()
+
+class FakeTask:
+    """
+    Задача анализа без брокера: запоминает id документов, поставленных в очередь
+    """
+    def __init__(self):
+        self.queued = []
+
+    def delay(self, doc_id):
+        self.queued.append(doc_id)
+
+    def s(self, doc_id):
+        return doc_id
+
+class FakeGroup:
+    def __init__(self, task, doc_ids):
+        self.task = task
+        self.doc_ids = list(doc_ids)
+
+    def apply_async(self):
+        self.task.queued.extend(self.doc_ids)
+
+@pytest.fixture
+def task(monkeypatch):
+    fake = FakeTask()
+    monkeypatch.setattr(main, 'analyze_document_task', fake)
+    monkeypatch.setattr(main, 'group', lambda doc_ids: FakeGroup(fake, doc_ids))
+    return fake
+
+def create_client_user():
+    name = uuid.uuid4().hex[:12]
+    response = client.post("/users/", json={"username": name, "email": f"{name}@example.com"})
+    assert response.status_code == 200
+    data = response.json()
+    return data["id"], {"x-api-key": data["api_key"]}
+
+def unique_invoice() -> str:
+    # свое содержимое для каждого теста: тестовая БД общая, хэши не должны пересекаться
+    return INVOICE_XML + f"<!-- {uuid.uuid4().hex} -->"
+
+def upload(user_id: int, headers: dict, content_xml: str):
+    response = client.post(
+        f"/users/{user_id}/documents",
+        json={"filename": "invoice.xml", "doc_type": "Invoice", "content_xml": content_xml},
+        headers=headers
+    )
+    assert response.status_code == 200
+    return response.json()
+
+def add_analysis(document_id: int) -> int:
+    """
+    Готовый анализ документа активной версией промпта анализа (как после работы воркера)
+    """
+    db = TestingSessionLocal()
+    try:
+        prompt = db.query(database.PromptTemplate)\
+            .filter(database.PromptTemplate.name == main.ANALYSIS_PROMPT_NAME,
+                    database.PromptTemplate.is_active == True)\
+            .first()
+        if prompt is None:
+            prompt = database.PromptTemplate(name=main.ANALYSIS_PROMPT_NAME, version=1,
+                                             template_text='{{ error_text }}', is_active=True)
+            db.add(prompt)
+            db.flush()
+        analysis = database.AnalysisResult(document_id=document_id, ai_response_json='{"reason": "r"}',
+                                           prompt_name=prompt.name, prompt_version=prompt.version)
+        db.add(analysis)
+        db.commit()
+        return analysis.id
+    finally:
+        db.close()
+
+def get_row(model, row_id: int):
+    db = TestingSessionLocal()
+    try:
+        return db.get(model, row_id)
+    finally:
+        db.close()
+
+def make_zip(files: dict) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
 def test_create_user():
     response = client.post(
         "/users/",
@@ -39,4 +133,117 @@ def test_create_user():
     assert response.status_code == 200
     data = response.json()
     assert data["email"] == "test@example.com"
-    assert "id" in data
\ No newline at end of file
+    assert "id" in data
+
+def test_batch_upload_item_statuses(task):
+    user_id, headers = create_client_user()
+    documents = [
+        {"filename": "ok.xml", "doc_type": "Invoice", "content_xml": INVOICE_XML},
+        {"filename": "broken.xml", "doc_type": "Invoice", "content_xml": "<Invoice>"}
+    ]
+    response = client.post(f"/users/{user_id}/documents/batch", json={"documents": documents}, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total"] == 2 and data["accepted"] == 2
+    assert [item["validation_status"] for item in data["items"]] == ["valid", "syntax_error"]
+    assert sorted(task.queued) == sorted(item["document_id"] for item in data["items"])
+
+def test_batch_upload_too_many_documents(task, monkeypatch):
+    user_id, headers = create_client_user()
+    monkeypatch.setattr(main, 'BATCH_MAX_DOCUMENTS', 1)
+    document = {"filename": "ok.xml", "doc_type": "Invoice", "content_xml": INVOICE_XML}
+    response = client.post(f"/users/{user_id}/documents/batch", json={"documents": [document] * 2}, headers=headers)
+    assert response.status_code == 413
+    assert task.queued == []
+
+def test_zip_upload_rejects_unreadable_entries(task):
+    user_id, headers = create_client_user()
+    body = make_zip({
+        "ok.xml": INVOICE_XML,
+        "cp1251.xml": "<Invoice>Счет</Invoice>".encode('cp1251'),
+        "corrupted.xml": "<corrupted-entry/>"
+    })
+    # порча данных файла без изменения заголовков: при чтении - Bad CRC-32
+    body = body.replace(b"<corrupted-entry/>", b"<corrupted-entrx/>")
+    response = client.post(f"/users/{user_id}/documents/batch/zip", content=body, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total"] == 3 and data["accepted"] == 1
+    statuses = {item["filename"]: item for item in data["items"]}
+    assert statuses["ok.xml"]["validation_status"] == "valid"
+    assert statuses["cp1251.xml"]["validation_status"] == "rejected"
+    assert statuses["corrupted.xml"]["validation_status"] == "rejected"
+    assert statuses["corrupted.xml"]["document_id"] is None
+    assert task.queued == [statuses["ok.xml"]["document_id"]]
+
+def test_zip_upload_limits(task, monkeypatch):
+    user_id, headers = create_client_user()
+    body = make_zip({"a.xml": INVOICE_XML, "b.xml": INVOICE_XML})
+    url = f"/users/{user_id}/documents/batch/zip"
+
+    monkeypatch.setattr(main, 'BATCH_MAX_DOCUMENTS', 1)
+    assert client.post(url, content=body, headers=headers).status_code == 413
+    monkeypatch.setattr(main, 'BATCH_MAX_DOCUMENTS', 10)
+    # размер после распаковки берется из заголовков архива, файлы не распаковываются
+    monkeypatch.setattr(main, 'BATCH_ZIP_MAX_UNCOMPRESSED_BYTES', len(INVOICE_XML.encode('utf-8')))
+    assert client.post(url, content=body, headers=headers).status_code == 413
+    monkeypatch.setattr(main, 'BATCH_ZIP_MAX_BYTES', len(body) - 1)
+    assert client.post(url, content=body, headers=headers).status_code == 413
+    assert client.post(url, content=b"not a zip", headers=headers).status_code == 400
+    assert task.queued == []
+
+def test_reupload_reuses_analysis_without_queue(task):
+    user_id, headers = create_client_user()
+    content_xml = unique_invoice()
+    first = upload(user_id, headers, content_xml)
+    analysis_id = add_analysis(first["id"])
+    assert task.queued == [first["id"]]
+
+    second = upload(user_id, headers, content_xml)
+    assert second["status"] == "analyzed"
+    assert second["validation_status"] == first["validation_status"]
+    # задача анализа не ставится, ответ скопирован со ссылкой на исходный анализ
+    assert task.queued == [first["id"]]
+    assert get_row(database.EdiDocument, second["id"]).duplicate_of_id == first["id"]
+    db = TestingSessionLocal()
+    try:
+        reused = db.query(database.AnalysisResult)\
+            .filter(database.AnalysisResult.document_id == second["id"])\
+            .one()
+        assert reused.reused_from_id == analysis_id
+    finally:
+        db.close()
+
+def test_duplicates_not_shared_between_owners(task):
+    owner_id, owner_headers = create_client_user()
+    other_id, other_headers = create_client_user()
+    content_xml = unique_invoice()
+    first = upload(owner_id, owner_headers, content_xml)
+    add_analysis(first["id"])
+
+    # тот же XML другого клиента разбирается и анализируется заново
+    other = upload(other_id, other_headers, content_xml)
+    assert other["status"] == "uploaded"
+    assert get_row(database.EdiDocument, other["id"]).duplicate_of_id is None
+
+    documents = [{"filename": "invoice.xml", "doc_type": "Invoice", "content_xml": content_xml}]
+    response = client.post(f"/users/{other_id}/documents/batch", json={"documents": documents}, headers=other_headers)
+    batch_id = response.json()["items"][0]["document_id"]
+    # в пакете найден только свой документ
+    assert get_row(database.EdiDocument, batch_id).duplicate_of_id == other["id"]
+    assert task.queued == [first["id"], other["id"], batch_id]
+
+def test_dedup_stats(task):
+    user_id, headers = create_client_user()
+    before = client.get("/documents/dedup/stats").json()
+    content_xml = unique_invoice()
+    first = upload(user_id, headers, content_xml)
+    add_analysis(first["id"])
+    upload(user_id, headers, content_xml)
+
+    after = client.get("/documents/dedup/stats").json()
+    assert after["documents_total"] == before["documents_total"] + 2
+    assert after["duplicate_uploads"] == before["duplicate_uploads"] + 1
+    assert after["analyses_total"] == before["analyses_total"] + 2
+    assert after["analyses_reused"] == before["analyses_reused"] + 1
+    assert 0 < after["inference_avoided_ratio"] <= 1
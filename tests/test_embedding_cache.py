@@ -0,0 +1,26 @@
+import numpy as np
+from embedding_cache import EmbeddingCache, retrieval_query, embedding_cache_stats, DEFAULT_RETRIEVAL_QUERY
+
+def test_retrieval_query_drops_document_values():
+    assert retrieval_query(None) == DEFAULT_RETRIEVAL_QUERY
+    assert retrieval_query('Сумма строк (100.0) не совпадает с итогом (120.0)') == \
+        retrieval_query('Сумма строк  (7) не совпадает с итогом (8.5)')
+    assert retrieval_query("Element 'cbc:Amount': The value 'EURO' is not accepted., line 12, column 7") == \
+        "Element 'cbc:Amount': The value '...' is not accepted."
+
+def test_memory_lru_and_normalized_key():
+    cache = EmbeddingCache('model', size=2, persist='none')
+    cache.set('a  b', [1.0, 2.0])
+    assert cache.get('a b').tolist() == [1.0, 2.0]
+    cache.set('c', [3.0])
+    cache.set('d', [4.0])
+    assert cache.get('a b') is None
+    # другая модель - другой ключ
+    assert EmbeddingCache('other').make_key('c') != cache.make_key('c')
+
+def test_disk_persistence(tmp_path):
+    EmbeddingCache('model', persist='disk', cache_dir=str(tmp_path)).set('text', np.array([0.5, 0.25]))
+    restored = EmbeddingCache('model', persist='disk', cache_dir=str(tmp_path)).get('text')
+    assert restored.dtype == np.float32
+    assert restored.tolist() == [0.5, 0.25]
+    assert embedding_cache_stats({'embedding_cache_hits_memory': 1, 'embedding_cache_misses': 1})['hit_ratio'] == 0.5
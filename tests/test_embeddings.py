@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import threading
+import numpy as np
+import pytest
+import embeddings
+from embeddings import embedder
+from embedding_cache import EmbeddingCache
+
+class FakeModel:
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts, batch_size=32):
+        self.calls.append(texts)
+        if isinstance(texts, str):
+            return np.array([float(len(texts)), 1.0])
+        return np.array([[float(len(text)), 1.0] for text in texts])
+
+def test_import_does_not_load_model():
+    # импорт модуля (а с ним main и tasks) не тянет torch и sentence_transformers
+    code = 'import sys, embeddings; print(embeddings.embedder.loaded, "sentence_transformers" in sys.modules)'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True)
+    assert result.stdout.split() == ['False', 'False']
+
+def test_model_loaded_once_on_first_use(monkeypatch):
+    loads = []
+    model = FakeModel()
+
+    def load_model():
+        loads.append(1)
+        return model
+
+    monkeypatch.setattr(embeddings, 'load_model', load_model)
+    monkeypatch.setattr(embedder, '_model', None)
+    monkeypatch.setattr(embedder, 'cache', EmbeddingCache('model', persist='none'))
+    assert not embedder.loaded
+
+    threads = [threading.Thread(target=embedder.get_embedding, args=('a  b',)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+    assert embedder.get_embedding('a b') == [3.0, 1.0]
+    assert embedder.get_embeddings(['x', 'yy']) == [[1.0, 1.0], [2.0, 1.0]]
+
+def test_vector_agreement():
+    rng = np.random.default_rng(0)
+    rules = rng.normal(size=(50, 8))
+    queries = rules[:5] + rng.normal(scale=0.01, size=(5, 8))
+    assert embeddings.vector_agreement(rules, rules, queries, queries) == pytest.approx((1.0, 1.0))
+    cosine, agreement = embeddings.vector_agreement(rules, -rules, queries, -queries)
+    assert cosine == pytest.approx(-1.0) and agreement < 1.0
+
+@pytest.mark.parametrize('backend', ['onnx', 'torch_int8'])
+def test_quantized_backend_matches_torch(backend):
+    # векторы запросов квантованного бэкенда сравниваются с векторами правил torch float32 в БД
+    pytest.importorskip('sentence_transformers')
+    try:
+        model = embeddings.load_model(backend=backend)
+    except Exception as e:
+        pytest.skip(f'бэкенд {backend} недоступен: {e}')
+    reference = embeddings.load_model(backend='torch')
+    rules = [f'{topic} {check}' for topic in ('Сумма документа', 'Валюта', 'Дата выставления', 'ИНН поставщика')
+             for check in ('не может быть отрицательной', 'задается кодом ISO 4217', 'обязателен')]
+    queries = ["Element 'cbc:IssueDate': This element is not expected.",
+               'Сумма строк (N) не совпадает с итогом (N)',
+               "Element 'cbc:DocumentCurrencyCode': The value '...' is not accepted."]
+    cosine, agreement = embeddings.vector_agreement(reference.encode(rules), model.encode(rules),
+                                                    reference.encode(queries), model.encode(queries), k=3)
+    assert cosine >= embeddings.EMBEDDING_MIN_COSINE
+    assert agreement >= embeddings.EMBEDDING_MIN_TOP_K_AGREEMENT
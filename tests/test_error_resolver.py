@@ -0,0 +1,38 @@
+import json
+from error_resolver import ErrorResolver, DEFAULT_RULES, resolver_stats
+
+resolver = ErrorResolver(DEFAULT_RULES)
+
+def test_line_sum_mismatch():
+    name, answer = resolver.resolve('math_error', 'Сумма строк (100.0) не совпадает с итогом (120.0)')
+    answer = json.loads(answer)
+    assert name == 'line_sum_mismatch'
+    assert '100.0' in answer['reason'] and '120.0' in answer['reason']
+    assert answer['criticality'] == 'high'
+
+def test_xsd_errors():
+    name, answer = resolver.resolve(
+        'schema_error', "Element 'Invoice': Missing child element(s). Expected is ( IssueDate )., line 1")
+    assert name == 'xsd_element_missing'
+    assert 'IssueDate' in json.loads(answer)['reason']
+    assert resolver.resolve('schema_error', "Element 'X': This element is not expected.")[0] == 'xsd_element_unexpected'
+    assert resolver.resolve(
+        'schema_error', "Element 'Amount': 'abc' is not a valid value of the atomic type 'xs:decimal'."
+    )[0] == 'xsd_value_invalid'
+
+def test_unknown_error_falls_through_to_llm():
+    assert resolver.resolve('schema_error', 'Ошибка в схеме XML: что-то непонятное') is None
+    assert resolver.resolve('math_error', 'Не сходится математика.') is None
+
+def test_syntax_error_and_valid_document():
+    assert resolver.resolve('syntax_error', 'Invalid XML: Opening and ending tag mismatch')[0] == 'xml_syntax_error'
+    assert json.loads(resolver.resolve('valid', None)[1])['criticality'] == 'low'
+
+def test_custom_rules_and_stats():
+    custom = ErrorResolver([{'name': 'currency', 'statuses': ['schema_error'], 'pattern': r"value '(?P<value>\w+)'",
+                             'response': {'reason': 'Валюта {value}: {error}', 'solution': '{unknown}',
+                                          'criticality': 'low'}}])
+    answer = json.loads(custom.resolve('schema_error', "The value 'EURO' is bad")[1])
+    assert answer['reason'] == "Валюта EURO: The value 'EURO' is bad"
+    assert answer['solution'] == '{unknown}'
+    assert resolver_stats({'analysis_resolved_by_rule': 3, 'analysis_llm': 1})['share_without_inference'] == 0.75
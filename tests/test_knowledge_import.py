@@ -0,0 +1,28 @@
+import pytest
+from database import KnowledgeBaseItem
+from knowledge_import import parse_rules, rule_hash
+
+CSV = 'topic,rule_text,status\nValidation,Сумма документа не может быть отрицательной.,\nCurrency,Код валюты - три заглавные буквы.,draft\n'
+
+def test_parse_csv_and_json():
+    rules = parse_rules(('﻿' + CSV).encode('utf-8'), 'csv')
+    assert [rule['topic'] for rule in rules] == ['Validation', 'Currency']
+    assert rules[0]['status'] is None and rules[1]['status'] == 'draft'
+    assert parse_rules('{"rules": [{"topic": "T", "rule_text": " текст "}]}', 'json')[0]['rule_text'] == 'текст'
+
+def test_invalid_rules():
+    with pytest.raises(ValueError):
+        parse_rules('[{"topic": "T"}]', 'json')
+    with pytest.raises(ValueError):
+        parse_rules('topic,rule_text,status\nT,текст,published\n', 'csv')
+    with pytest.raises(ValueError):
+        parse_rules('{"topic": "T"}', 'json')
+
+def test_rule_hash_ignores_whitespace():
+    assert rule_hash('Сумма  документа\nне может') == rule_hash('Сумма документа не может')
+    assert rule_hash('a') != rule_hash('b')
+
+def test_rule_hash_is_unique():
+    # одновременные импорты не вставляют одно правило дважды: ON CONFLICT по уникальному индексу
+    indexes = {index.name: index for index in KnowledgeBaseItem.__table__.indexes}
+    assert indexes['uq_knowledge_base_rule_hash'].unique
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from database import knowledge_index_statement
+import knowledge_search
+from knowledge_search import set_search_params, RuleIndex
+
+class RecordingSession:
+    def __init__(self):
+        self.calls = []
+
+    def execute(self, statement, params=None):
+        self.calls.append((str(statement), params))
+
+def test_index_statement():
+    statement = knowledge_index_statement('knowledge_base', 'hnsw')
+    assert 'USING hnsw (embedding vector_cosine_ops)' in statement
+    assert statement.endswith("WHERE status = 'approved'")
+    assert 'lists' in knowledge_index_statement('knowledge_base', 'ivfflat')
+    assert knowledge_index_statement('knowledge_base', 'none') is None
+    with pytest.raises(ValueError):
+        knowledge_index_statement('knowledge_base', 'flat')
+
+def test_ef_search_is_set_per_transaction():
+    db = RecordingSession()
+    set_search_params(db, index_type='hnsw', ef_search=2, limit=3)
+    assert db.calls == [("SELECT set_config('hnsw.ef_search', :value, true)", {'value': '3'})]
+    db = RecordingSession()
+    set_search_params(db, index_type='ivfflat', probes=7)
+    assert db.calls[0][1] == {'value': '7'}
+
+def test_rule_index_top_k():
+    index = RuleIndex()
+    vectors = np.array([[1, 0, 0], [0, 1, 0], [0.9, 0.1, 0], [0, 0, 5]], dtype=np.float32)
+    index.build([1, 2, 3, 4], vectors, ['a', 'b', 'c', 'd'])
+    # ненормированный запрос и строки: сравнение по косинусу
+    assert index.search_vector([2, 0, 0], limit=2) == ['a', 'c']
+    assert index.search_vector([0, 0, 1], limit=1) == ['d']
+    assert len(index.search_vector([0, 0, 1], limit=10)) == 4
+    assert RuleIndex().search_vector([1, 0, 0]) == []
+
+def test_rule_index_full_sync_without_version_change(monkeypatch):
+    # версия в Redis не меняется, но индекс все равно сверяется с БД раз в full_sync_seconds
+    monkeypatch.setattr(knowledge_search, 'knowledge_version', lambda: 7)
+    index = RuleIndex(check_seconds=0, full_sync_seconds=3600)
+    syncs = []
+    monkeypatch.setattr(index, '_sync', lambda db: syncs.append(db))
+    index.refresh('db')
+    index.refresh('db')
+    assert len(syncs) == 1
+    index.full_sync_seconds = 0
+    index.refresh('db')
+    assert len(syncs) == 2
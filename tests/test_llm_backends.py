@@ -0,0 +1,245 @@
+import types
+import numpy as np
+import pytest
+import llm_backends
+import metrics
+from llm_backends import LlamaCppBackend, _common_prefix_length
+
+# llama-cpp-python в тестах не нужен: Llama и _internals заменены заглушками,
+# токен - код символа, BOS - 1, конец генерации - 2
+BOS = 1
+EOG = 2
+
+class FakeLlama:
+    def __init__(self, n_batch: int = 4):
+        self.n_batch = n_batch
+        self.context_params = types.SimpleNamespace(n_ubatch=n_batch)
+        self._model = self.model = object()
+        self.calls = []
+        self.evaluated = []
+        self.loaded = []
+        self.n_tokens = 0
+        self._input_ids = np.array([], dtype=np.intc)
+
+    def token_bos(self):
+        return BOS
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        return [ord(char) for char in text.decode('utf-8')]
+
+    def detokenize(self, tokens):
+        return ''.join(chr(token) for token in tokens).encode('utf-8')
+
+    def reset(self):
+        self.n_tokens = 0
+        self._input_ids = np.array([], dtype=np.intc)
+
+    def eval(self, tokens):
+        self.evaluated.append(list(tokens))
+        self._input_ids = np.array(list(self._input_ids) + list(tokens), dtype=np.intc)
+        self.n_tokens = len(self._input_ids)
+
+    def save_state(self):
+        return list(self._input_ids)
+
+    def load_state(self, state):
+        self.loaded.append(state)
+        self._input_ids = np.array(state, dtype=np.intc)
+        self.n_tokens = len(state)
+
+    def __call__(self, prompt, **kwargs):
+        self.calls.append((prompt, kwargs))
+        # как Llama.generate: KV-кэш теперь содержит весь промпт
+        self._input_ids = np.array([BOS] + self.tokenize(prompt.encode('utf-8')), dtype=np.intc)
+        self.n_tokens = len(self._input_ids)
+        return {'choices': [{'text': 'ok'}]}
+
+class FakeBatchData:
+    def __init__(self, size: int):
+        self.token = [0] * size
+        self.pos = [0] * size
+        self.n_seq_id = [0] * size
+        self.seq_id = [[0] * 16 for _ in range(size)]
+        self.logits = [False] * size
+        self.n_tokens = 0
+
+class FakeBatch:
+    def __init__(self, n_tokens, embd, n_seq_max, verbose=True):
+        self.batch = FakeBatchData(n_tokens)
+        self.closed = False
+
+    def reset(self):
+        self.batch.n_tokens = 0
+
+    def close(self):
+        self.closed = True
+
+class FakeContext:
+    def __init__(self, model=None, params=None, verbose=True):
+        self.params = params
+        self.clears = 0
+        # каждый decode: список (токен, позиция, последовательности, нужны ли логиты)
+        self.decoded = []
+
+    def kv_cache_clear(self):
+        self.clears += 1
+
+    def decode(self, batch):
+        data = batch.batch
+        self.decoded.append([
+            (data.token[j], data.pos[j], tuple(data.seq_id[j][:data.n_seq_id[j]]), data.logits[j])
+            for j in range(data.n_tokens)
+        ])
+
+class FakeSampler:
+    # ответы последовательностей по порядку создания сэмплеров
+    scripts = []
+
+    def __init__(self):
+        self.tokens = list(FakeSampler.scripts.pop(0)) if FakeSampler.scripts else []
+        self.chain = []
+        self.closed = False
+
+    def __getattr__(self, name):
+        if name.startswith('add_'):
+            return lambda *args: self.chain.append(name)
+        raise AttributeError(name)
+
+    def sample(self, ctx, index):
+        return self.tokens.pop(0) if self.tokens else EOG
+
+    def close(self):
+        self.closed = True
+
+class FakeGrammar:
+    built = 0
+
+    @classmethod
+    def from_json_schema(cls, schema: str, verbose: bool = True):
+        cls.built += 1
+        return cls()
+
+@pytest.fixture
+def backend(monkeypatch):
+    monkeypatch.setattr(llm_backends, 'llama_cpp', types.SimpleNamespace(
+        llama_context_default_params=types.SimpleNamespace,
+        llama_model_get_vocab=lambda model: None,
+        llama_vocab_is_eog=lambda vocab, token: token == EOG
+    ))
+    monkeypatch.setattr(llm_backends, 'internals', types.SimpleNamespace(
+        LlamaBatch=FakeBatch, LlamaContext=FakeContext, LlamaSampler=FakeSampler
+    ), raising=False)
+    monkeypatch.setattr(llm_backends, 'LlamaGrammar', FakeGrammar, raising=False)
+    monkeypatch.setattr(metrics, 'incr', lambda name, amount=1: None)
+    FakeGrammar.built = 0
+    FakeSampler.scripts = []
+
+    # модель не загружается: атрибуты - как после LlamaCppBackend.__init__
+    instance = LlamaCppBackend.__new__(LlamaCppBackend)
+    instance.model_id = 'fake.gguf'
+    instance.llm = FakeLlama()
+    instance.n_ctx = 4096
+    instance._prefix_states = llm_backends.OrderedDict()
+    instance._batch_ctx = None
+    instance._grammar = None
+    return instance
+
+def tokens(text: str) -> list:
+    return [ord(char) for char in text]
+
+def test_common_prefix_length():
+    assert _common_prefix_length([[1, 2, 3], [1, 2, 4]]) == 2
+    # у каждой последовательности остается свой последний токен - с него берутся логиты
+    assert _common_prefix_length([[1, 2, 3], [1, 2, 3]]) == 2
+    assert _common_prefix_length([[1, 2, 3], [1, 2]]) == 1
+    assert _common_prefix_length([[5, 2], [1, 2]]) == 0
+    assert _common_prefix_length([[1, 2, 3]]) == 2
+
+def test_prefix_evaluated_once_and_restored(backend):
+    llm = backend.llm
+    backend._restore_prefix('SYS:', 'SYS:doc 1')
+    assert llm.evaluated == [[BOS] + tokens('SYS:')]
+
+    # префикс еще в KV-кэше после генерации с тем же шаблоном - состояние не загружается
+    llm('SYS:doc 1')
+    backend._restore_prefix('SYS:', 'SYS:doc 2')
+    assert llm.loaded == [] and len(llm.evaluated) == 1
+
+    # между запросами был другой промпт - сохраненное состояние восстанавливается
+    llm('other prompt')
+    backend._restore_prefix('SYS:', 'SYS:doc 3')
+    assert llm.loaded == [[BOS] + tokens('SYS:')] and len(llm.evaluated) == 1
+
+    # промпт не начинается с префикса - кэш не трогается
+    backend._restore_prefix('SYS:', 'USER:doc')
+    assert len(llm.evaluated) == 1 and len(llm.loaded) == 1
+
+def test_prefix_states_evicted(backend, monkeypatch):
+    monkeypatch.setattr(llm_backends, 'LLM_PREFIX_CACHE_SIZE', 1)
+    backend._restore_prefix('A:', 'A:doc')
+    backend._restore_prefix('B:', 'B:doc')
+    assert len(backend._prefix_states) == 1
+    # состояние префикса A вытеснено - он вычисляется заново
+    backend._restore_prefix('A:', 'A:doc')
+    assert len(backend.llm.evaluated) == 3
+
+def test_generate_batch_shares_prefix_and_stops_on_eog(backend, monkeypatch):
+    monkeypatch.setattr(llm_backends, 'LLM_CONSTRAINED_DECODING', False)
+    FakeSampler.scripts = [tokens('xy'), tokens('z')]
+    streamed = []
+    results = backend.generate_batch(['SYS:a', 'SYS:bb'], {'max_tokens': 10, 'temperature': 0},
+                                     on_text=[None, streamed.append])
+    assert results == ['xy', 'z']
+    assert ''.join(streamed) == 'z'
+
+    decoded = backend._batch_ctx.decoded
+    # общий префикс (BOS + "SYS:") вычислен один раз сразу для обеих последовательностей, частями по n_batch
+    assert [[token for token, _, _, _ in chunk] for chunk in decoded[:2]] == [[BOS] + tokens('SYS'), tokens(':')]
+    assert {seq for chunk in decoded[:2] for _, _, seq, _ in chunk} == {(0, 1)}
+    # затем свой хвост каждого промпта, логиты - только у последнего токена
+    assert decoded[2] == [(ord('a'), 5, (0,), True)]
+    assert decoded[3] == [(ord('b'), 5, (1,), False), (ord('b'), 6, (1,), True)]
+    # после конца генерации (EOG) последовательность 1 в шаги не попадает
+    steps = decoded[-2:]
+    assert [[seq for _, _, seq, _ in step] for step in steps] == [[(0,), (1,)], [(0,)]]
+    # позиции ответа продолжают промпт своей последовательности
+    assert steps[0] == [(ord('x'), 6, (0,), True), (ord('z'), 7, (1,), True)]
+
+def test_generate_batch_max_tokens(backend):
+    FakeSampler.scripts = [tokens('abcdef')]
+    assert backend.generate_batch(['SYS:a'], {'max_tokens': 3, 'temperature': 0}) == ['abc']
+
+def test_generate_batch_halves_over_kv_budget(backend, monkeypatch):
+    # промпт - 6 токенов, ответ до 4: два промпта вместе (5 общих + 1 + 1 + 2 * 4 = 15) не помещаются в 12
+    monkeypatch.setattr(llm_backends, 'LLM_BATCH_CTX', 12)
+    FakeSampler.scripts = [tokens('1'), tokens('2')]
+    assert backend.generate_batch(['SYS:a', 'SYS:b'], {'max_tokens': 4}) == ['1', '2']
+    assert backend._batch_ctx.clears == 2
+
+    monkeypatch.setattr(llm_backends, 'LLM_BATCH_CTX', 8)
+    with pytest.raises(ValueError):
+        backend.generate_batch(['SYS:a'], {'max_tokens': 4})
+
+def test_generate_batch_respects_max_batch_size(backend, monkeypatch):
+    monkeypatch.setattr(llm_backends, 'LLM_MAX_BATCH_SIZE', 2)
+    FakeSampler.scripts = [tokens('1'), tokens('2'), tokens('3')]
+    assert backend.generate_batch(['SYS:a', 'SYS:b', 'SYS:c'], {'max_tokens': 4}) == ['1', '2', '3']
+    assert backend._batch_ctx.clears == 2
+
+def test_grammar_built_once(backend, monkeypatch):
+    monkeypatch.setattr(llm_backends, 'LLM_CONSTRAINED_DECODING', True)
+    grammar = backend._response_grammar()
+    backend.generate('prompt', {'max_tokens': 8})
+    backend.generate('prompt', {'max_tokens': 8})
+    samplers = [backend._sampler({'temperature': 0}) for _ in range(3)]
+    assert FakeGrammar.built == 1
+    assert all(kwargs['grammar'] is grammar for _, kwargs in backend.llm.calls)
+    # у каждой последовательности батча своя цепочка с грамматикой
+    assert all(sampler.chain == ['add_grammar', 'add_greedy'] for sampler in samplers)
+
+def test_grammar_disabled(backend, monkeypatch):
+    monkeypatch.setattr(llm_backends, 'LLM_CONSTRAINED_DECODING', False)
+    backend.generate('prompt', {'max_tokens': 8})
+    assert backend.llm.calls[0][1]['grammar'] is None
+    assert backend._sampler({}).chain == ['add_top_k', 'add_top_p', 'add_min_p', 'add_temp', 'add_dist']
+    assert FakeGrammar.built == 0
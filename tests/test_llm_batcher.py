@@ -0,0 +1,37 @@
+import threading
+from llm_batcher import InferenceBatcher
+
+# движок-заглушка: запоминает размеры батчей вместо генерации
+class FakeEngine:
+    def __init__(self):
+        self.batches = []
+
+    def analyze_batch(self, requests, generation_config=None):
+        self.batches.append((len(requests), generation_config))
+        return [f"{{\"doc_id\": \"{request['doc_id']}\"}}" for request in requests]
+
+def run_concurrently(batcher, configs):
+    results = [None] * len(configs)
+    def worker(i):
+        results[i] = batcher.analyze(doc_id=str(i), doc_type='Invoice', error_text='e',
+                                     rules='', template_text='', generation_config=configs[i])
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(configs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_requests_are_batched_and_results_routed_back():
+    engine = FakeEngine()
+    batcher = InferenceBatcher(lambda: engine, max_batch_size=4, max_wait_ms=500)
+    results = run_concurrently(batcher, [{'temperature': 0.1}] * 4)
+    assert results == [f'{{"doc_id": "{i}"}}' for i in range(4)]
+    assert engine.batches == [(4, {'temperature': 0.1})]
+
+def test_different_generation_configs_are_not_mixed():
+    engine = FakeEngine()
+    batcher = InferenceBatcher(lambda: engine, max_batch_size=4, max_wait_ms=500)
+    run_concurrently(batcher, [{'temperature': 0.1}, {'temperature': 0.5}] * 2)
+    assert sorted(engine.batches, key=lambda b: b[1]['temperature']) == \
+        [(2, {'temperature': 0.1}), (2, {'temperature': 0.5})]
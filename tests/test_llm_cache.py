@@ -0,0 +1,31 @@
+from llm_cache import ResponseCache
+
+# кэш только в памяти процесса - Redis для теста не нужен
+def make_cache(**kwargs):
+    return ResponseCache(shared='none', **kwargs)
+
+def test_same_prompt_and_config_hit():
+    cache = make_cache()
+    config = {'temperature': 0.1, 'max_tokens': 512}
+    key = cache.make_key('prompt', config, 'model.gguf')
+    assert cache.get(key) is None
+    cache.set(key, '{"reason": "r"}')
+    assert cache.get(cache.make_key('prompt', dict(config), 'model.gguf')) == '{"reason": "r"}'
+    # другой generation_config - другой ключ
+    assert cache.make_key('prompt', {'temperature': 0.1, 'max_tokens': 256}, 'model.gguf') != key
+
+def test_lru_eviction_and_temperature_bypass():
+    cache = make_cache(memory_size=1, max_temperature=0.3)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    assert cache.get('a') is None
+    assert cache.get('b') == '2'
+    assert cache.should_bypass({'temperature': 0.8})
+    assert not cache.should_bypass({'temperature': 0.2})
+
+def test_missing_temperature_is_sampled():
+    # без temperature модель генерирует с температурой по умолчанию (0.8) - ответ не кэшируется
+    cache = make_cache(max_temperature=0.3)
+    assert cache.should_bypass({'max_tokens': 256})
+    assert cache.should_bypass({})
+    assert not cache.should_bypass({'temperature': 0, 'max_tokens': 256})
@@ -0,0 +1,98 @@
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from llm_client import InferenceClient, InferenceServerError
+
+# сервер-заглушка: отвечает на /analyze эхом doc_id, на /health - готовностью
+class FakeHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self._reply(200, {'analysis': json.dumps({'doc_id': payload['doc_id'],
+                                                  'config': payload['generation_config']})})
+
+    def do_GET(self):
+        self._reply(200, {'ready': True})
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        return 'test'
+
+    def log_message(self, *args):
+        pass
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    pass
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def analyze(client):
+    return json.loads(client.analyze(doc_id='7', doc_type='Invoice', error_text='e', rules='',
+                                     template_text='', generation_config={'temperature': 0.1}))
+
+def test_client_over_tcp():
+    server = serve(HTTPServer(('127.0.0.1', 0), FakeHandler))
+    try:
+        client = InferenceClient(f'http://127.0.0.1:{server.server_address[1]}')
+        assert analyze(client) == {'doc_id': '7', 'config': {'temperature': 0.1}}
+        assert client.wait_ready(1)
+    finally:
+        server.shutdown()
+
+def test_client_over_unix_socket():
+    path = os.path.join(tempfile.mkdtemp(), 'llm.sock')
+    server = serve(UnixHTTPServer(path, FakeHandler))
+    try:
+        assert analyze(InferenceClient(f'unix://{path}'))['doc_id'] == '7'
+    finally:
+        server.shutdown()
+
+def test_unavailable_server():
+    client = InferenceClient('http://127.0.0.1:9', timeout=1)
+    with pytest.raises(InferenceServerError):
+        client.health()
+    assert not client.wait_ready(0)
+
+class FailedHandler(FakeHandler):
+    # модель на сервере не загрузилась
+    def do_GET(self):
+        self._reply(500, {'detail': 'Модель не загружена: FileNotFoundError'})
+
+def test_wait_ready_reports_load_failure():
+    server = serve(HTTPServer(('127.0.0.1', 0), FailedHandler))
+    try:
+        client = InferenceClient(f'http://127.0.0.1:{server.server_address[1]}')
+        started = time.monotonic()
+        with pytest.raises(InferenceServerError, match='FileNotFoundError'):
+            client.wait_ready(30)
+        assert time.monotonic() - started < 5
+    finally:
+        server.shutdown()
+
+def test_server_health_after_failed_warm_up(monkeypatch):
+    pytest.importorskip('uvicorn')
+    from fastapi.testclient import TestClient
+    import inference_server
+
+    class BrokenEngine:
+        def __init__(self):
+            raise FileNotFoundError('Не найдена модель models/x.gguf')
+
+    monkeypatch.setattr(inference_server, 'LLMEngine', BrokenEngine)
+    monkeypatch.setattr(inference_server, 'load_error', None)
+    inference_server.warm_up()
+    response = TestClient(inference_server.app).get('/health')
+    assert response.status_code == 500
+    assert 'models/x.gguf' in response.json()['detail']
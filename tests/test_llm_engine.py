@@ -0,0 +1,128 @@
+import json
+import time
+import pytest
+import llm_backends
+import llm_engine
+import analysis_stream
+from llm_router import routing_stats
+from llm_backends import FakeBackend, create_backend
+from llm_engine import LLMEngine
+from llm_cache import ResponseCache
+
+TEMPLATE = 'Правила: {{ context_rules }}\nДокумент {{ doc_id }} ({{ doc_type }}): {{ error_text }}'
+
+# движок на бэкенде-заглушке, без кэша ответов (Redis не нужен)
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setattr(llm_backends, 'LLM_BACKEND', 'fake')
+    monkeypatch.setattr(llm_engine, 'LLM_CACHE_ENABLED', False)
+    monkeypatch.setattr(LLMEngine, '_instance', None)
+    engine = LLMEngine()
+    engine.backend = FakeBackend(latency_ms=0, tokens_per_second=0)
+    engine.small_backend = FakeBackend(latency_ms=0, tokens_per_second=0, model_id='fake-small')
+    routing_stats.reset()
+    return engine
+
+def request(doc_id, error_category=None):
+    return {'doc_id': doc_id, 'doc_type': 'Invoice', 'error_text': 'e', 'rules': '-',
+            'template_text': TEMPLATE, 'template_key': '1:1', 'error_category': error_category}
+
+def test_fake_backend_pipeline(engine):
+    assert engine.model_id == 'fake'
+    result = json.loads(engine.analyze_error(**request('1')))
+    assert set(result) == {'reason', 'solution', 'criticality'}
+    assert len(engine.analyze_batch([request('1'), request('2')])) == 2
+    # шаблон скомпилирован один раз на версию промпта
+    assert list(engine._templates) == ['1:1']
+
+def test_fake_backend_latency_and_token_rate():
+    backend = FakeBackend(latency_ms=50, tokens_per_second=1000, response='x' * 400)
+    started = time.perf_counter()
+    backend.generate('prompt', {'max_tokens': 512})
+    # 50 мс задержки + 100 токенов при 1000 токенов/с
+    assert time.perf_counter() - started >= 0.15
+    assert backend._duration({'max_tokens': 10}) == pytest.approx(0.06)
+
+def test_non_json_answer_is_wrapped(engine):
+    engine.backend = FakeBackend(latency_ms=0, tokens_per_second=0, response='Не знаю')
+    result = json.loads(engine.analyze_error(**request('1')))
+    assert result['solution'] == 'Не знаю'
+    assert result['criticality'] == 'medium'
+
+def test_routing_small_model_and_escalation(engine):
+    engine.small_backend.response = json.dumps({'reason': 'Нет элемента IssueDate в Invoice.',
+                                                'solution': 'Добавьте IssueDate и загрузите документ повторно.',
+                                                'criticality': 'high'}, ensure_ascii=False)
+    answers = engine.analyze_batch([request('1', 'schema_error'), request('2', 'math_error')])
+    assert 'IssueDate' in json.loads(answers[0])['reason']
+    assert json.loads(answers[1]) == json.loads(engine.backend.response)
+    # неуверенный ответ маленькой модели пересчитывается большой
+    engine.small_backend.response = json.dumps({'reason': 'Не знаю', 'solution': '', 'criticality': 'low'})
+    answer = engine.analyze_error(**request('3', 'schema_error'))
+    assert json.loads(answer) == json.loads(engine.backend.response)
+    stats = routing_stats.snapshot()
+    assert stats['routed'] == {'small': 2, 'large': 1}
+    assert stats['escalated'] == 1
+    assert stats['generations'] == {'small': 2, 'large': 2}
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_backend('unknown')
+
+def test_streaming_publishes_partial_answer(engine, fake_redis):
+    redis_client = fake_redis
+    answer = engine.analyze_batch([{**request('1'), 'stream': True}, request('2')])[0]
+    # поток только у документа 1, части ответа вместе дают полный ответ
+    events = [json.loads(message) for channel, message in redis_client.published]
+    assert {channel for channel, _ in redis_client.published} == {analysis_stream.channel('1')}
+    assert json.loads(''.join(event['delta'] for event in events)) == json.loads(answer)
+    assert json.loads(json.loads(redis_client.values[analysis_stream.text_key('1')])['text']) == json.loads(answer)
+    assert analysis_stream.sse_event('done', {'a': 1}) == 'event: done\ndata: {"a": 1}\n\n'
+
+def test_prompt_not_html_escaped(engine):
+    # ошибки lxml полны кавычек и угловых скобок - модель должна видеть их как есть
+    template = engine._get_template(TEMPLATE, '1:1')
+    error_text = "Element 'cbc:Amount': value <0> & more"
+    prompt, tokens = engine.assembler.assemble(template, {**request('1'), 'error_text': error_text}, max_tokens=64)
+    assert error_text in prompt
+    assert tokens == engine.backend.count_tokens(prompt) + 1
+
+def test_cache_key_of_answering_model(engine, monkeypatch):
+    cache = ResponseCache(shared='none')
+    monkeypatch.setattr(llm_engine, 'LLM_CACHE_ENABLED', True)
+    monkeypatch.setattr(llm_engine, 'response_cache', cache)
+    small_answer = json.dumps({'reason': 'Нет элемента IssueDate в Invoice.',
+                               'solution': 'Добавьте IssueDate и загрузите документ повторно.',
+                               'criticality': 'high'}, ensure_ascii=False)
+    engine.small_backend.response = small_answer
+    engine.analyze_error(**request('1', 'schema_error'))
+    # тот же промпт, направленный на 8B, не получает из кэша ответ маленькой модели
+    answer = engine.analyze_error(**{**request('1', 'schema_error'), 'error_category': 'math_error'})
+    assert json.loads(answer) == json.loads(engine.backend.response)
+
+    # эскалация: ответ 8B кэшируется под ключом 8B
+    engine.small_backend.response = json.dumps({'reason': 'Не знаю', 'solution': '', 'criticality': 'low'})
+    request_2 = {**request('2', 'schema_error'), 'error_text': 'другая ошибка'}
+    engine.analyze_error(**request_2)
+    prompt, _ = engine.assembler.assemble(engine._get_template(TEMPLATE, '1:1'), request_2, 512)
+    config = {'temperature': 0.1, 'max_tokens': 512}
+    assert cache.get(engine._cache_key(prompt, config, 'large')) is not None
+    assert cache.get(engine._cache_key(prompt, config, 'small')) is None
+
+def test_streaming_escalation_resets_partial_answer(engine, fake_redis):
+    redis_client = fake_redis
+    engine.small_backend.response = json.dumps({'reason': 'Не знаю', 'solution': '', 'criticality': 'low'})
+    engine.analyze_error(**{**request('1', 'schema_error'), 'stream': True})
+    events = [json.loads(message) for _, message in redis_client.published]
+    escalated = events.index({'event': 'status', 'status': 'escalated', 'model': 'fake'})
+    assert escalated > 0 and len(events) > escalated + 1
+    assert all(event['model'] == 'fake-small' for event in events[:escalated])
+    # ответ большой модели - с нулевой позиции
+    assert events[escalated + 1]['offset'] == 0
+    assert all(event['model'] == 'fake' for event in events[escalated + 1:])
+
+def test_backend_requires_generate():
+    class NoGenerate(llm_backends.LLMBackend):
+        pass
+    with pytest.raises(TypeError):
+        NoGenerate()
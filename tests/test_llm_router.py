@@ -0,0 +1,29 @@
+import json
+from llm_router import choose_tier, is_confident, routing_summary
+
+ANSWER = {'reason': 'В элементе Invoice нет обязательного IssueDate.',
+          'solution': '1. Добавьте IssueDate. 2. Загрузите документ повторно.',
+          'criticality': 'high'}
+
+def test_choose_tier():
+    assert choose_tier('schema_error', "Element 'Invoice': Missing child element(s).", {}) == 'small'
+    assert choose_tier('math_error', 'Сумма строк (1) не совпадает с итогом (2)', {}) == 'large'
+    assert choose_tier('schema_error', 'x' * 1000, {}) == 'large'
+    assert choose_tier('schema_error', 'e', {'max_tokens': 2048}) == 'large'
+    assert choose_tier('math_error', 'e', {'model_tier': 'small'}) == 'small'
+    assert choose_tier(None, 'e', {}) == 'large'
+
+def test_confidence_heuristic():
+    assert is_confident('Ответ: ' + json.dumps(ANSWER, ensure_ascii=False))
+    assert not is_confident('Не знаю')
+    assert not is_confident(json.dumps({**ANSWER, 'criticality': 'critical'}))
+    assert not is_confident(json.dumps({**ANSWER, 'solution': 'Исправьте.'}, ensure_ascii=False))
+    assert not is_confident(json.dumps({**ANSWER, 'reason': 'Причина неизвестна, нужно больше данных.'},
+                                       ensure_ascii=False))
+
+def test_routing_summary():
+    summary = routing_summary({'llm_route_small': 3, 'llm_route_large': 1, 'llm_route_escalated': 1,
+                               'llm_small_ms': 300, 'llm_small_generations': 3})
+    assert summary['share_small'] == 0.75
+    assert summary['escalation_rate'] == 0.3333
+    assert summary['avg_generation_ms'] == {'small': 100.0, 'large': 0.0}
@@ -0,0 +1,52 @@
+import asyncio
+import pytest
+from parse_executor import ParseExecutor, ParseQueueFull
+
+XML = """<Invoice xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
+         xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">
+    <cbc:ID>INV-1</cbc:ID>
+</Invoice>"""
+
+def test_run_async_in_spawned_process():
+    # процессы пула запускаются через spawn, обработчик ждет результат без занятого потока
+    executor = ParseExecutor(mode='process', workers=1, min_bytes=0)
+    try:
+        result = asyncio.run(executor.run_async(XML))
+        assert result['parsed_metadata']['invoice_id'] == 'INV-1'
+        assert executor._pool._mp_context.get_start_method() == 'spawn'
+    finally:
+        executor.shutdown()
+
+def test_run_async_queue_full():
+    executor = ParseExecutor(mode='process', workers=1, queue_size=1, min_bytes=0)
+    executor._slots.acquire()
+    with pytest.raises(ParseQueueFull):
+        asyncio.run(executor.run_async(XML))
+
+def test_run_async_thread_mode():
+    result = asyncio.run(ParseExecutor(mode='thread').run_async(XML))
+    assert result['parsed_metadata']['invoice_id'] == 'INV-1'
+
+def test_cancelled_wait_keeps_queue_size():
+    # запрос, отмененный в ожидании места, не уносит с собой место в очереди
+    executor = ParseExecutor(mode='process', workers=1, queue_size=1, min_bytes=0, timeout=5)
+    executor._slots.acquire()
+
+    async def cancel_waiting():
+        task = asyncio.create_task(executor.run_async(XML, block=True))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        executor._slots.release()
+        await asyncio.sleep(0.05)
+        return executor._slots.acquire(blocking=False)
+    assert asyncio.run(cancel_waiting())
+    executor._slots.release()
+
+def test_min_bytes_counts_utf8_bytes():
+    executor = ParseExecutor(mode='process', min_bytes=10)
+    # 6 символов кириллицы - 12 байт в UTF-8
+    assert executor._in_process('Накладная'[:6])
+    assert not executor._in_process('abcdef')
+    assert executor._in_process(b'0123456789')
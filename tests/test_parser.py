@@ -1,5 +1,5 @@
 import pytest
-from xml_parser import EdiXmlParser
+from xml_parser import EdiXmlParser, SchemaCache
 
 # данные, которые готовятся перед тестом
 @pytest.fixture
@@ -21,4 +21,87 @@ def test_parse_invalid_xml(parser):
     xml = "<Invoice>Broken Tag"
     # жду, что парсер выбросит ошибку ValueError
     with pytest.raises(ValueError):
-        parser.parse_invoice(xml)
\ No newline at end of file
+        parser.parse_invoice(xml)
+
+def test_schema_cache_reuses_compiled_schema():
+    cache = SchemaCache(max_size=1)
+    xsd = """<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+        <xs:element name="Invoice" type="xs:string"/>
+    </xs:schema>"""
+    first = cache.get(('Invoice', 1), xsd)
+    # повторный запрос той же версии - попадание в кэш
+    assert cache.get(('Invoice', 1), xsd) is first
+    # новая версия вытесняет старую (размер кэша 1)
+    cache.get(('Invoice', 2), xsd)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 2, 1)
+    cache.invalidate('Invoice')
+    assert cache.stats()['size'] == 0
+
+
+def test_parse_document_validates_and_extracts_single_tree(parser):
+    with open('test_invoice.xml', encoding='utf-8') as f:
+        xml = f.read()
+    xsd = """<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"
+        targetNamespace="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
+        elementFormDefault="qualified">
+        <xs:element name="Invoice">
+            <xs:complexType>
+                <xs:sequence>
+                    <xs:any minOccurs="0" maxOccurs="unbounded" processContents="skip"/>
+                </xs:sequence>
+            </xs:complexType>
+        </xs:element>
+    </xs:schema>"""
+    result = parser.parse_document(xml, xsd_content=xsd)
+    assert result['validation_status'] in ('valid', 'math_error')
+    assert result['parsed_metadata']['invoice_id'] == 'INV-2025-001'
+    assert set(result['timings']) == {'parse_ms', 'validate_ms', 'extract_ms'}
+
+def test_parse_document_syntax_error(parser):
+    result = parser.parse_document("<Invoice>Broken Tag")
+    assert result['validation_status'] == 'syntax_error'
+    assert result['parsed_metadata']['validation_error']
+
+
+def _invoice_with_lines(count, declared_total):
+    lines = ''.join(
+        f"""<cac:InvoiceLine>
+            <cbc:ID>{i}</cbc:ID>
+            <cbc:InvoicedQuantity>1</cbc:InvoicedQuantity>
+            <cbc:LineExtensionAmount>2.50</cbc:LineExtensionAmount>
+        </cac:InvoiceLine>"""
+        for i in range(1, count + 1)
+    )
+    return f"""<Invoice xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
+             xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+             xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">
+        <cbc:ID>INV-BIG</cbc:ID>
+        {lines}
+        <cac:LegalMonetaryTotal>
+            <cbc:TaxExclusiveAmount>{declared_total}</cbc:TaxExclusiveAmount>
+        </cac:LegalMonetaryTotal>
+    </Invoice>"""
+
+def test_stream_mode_matches_tree_mode(parser):
+    xml = _invoice_with_lines(250, 625.0)
+    chunks = []
+    streamed = parser.parse_document(xml, streaming=True, on_lines=chunks.append)
+    tree = parser.parse_document(xml, streaming=False)
+    assert streamed['mode'] == 'stream'
+    assert streamed['validation_status'] == tree['validation_status'] == 'valid'
+    assert streamed['parsed_metadata']['invoice_id'] == 'INV-BIG'
+    assert streamed['parsed_metadata']['lines_count'] == 250
+    assert [len(c) for c in chunks] == [250]
+
+def test_stream_mode_math_error(parser):
+    result = parser.parse_document(_invoice_with_lines(3, 100), streaming=True)
+    assert result['validation_status'] == 'math_error'
+
+
+def test_header_id_ignores_nested_ids(parser):
+    # в накладной нет cbc:ID в шапке - ID строки не должен подставиться вместо него
+    xml = _invoice_with_lines(1, 2.5).replace('<cbc:ID>INV-BIG</cbc:ID>', '')
+    result = parser.parse_invoice(xml)
+    assert result['invoice_id'] is None
+    assert result['lines'][0]['line_id'] == '1'
@@ -0,0 +1,29 @@
+from jinja2 import Environment
+from llm_backends import FakeBackend
+from prompt_assembler import PromptAssembler, TRUNCATED_MARK
+
+TEMPLATE = Environment().from_string('Правила:\n{{ context_rules }}\nДокумент {{ doc_id }} ({{ doc_type }}): {{ error_text }}')
+
+def assembler(n_ctx):
+    backend = FakeBackend(latency_ms=0, tokens_per_second=0)
+    backend.n_ctx = n_ctx
+    return PromptAssembler(backend)
+
+def request(error_text, rules):
+    return {'doc_id': '1', 'doc_type': 'Invoice', 'error_text': error_text, 'rules': '\n'.join(rules)}
+
+def test_prompt_fits_without_changes():
+    prompt, tokens = assembler(4096).assemble(TEMPLATE, request('e', ['- a', '- b']), max_tokens=512)
+    assert prompt == TEMPLATE.render(doc_id='1', doc_type='Invoice', error_text='e', context_rules='- a\n- b')
+    assert tokens == (len(prompt) + 3) // 4 + 1
+
+def test_error_text_and_rules_trimmed_to_budget():
+    prompt_assembler = assembler(200)
+    rules = ['- ' + 'важное правило ' * 10, '- ' + 'x' * 400, '- короткое правило']
+    prompt, tokens = prompt_assembler.assemble(TEMPLATE, request('ошибка ' * 200, rules), max_tokens=64)
+    assert tokens + 64 <= 200
+    assert TRUNCATED_MARK in prompt
+    # длинное правило пропущено, следующее за ним короткое вошло
+    assert rules[0] in prompt and rules[1] not in prompt and rules[2] in prompt
+    # длины правил посчитаны один раз
+    assert set(prompt_assembler._rule_tokens) == set(rules)
@@ -0,0 +1,29 @@
+import json
+import time
+import metrics
+from celery_app import celery_app
+from tasks import LLM_SERVER_WAIT_SECONDS
+
+def test_proc_alive_timeout_covers_startup():
+    # по умолчанию Celery ждет worker_process_init 4 с - модель за это время не загрузить
+    assert celery_app.conf.worker_proc_alive_timeout > LLM_SERVER_WAIT_SECONDS
+
+def test_ready_record_expires(fake_redis):
+    client = fake_redis
+    metrics.mark_ready('alive', {'model': 'm'})
+    client.hset(metrics.READY_KEY, 'crashed', json.dumps({'model': 'm', 'ready_at': time.time() - 600}))
+
+    assert list(metrics.ready_processes(ttl=60)) == ['alive']
+    # запись упавшего процесса удалена
+    assert list(client.hgetall(metrics.READY_KEY)) == [b'alive']
+
+def test_heartbeat_refreshes_until_stopped(fake_redis):
+    client = fake_redis
+    metrics.start_heartbeat('worker', {'model': 'm'}, interval=0.01)
+    first = json.loads(client.hgetall(metrics.READY_KEY)[b'worker'])['ready_at']
+    time.sleep(0.05)
+    assert json.loads(client.hgetall(metrics.READY_KEY)[b'worker'])['ready_at'] > first
+
+    metrics.mark_stopped('worker')
+    time.sleep(0.03)
+    assert metrics.ready_processes() == {}
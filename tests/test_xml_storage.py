@@ -0,0 +1,84 @@
+import os
+import subprocess
+import sys
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+import xml_storage
+from database import User, EdiDocument
+from xml_storage import compress_xml, decompress_xml
+
+XML = '<Invoice><cbc:ID>INV-1</cbc:ID><cbc:Note>Счет</cbc:Note></Invoice>' * 20
+
+def test_gzip_round_trip():
+    data, codec = compress_xml(XML, 'gzip')
+    assert codec == 'gzip' and len(data) < len(XML.encode('utf-8'))
+    assert decompress_xml(data, codec) == XML
+    # mtime=0 - одинаковый XML сжимается в одинаковые байты
+    assert compress_xml(XML, 'gzip')[0] == data
+
+def test_zstd_round_trip():
+    pytest.importorskip('zstandard')
+    data, codec = compress_xml(XML, 'zstd')
+    assert codec == 'zstd'
+    assert decompress_xml(data, codec) == XML
+
+def test_without_zstandard(monkeypatch):
+    monkeypatch.setattr(xml_storage, 'zstandard', None)
+    with pytest.raises(RuntimeError):
+        compress_xml(XML, 'zstd')
+    with pytest.raises(ValueError):
+        compress_xml(XML, 'lz4')
+    # без пакета zstandard новые документы по умолчанию сжимаются gzip
+    code = 'import sys; sys.modules["zstandard"] = None; import xml_storage; print(xml_storage.XML_COMPRESSION)'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env.pop('XML_COMPRESSION', None)
+    result = subprocess.run([sys.executable, '-c', code], cwd=root, env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == 'gzip'
+
+@pytest.fixture
+def db():
+    # только таблицы документов: остальным нужен PostgreSQL (pgvector)
+    engine = create_engine('sqlite://')
+    User.__table__.create(engine)
+    EdiDocument.__table__.create(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(User(id=1, username='u', email='u@example.com', api_key='k'))
+    session.commit()
+    yield session
+    session.close()
+
+def test_content_xml_property_compresses(db):
+    doc = EdiDocument(filename='a.xml', doc_type='Invoice', owner_id=1, content_xml=XML)
+    assert doc.content_xml_raw is None and doc.content_codec == xml_storage.XML_COMPRESSION
+    db.add(doc)
+    db.commit()
+    db.expire_all()
+    assert db.get(EdiDocument, doc.id).content_xml == XML
+
+def test_content_xml_legacy_column(db):
+    # документы, загруженные до сжатия, читаются из прежней колонки content_xml
+    doc = EdiDocument(filename='old.xml', doc_type='Invoice', owner_id=1, content_xml_raw=XML)
+    db.add(doc)
+    db.commit()
+    db.expire_all()
+    doc = db.get(EdiDocument, doc.id)
+    assert doc.content_xml == XML
+    doc.content_xml = None
+    assert doc.content_xml is None and doc.content_codec is None
+
+def test_xml_columns_deferred(db):
+    db.add(EdiDocument(filename='a.xml', doc_type='Invoice', owner_id=1, content_xml=XML))
+    db.commit()
+    db.expire_all()
+    statements = []
+    event.listen(db.get_bind(), 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+
+    # список документов (как UserResponse.documents) не выбирает XML
+    docs = db.query(EdiDocument).filter(EdiDocument.owner_id == 1).all()
+    assert 'content_xml' not in statements[-1]
+    # XML подгружается отдельным запросом только при обращении
+    assert docs[0].content_xml == XML
+    assert 'content_xml_compressed' in statements[-1]
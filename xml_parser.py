@@ -1,29 +1,168 @@
 # парсинг XML (упрощённый формат UBL)
+import io
+import os
+import time
+import threading
+from collections import OrderedDict
 from lxml import etree
 from logger_config import logger
 
+# сколько скомпилированных XSD-схем держать в памяти процесса
+XSD_CACHE_SIZE = int(os.getenv('XSD_CACHE_SIZE', '32'))
+
+# документы от этого размера (в байтах) разбираются потоково, без построения полного дерева
+STREAMING_THRESHOLD_BYTES = int(os.getenv('XML_STREAMING_THRESHOLD_BYTES', str(5 * 1024 * 1024)))
+# размер пачки строк, которые потоковый парсер отдает в callback
+LINE_CHUNK_SIZE = int(os.getenv('XML_LINE_CHUNK_SIZE', '1000'))
+
+class SchemaCache:
+    """
+    LRU-кэш скомпилированных XSD-схем (etree.XMLSchema) на уровне процесса.
+    Ключ - (имя схемы, версия): новая версия схемы в БД получает новый ключ,
+    поэтому устаревшая запись просто вытесняется или сбрасывается через invalidate.
+    """
+    def __init__(self, max_size: int = XSD_CACHE_SIZE):
+        self.max_size = max_size
+        self._schemas = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, xsd_content: str):
+        """
+        Возвращает скомпилированную схему по ключу, компилируя её при промахе
+        """
+        with self._lock:
+            schema = self._schemas.get(key)
+            if schema is not None:
+                self._schemas.move_to_end(key)
+                self.hits += 1
+                return schema
+            self.misses += 1
+
+        # компиляция схемы - дорогая операция, делаю её вне блокировки
+        xsd_doc = etree.fromstring(xsd_content.encode('utf-8'))
+        schema = etree.XMLSchema(xsd_doc)
+
+        with self._lock:
+            self._schemas[key] = schema
+            self._schemas.move_to_end(key)
+            while len(self._schemas) > self.max_size:
+                self._schemas.popitem(last=False)
+                self.evictions += 1
+        return schema
+
+    def invalidate(self, name: str = None):
+        """
+        Сброс всех версий схемы с именем name (или всего кэша, если имя не задано)
+        """
+        with self._lock:
+            if name is None:
+                self._schemas.clear()
+                return
+            for key in [k for k in self._schemas if k[0] == name]:
+                del self._schemas[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._schemas),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0
+            }
+
+# глобальный кэш схем процесса
+schema_cache = SchemaCache()
+
+# пространства для имен UBL 2.1
+UBL_NS = {
+    'cbc': 'urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2',
+    'cac': 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2',
+    'ubl': 'urn:oasis:names:specification:ubl:schema:xsd:Invoice-2'
+}
+
+# карта полей шапки: имя поля -> (путь от корня Invoice, преобразование значения)
+# пути привязаны к корню (без //), поэтому не сканируют все дерево
+# и не цепляют вложенные cbc:ID из строк и сторон сделки
+HEADER_FIELDS = {
+    'invoice_id': ('cbc:ID', None),
+    'issue_date': ('cbc:IssueDate', None),
+    'currency': ('cbc:DocumentCurrencyCode', None),
+    'supplier_name': ('cac:AccountingSupplierParty/cac:Party/cac:PartyName/cbc:Name', None),
+    'customer_name': ('cac:AccountingCustomerParty/cac:Party/cac:PartyName/cbc:Name', None),
+    # Суммы
+    'total_payable': ('cac:LegalMonetaryTotal/cbc:PayableAmount', float),
+    'total_tax_excl': ('cac:LegalMonetaryTotal/cbc:TaxExclusiveAmount', float),
+}
+
+# карта полей строки товара: пути относительно cac:InvoiceLine
+LINE_FIELDS = {
+    'line_id': ('cbc:ID', None),
+    'quantity': ('cbc:InvoicedQuantity', float),
+    'line_amount': ('cbc:LineExtensionAmount', float),
+    'item_name': ('cac:Item/cbc:Name', None),
+}
+
+def _compile_fields(fields: dict):
+    """
+    Компиляция карты полей в etree.XPath один раз при импорте модуля
+    """
+    return [
+        (name, etree.XPath(f'{path}[1]', namespaces=UBL_NS), convert)
+        for name, (path, convert) in fields.items()
+    ]
+
+def _extract_fields(compiled_fields, element):
+    data = {}
+    for name, xpath, convert in compiled_fields:
+        res = xpath(element)
+        value = res[0].text if res else None
+        # числовые поля: пустое значение считаю нулем
+        data[name] = convert(value or 0) if convert else value
+    return data
+
 class EdiXmlParser:
     """
     Класс для разбора XML-накладных
     """
-    # пространства для имен UBL 2.1
-    NS = {
-        'cbc': 'urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2',
-        'cac': 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2',
-        'ubl': 'urn:oasis:names:specification:ubl:schema:xsd:Invoice-2'
-    }
+    NS = UBL_NS
+    
+    # скомпилированные извлекатели полей
+    HEADER_XPATHS = _compile_fields(HEADER_FIELDS)
+    LINE_XPATHS = _compile_fields(LINE_FIELDS)
+    INVOICE_LINES = etree.XPath('cac:InvoiceLine', namespaces=UBL_NS)
     
-    def validate_xsd(self, xml_bytes: bytes, xsd_content: str):
+    def load_tree(self, xml_content):
+        """
+        построение дерева lxml из строки или байтов (один раз на документ)
+        """
+        # строку кодирую в байты - lxml не принимает str с объявлением кодировки
+        if isinstance(xml_content, str):
+            xml_content = xml_content.encode('utf-8')
+        return etree.fromstring(xml_content)
+
+    def validate_xsd(self, xml_doc, xsd_content: str, schema_key=None):
         """
         валидация по схеме XSD
+        xml_doc - байты XML или уже построенное дерево (корневой элемент)
+        schema_key - (имя, версия) схемы в БД; если задан, скомпилированная схема берется из кэша
         """
         try:
-            # из строки создается объект схемы
-            xsd_doc = etree.fromstring(xsd_content.encode('utf-8'))
-            schema = etree.XMLSchema(xsd_doc)
+            # объект схемы: из кэша по ключу или компиляция из строки
+            if schema_key is not None:
+                schema = schema_cache.get(schema_key, xsd_content)
+            else:
+                xsd_doc = etree.fromstring(xsd_content.encode('utf-8'))
+                schema = etree.XMLSchema(xsd_doc)
             
-            # создается объект XML
-            xml_doc = etree.fromstring(xml_bytes)
+            # объект XML создается, только если дерево не передали готовым
+            if not isinstance(xml_doc, etree._Element):
+                xml_doc = etree.fromstring(xml_doc)
             
             # валидация
             schema.assertValid(xml_doc)
@@ -36,68 +175,241 @@ class EdiXmlParser:
         except Exception as e:
             return False, f'Ошибка в схеме XML: {e}'
         
-    def parse_invoice(self, xml_content: str):
+    def parse_invoice(self, xml_content):
         """
         парсинг XML типа документа Invoice
+        xml_content - строка, байты или уже построенное дерево
         """
         try:
-             
-            #удаление ByteOrderMark (BOM) если есть - чтобы lxml мог работать с файлом
-            if isinstance(xml_content, str):
-                xml_bytes = xml_content.encode('utf-8')
+            if isinstance(xml_content, etree._Element):
+                root = xml_content
             else:
-                xml_bytes = xml_content
+                root = self.load_tree(xml_content)
+            return self._extract_invoice(root)
+        
+        except etree.XMLSyntaxError as e:
+            logger.error("XML Syntax Error", extra={"error": str(e)})
+            raise ValueError(f"Invalid XML: {e}")
+        except Exception as e:
+            logger.error("Parser crash", extra={"error": str(e)})
+            raise e
 
-            root = etree.fromstring(xml_bytes)
-            
-            # вспомогательная функция для поиска с NameSpaces
-            def get_text(xpath_query, element=root):
-                # lxml требует явного указания NameSpaces
-                res = element.xpath(xpath_query, namespaces=self.NS)
-                return res[0].text if res else None
-            
-            # шапка документа
-            data = {
-                "invoice_id": get_text('//cbc:ID'),
-                "issue_date": get_text('//cbc:IssueDate'),
-                "currency": get_text('//cbc:DocumentCurrencyCode'),
-                "supplier_name": get_text('//cac:AccountingSupplierParty/cac:Party/cac:PartyName/cbc:Name'),
-                "customer_name": get_text('//cac:AccountingCustomerParty/cac:Party/cac:PartyName/cbc:Name'),
-                # Суммы
-                "total_payable": float(get_text('//cac:LegalMonetaryTotal/cbc:PayableAmount') or 0),
-                "total_tax_excl": float(get_text('//cac:LegalMonetaryTotal/cbc:TaxExclusiveAmount') or 0),
-                "lines": []
-            }
+    def _extract_invoice(self, root):
+        """
+        извлечение полей накладной и математическая проверка по готовому дереву
+        """
+        data = self._extract_header(root)
+        
+        # строки товаров - прямые потомки корня Invoice
+        lines = self.INVOICE_LINES(root)
+        for line in lines:
+            data["lines"].append(self._extract_line(line))
+        
+        # математическая валидация
+        # сумма всех строк должна быть равна Total Tax Exclusive Amount
+        calculated_total = sum(l['line_amount'] for l in data['lines'])
+        self._check_totals(data, calculated_total)
+
+        logger.info("UBL Invoice parsed", extra={"id": data["invoice_id"], "lines_count": len(lines)})
+        return data
+
+    def _extract_header(self, root):
+        """
+        шапка документа и итоговые суммы
+        """
+        data = _extract_fields(self.HEADER_XPATHS, root)
+        data['lines'] = []
+        return data
+
+    def _extract_line(self, line):
+        """
+        одна строка товара cac:InvoiceLine
+        """
+        return _extract_fields(self.LINE_XPATHS, line)
+
+    def _check_totals(self, data, calculated_total):
+        if abs(calculated_total - data['total_tax_excl']) > 0.01:
+            logger.warning("Math mismatch in invoice", extra={
+                "calculated": calculated_total,
+                "declared": data['total_tax_excl']
+            })
+            data["validation_error"] = f"Сумма строк ({calculated_total}) не совпадает с итогом ({data['total_tax_excl']})"
+        else:
+            data["validation_error"] = None
+
+    def parse_invoice_stream(self, xml_content, schema=None, on_lines=None, chunk_size: int = LINE_CHUNK_SIZE):
+        """
+        Потоковый парсинг Invoice через etree.iterparse для очень больших накладных.
+        Каждая cac:InvoiceLine обрабатывается и сразу удаляется из дерева, сумма строк
+        копится на лету, поэтому память не растет с числом строк.
+        schema - скомпилированная XMLSchema: документ валидируется в том же проходе
+        on_lines - необязательный callback, получает строки пачками по chunk_size
+        В результате вместо списка lines возвращается lines_count.
+        """
+        if isinstance(xml_content, str):
+            xml_content = xml_content.encode('utf-8')
+        
+        line_tag = etree.QName(self.NS['cac'], 'InvoiceLine').text
+        context = etree.iterparse(
+            io.BytesIO(xml_content),
+            events=('end',),
+            tag=line_tag,
+            schema=schema
+        )
+        
+        calculated_total = 0.0
+        lines_count = 0
+        chunk = []
+        for _, line in context:
+            item = self._extract_line(line)
+            calculated_total += item['line_amount']
+            lines_count += 1
             
-            # строки товаров
-            lines = root.xpath('//cac:InvoiceLine', namespaces=self.NS)
-            for line in lines:
-                item = {
-                    "line_id": get_text('cbc:ID', line),
-                    "quantity": float(get_text('cbc:InvoicedQuantity', line) or 0),
-                    "line_amount": float(get_text('cbc:LineExtensionAmount', line) or 0),
-                    "item_name": get_text('cac:Item/cbc:Name', line)
-                }
-                data["lines"].append(item)
+            if on_lines is not None:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    on_lines(chunk)
+                    chunk = []
             
-            # математическая валидация
-            # сумма всех строк должна быть равна Total Tax Exclusive Amount
-            calculated_total = sum(l['line_amount'] for l in data['lines'])
-            if abs(calculated_total - data['total_tax_excl']) > 0.01:
-                logger.warning("Math mismatch in invoice", extra={
-                    "calculated": calculated_total,
-                    "declared": data['total_tax_excl']
-                })
-                data["validation_error"] = f"Сумма строк ({calculated_total}) не совпадает с итогом ({data['total_tax_excl']})"
-            else:
-                data["validation_error"] = None
+            # освобождаю память: очищаю строку и удаляю уже обработанные строки перед ней
+            # (элементы шапки не трогаю - они нужны для извлечения полей в конце)
+            line.clear(keep_tail=True)
+            parent = line.getparent()
+            previous = line.getprevious()
+            while previous is not None and previous.tag == line_tag:
+                parent.remove(previous)
+                previous = line.getprevious()
+        
+        if chunk:
+            on_lines(chunk)
+        
+        # в дереве остались только шапка и итоги
+        data = self._extract_header(context.root)
+        del data['lines']
+        data['lines_count'] = lines_count
+        self._check_totals(data, calculated_total)
+        
+        logger.info("UBL Invoice parsed (stream)", extra={"id": data["invoice_id"], "lines_count": lines_count})
+        return data
 
-            logger.info("UBL Invoice parsed", extra={"id": data["invoice_id"], "lines_count": len(lines)})
-            return data
+    def parse_document(self, xml_content, xsd_content: str = None, schema_key=None,
+                       streaming: bool = None, on_lines=None):
+        """
+        Полная обработка загруженного документа за один разбор XML:
+        дерево строится один раз и используется и для XSD-валидации, и для извлечения полей.
+        Документы от STREAMING_THRESHOLD_BYTES (или при streaming=True) разбираются
+        потоково через iterparse - валидация и извлечение идут в том же проходе.
+        Возвращает словарь:
+            - validation_status (schema_error, syntax_error, math_error, valid)
+            - validation_error - текст ошибки или None
+            - parsed_metadata - результат парсинга
+            - mode - tree или stream
+            - timings - время этапов в миллисекундах (parse_ms, validate_ms, extract_ms)
+        """
+        # строку кодирую в байты один раз - дальше работаю только с ними
+        if isinstance(xml_content, str):
+            xml_content = xml_content.encode('utf-8')
+        if streaming is None:
+            streaming = len(xml_content) >= STREAMING_THRESHOLD_BYTES
+        
+        timings = {'parse_ms': 0.0, 'validate_ms': 0.0, 'extract_ms': 0.0}
+        result = {
+            'validation_status': 'pending',
+            'validation_error': None,
+            'parsed_metadata': {},
+            'mode': 'stream' if streaming else 'tree',
+            'timings': timings
+        }
+        
+        if streaming:
+            return self._parse_document_stream(xml_content, xsd_content, schema_key, on_lines, result)
         
+        # этап 1: построение дерева
+        started = time.perf_counter()
+        try:
+            root = self.load_tree(xml_content)
         except etree.XMLSyntaxError as e:
+            timings['parse_ms'] = _elapsed_ms(started)
             logger.error("XML Syntax Error", extra={"error": str(e)})
-            raise ValueError(f"Invalid XML: {e}")
-        except Exception as e:
+            return self._syntax_failure(result, e, xsd_content)
+        timings['parse_ms'] = _elapsed_ms(started)
+        
+        # этап 2: XSD-валидация по тому же дереву
+        if xsd_content is not None:
+            started = time.perf_counter()
+            is_valid, error = self.validate_xsd(root, xsd_content, schema_key=schema_key)
+            timings['validate_ms'] = _elapsed_ms(started)
+            if not is_valid:
+                return _failure(result, 'schema_error', error)
+        
+        # этап 3: извлечение полей и математическая проверка
+        started = time.perf_counter()
+        try:
+            data = self._extract_invoice(root)
+        except ValueError as e:
+            # например, нечисловая сумма в строке
+            logger.error("Parser crash", extra={"error": str(e)})
+            return _failure(result, 'syntax_error', str(e))
+        finally:
+            timings['extract_ms'] = _elapsed_ms(started)
+        
+        return self._success(result, data)
+
+    def _parse_document_stream(self, xml_bytes: bytes, xsd_content, schema_key, on_lines, result):
+        """
+        потоковая ветка parse_document: один проход iterparse с валидацией по схеме
+        """
+        timings = result['timings']
+        schema = None
+        if xsd_content is not None:
+            started = time.perf_counter()
+            try:
+                if schema_key is not None:
+                    schema = schema_cache.get(schema_key, xsd_content)
+                else:
+                    schema = etree.XMLSchema(etree.fromstring(xsd_content.encode('utf-8')))
+            except Exception as e:
+                return _failure(result, 'schema_error', f'Ошибка в схеме XML: {e}')
+            finally:
+                timings['validate_ms'] = _elapsed_ms(started)
+        
+        # разбор, валидация и извлечение идут одним проходом - время пишу в parse_ms
+        started = time.perf_counter()
+        try:
+            data = self.parse_invoice_stream(xml_bytes, schema=schema, on_lines=on_lines)
+        except etree.XMLSyntaxError as e:
+            # iterparse сообщает об ошибках схемы тем же исключением - различаю по коду ошибки
+            if schema is not None and etree.ErrorTypes.SCHEMAV_NOROOT <= e.code <= etree.ErrorTypes.SCHEMAV_MISC:
+                logger.warning(f'XSD валидация не пройдена: {e}')
+                return _failure(result, 'schema_error', str(e))
+            logger.error("XML Syntax Error", extra={"error": str(e)})
+            return self._syntax_failure(result, e, xsd_content)
+        except ValueError as e:
             logger.error("Parser crash", extra={"error": str(e)})
-            raise e
\ No newline at end of file
+            return _failure(result, 'syntax_error', str(e))
+        finally:
+            timings['parse_ms'] = _elapsed_ms(started)
+        
+        return self._success(result, data)
+
+    def _syntax_failure(self, result, error, xsd_content):
+        # при наличии схемы битый XML, как и раньше, считается ошибкой схемы
+        if xsd_content is not None:
+            return _failure(result, 'schema_error', f'Ошибка в схеме XML: {error}')
+        return _failure(result, 'syntax_error', f'Invalid XML: {error}')
+
+    def _success(self, result, data):
+        result['parsed_metadata'] = data
+        result['validation_error'] = data.get('validation_error')
+        result['validation_status'] = 'math_error' if data.get('validation_error') else 'valid'
+        logger.info('Document processed', extra={'mode': result['mode'], **result['timings']})
+        return result
+
+def _failure(result, status: str, error: str):
+    result['validation_status'] = status
+    result['validation_error'] = error
+    result['parsed_metadata'] = {'validation_error': error}
+    return result
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 3)
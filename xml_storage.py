@@ -0,0 +1,47 @@
+# сжатие "сырого" XML документов для хранения в БД
+import gzip
+import os
+
+# zstandard - необязательная зависимость: без нее XML сжимается gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# алгоритм сжатия новых документов: zstd (если установлен zstandard) или gzip
+XML_COMPRESSION = os.getenv('XML_COMPRESSION', 'zstd' if zstandard else 'gzip')
+XML_COMPRESSION_LEVEL = int(os.getenv('XML_COMPRESSION_LEVEL', '6'))
+
+def compress_xml(content_xml: str, codec: str = XML_COMPRESSION):
+    """
+    Возвращает (сжатые байты, название алгоритма)
+    """
+    data = content_xml.encode('utf-8')
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Для сжатия zstd установите пакет zstandard')
+        return zstandard.ZstdCompressor(level=XML_COMPRESSION_LEVEL).compress(data), 'zstd'
+    if codec == 'gzip':
+        # mtime=0 - одинаковый XML дает одинаковые байты
+        return gzip.compress(data, compresslevel=XML_COMPRESSION_LEVEL, mtime=0), 'gzip'
+    raise ValueError(f'Неизвестный алгоритм сжатия: {codec}')
+
+def decompress_xml(data: bytes, codec: str) -> str:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Документ сжат zstd - установите пакет zstandard')
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    if codec == 'gzip':
+        return gzip.decompress(data).decode('utf-8')
+    raise ValueError(f'Неизвестный алгоритм сжатия: {codec}')
+
+def storage_columns(content_xml: str):
+    """
+    Значения колонок EdiDocument для хранения XML (для bulk-вставки без ORM-объектов)
+    """
+    compressed, codec = compress_xml(content_xml)
+    return {
+        'content_xml_raw': None,
+        'content_xml_compressed': compressed,
+        'content_codec': codec
+    }